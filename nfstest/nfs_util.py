@@ -29,6 +29,8 @@ import subprocess
 from host import Host
 import nfstest_config as c
 from packet.pktt import Pktt
+from packet.nfs.layoutmap import LayoutMap
+from packet.nfs.nfs4state import NFS4State
 from packet.nfs.nfs4_const import *
 
 # Module constants
@@ -115,6 +117,7 @@ class NFSUtil(Host):
         self.nii_server = ''  # nii_name for the server
         self.device_info = {}
         self.dslist = []
+        self._ds_io_map = None  # I/O sent to the data servers (see _ds_io)
         self.stateid = None
         self.rootfh  = None
         self.rootfsid = None
@@ -365,9 +368,18 @@ class NFSUtil(Host):
             # Find request
             pktcall = self.pktt.match(src + dst + match + "NFS.argop == %d" % op, maxindex=maxindex)
             if pktcall and not call_only:
+                # Use the reply index so there is no search for a reply
+                # which does not exist and the search stops at the reply
+                rindex = self.pktt.reply_index(pktcall.record.index)
+                if rindex == -1:
+                    # There is no reply for this call
+                    continue
+                rmaxindex = maxindex
+                if rindex is not None and (not maxindex or rindex + 1 < maxindex):
+                    rmaxindex = rindex + 1
                 # Find reply
                 xid = pktcall.rpc.xid
-                pktreply = self.pktt.match("RPC.xid == %d and %s NFS.resop == %d" % (xid, mstatus, op), maxindex=maxindex)
+                pktreply = self.pktt.match("RPC.xid == %d and %s NFS.resop == %d" % (xid, mstatus, op), maxindex=rmaxindex)
                 if pktreply:
                     break
             else:
@@ -693,6 +705,73 @@ class NFSUtil(Host):
             ds_index += nfhs
         return n == m and idx == ds_index
 
+    def find_ds_io(self, iomode=None, maxindex=None, start=None):
+        """Map all the I/O sent to the data servers back to the file in a
+           single pass over the packet trace starting at the current packet.
+           The layouts and devices are taken from the LAYOUTGET and
+           GETDEVICEINFO replies found in the packet trace and the I/O is
+           mapped in batches (see packet.nfs.layoutmap.LayoutMap.queue).
+           The packet trace is rewound to the current packet afterwards.
+
+           iomode:
+               Map reads (iomode == 1) or writes (iomode == 2)
+               [default: map both reads and writes]
+           maxindex:
+               Stop the search at this packet index [default: None]
+           start:
+               Start the search at this packet index instead of the
+               current packet [default: None]
+
+           Return a tuple (layout_map, io_map) where layout_map is the
+           layout map object (packet.nfs.layoutmap.LayoutMap) and io_map
+           is a dictionary: ds_index => [(index, xid, file_offset, size, valid), ...]
+           where valid is True if the I/O is sent to the correct data
+           server and it is within a single stripe unit.
+        """
+        io_ops = (OP_READ, OP_WRITE)
+        if iomode is not None:
+            io_ops = (OP_READ,) if iomode == LAYOUTIOMODE4_READ else (OP_WRITE,)
+        lmap = LayoutMap()
+        io_map = {}
+        save_index = self.pktt.index
+        if start is not None:
+            self.pktt.rewind(start)
+        for pkt in self.pktt:
+            if maxindex is not None and pkt.record.index >= maxindex:
+                break
+            if pkt != "nfs":
+                continue
+            if pkt.rpc.type == 1:
+                lmap.add(pkt, self.pktt.pkt_call)
+                continue
+            # Callbacks change the layouts on the call
+            lmap.add(pkt)
+            if not hasattr(pkt.nfs, "array") or len([x for x in pkt.nfs.array if x.op in io_ops]) == 0:
+                continue
+            lmap.queue(pkt)
+        for item in lmap.flush():
+            (index, xid, seg, position, ds_index, file_offset, size, valid) = item
+            io_map.setdefault(ds_index, []).append((index, xid, file_offset, size, valid))
+        self.pktt.rewind(save_index)
+        return (lmap, io_map)
+
+    def _ds_io(self, iomode, maxindex=None):
+        """Return the I/O sent to the data servers mapped back to the file
+           for the whole packet trace as a dictionary:
+           (index, xid) => (ds_index, file_offset, valid)
+           The map is built once for each packet trace, iomode and maxindex.
+        """
+        item = self._ds_io_map
+        if item is None or item[0] is not self.pktt or item[1] != (iomode, maxindex):
+            lmap, io_map = self.find_ds_io(iomode, maxindex=maxindex, start=0)
+            ds_io = {}
+            for ds_index, io_list in io_map.items():
+                for (index, xid, file_offset, size, valid) in io_list:
+                    ds_io[(index, xid)] = (ds_index, file_offset, valid)
+            item = (self.pktt, (iomode, maxindex), ds_io)
+            self._ds_io_map = item
+        return item[2]
+
     def getop(self, pkt, op):
         """Get the NFS operation object from the given packet"""
         if pkt:
@@ -835,26 +914,29 @@ class NFSUtil(Host):
                     self.dprint('DBG2', "CREATE_SESSION sessionid: %s" % self.sessionid)
                     self.dprint('DBG2', "CREATE_SESSION ca_maxrespsz: %s" % self.ca_maxrespsz)
 
+                    # Find first SEQUENCE request per slot id in a single pass
+                    seqid_map = {}
+                    dst = "IP.dst == '%s' and " % ipaddr
+                    if port != None:
+                        dst += "TCP.dst_port == %d and " % port
+                    exprs = {'sequence': dst + "NFS.argop == %d" % OP_SEQUENCE}
+                    for name, pkt in self.pktt.match_many(exprs, rewind=True):
+                        if pkt.NFSop.slotid not in seqid_map:
+                            seqid_map[pkt.NFSop.slotid] = pkt.NFSop.sequenceid
+
                     slotid = 0
                     fmsg = None
                     test_seq = True
-                    save_index = self.pktt.index
-                    while True:
-                        # Find first SEQUENCE request per slot id
-                        (pktcall, pktreply) = self.find_nfs_op(OP_SEQUENCE, ipaddr, port, call_only=True, match="NFS.slotid == %d" % slotid)
-                        if pktcall is None:
-                            break
-                        self.pktt.rewind(save_index)
+                    while slotid in seqid_map:
                         slotid += 1
-                        if pktcall.NFSop.sequenceid != 1:
-                            fmsg = ", slot id %d starts with sequence id %d" % (slotid-1, pktcall.NFSop.sequenceid)
+                        if seqid_map[slotid-1] != 1:
+                            fmsg = ", slot id %d starts with sequence id %d" % (slotid-1, seqid_map[slotid-1])
                             test_seq = False
                             break
                     if slotid > 0:
                         self.test(test_seq, "SEQUENCE request should start with a sequence id of 1", failmsg=fmsg)
                     else:
                         self.test(False, "SEQUENCE request was not found")
-                    self.pktt.rewind(save_index)
             elif pktcall:
                 self.test(False, "CREATE_SESSION reply was not found")
 
@@ -1054,6 +1136,7 @@ class NFSUtil(Host):
         save_index = self.pktt.index
         xids = []
         offsets = {}
+        cindex_list = []
         good_pattern = 0
         bad_pattern = 0
         self.test_offsets = []  # Save the offsets sent to the server on I/O
@@ -1076,6 +1159,10 @@ class NFSUtil(Host):
         # Get I/O type: iomode == 1 (READ), else (WRITE)
         io_op = OP_READ if iomode == LAYOUTIOMODE4_READ else OP_WRITE
 
+        # I/O sent to the data servers mapped back to the file using
+        # the layouts held by the client when the I/O was sent
+        ds_io = self._ds_io(iomode, maxindex) if ds_index is not None else {}
+
         # Find all I/O requests for MDS or current DS
         while True:
             # Find I/O request
@@ -1083,6 +1170,7 @@ class NFSUtil(Host):
             if not pkt:
                 break
             xids.append(pkt.rpc.xid)
+            cindex_list.append(pkt.record.index)
             nfsop = pkt.NFSop
             self.test_offsets.append(nfsop.offset)
             xid_counts[pkt.rpc.xid] = nfsop.count
@@ -1096,7 +1184,11 @@ class NFSUtil(Host):
             self.stateid = nfsop.stateid.other
 
             # Get real file offset
-            file_offset = self.get_abs_offset(nfsop.offset, ds_index)
+            dsinfo = ds_io.get((pkt.record.index, pkt.rpc.xid))
+            if dsinfo is not None:
+                file_offset = dsinfo[1]
+            else:
+                file_offset = self.get_abs_offset(nfsop.offset, ds_index)
 
             if iomode == LAYOUTIOMODE4_READ:
                 size = nfsop.count
@@ -1111,7 +1203,12 @@ class NFSUtil(Host):
                 self.max_iosize = size
 
             # Check if I/O is sent to the MDS or correct DS according to stripe size
-            if ds_index is not None and not self.verify_stripe(file_offset, size, ds_index):
+            if ds_index is None:
+                pass
+            elif dsinfo is not None:
+                if dsinfo[0] != ds_index or not dsinfo[2]:
+                    self.test_stripe = False
+            elif not self.verify_stripe(file_offset, size, ds_index):
                 self.test_stripe = False
 
         # Rewind trace file to saved packet index
@@ -1130,10 +1227,21 @@ class NFSUtil(Host):
         # Flag showing if this DS is the same as the MDS
         dsismds = (ipaddr == self.server_ipaddr and port == self.port)
 
+        # Use the reply index to stop searching right after the last reply
+        # or not to search at all when none of the calls have a reply
+        search = True
+        rmaxindex = maxindex
+        rindex_list = [self.pktt.reply_index(x) for x in cindex_list]
+        if None not in rindex_list:
+            search = max(rindex_list) >= 0
+            rmaxindex = max(rindex_list) + 1
+            if maxindex and rmaxindex > maxindex:
+                rmaxindex = maxindex
+
         # Find all I/O replies for MDS or current DS
-        while True:
+        while search:
             # Find I/O reply
-            pkt = self.pktt.match("NFS.resop == %d" % io_op, maxindex=maxindex)
+            pkt = self.pktt.match("NFS.resop == %d" % io_op, maxindex=rmaxindex)
             if not pkt:
                 break
             xid = pkt.rpc.xid
@@ -1352,6 +1460,24 @@ class NFSUtil(Host):
             self.pktt.rewind(save_index)
         return self.stateid
 
+    def get_nfs4_state(self, maxindex=None):
+        """Rebuild the NFSv4 open, lock, delegation and layout state in a
+           single pass over the packet trace starting at the current packet.
+           The packet trace is rewound to the current packet afterwards.
+           Return the state tracker object (packet.nfs.nfs4state.NFS4State).
+
+           maxindex:
+               Stop the search at this packet index [default: None]
+        """
+        state = NFS4State()
+        save_index = self.pktt.index
+        for pkt in self.pktt:
+            if maxindex is not None and pkt.record.index >= maxindex:
+                break
+            state.add(pkt, self.pktt.pkt_call)
+        self.pktt.rewind(save_index)
+        return state
+
     def stid_str(self, stateid):
         """Display the state id in CRC16 format"""
         stid = self.format("{0:crc16}", stateid)
@@ -105,6 +105,8 @@ NFSTEST_CWDCFG  = '.nfstest'
 NFSTEST_SCRIPTS = [
     'test/nfstest_alloc',
     'test/nfstest_cache',
+    'test/nfstest_compare',
+    'test/nfstest_db',
     'test/nfstest_delegation',
     'test/nfstest_dio',
     'test/nfstest_file',
@@ -115,6 +117,7 @@ NFSTEST_SCRIPTS = [
     'test/nfstest_pnfs',
     'test/nfstest_posix',
     'test/nfstest_sparse',
+    'test/nfstest_stats',
     'test/nfstest_xid',
 ]
 NFSTEST_ALLMODS = [
@@ -126,10 +129,18 @@ NFSTEST_ALLMODS = [
     'nfstest/rexec.py',
     'nfstest/test_util.py',
     'nfstest/utils.py',
+    'packet/dedup.py',
     'packet/derunpack.py',
+    'packet/export.py',
+    'packet/nsindex.py',
+    'packet/pcapscan.py',
     'packet/pkt.py',
+    'packet/pktcache.py',
+    'packet/pktdb.py',
     'packet/pktt.py',
     'packet/record.py',
+    'packet/sample.py',
+    'packet/stats.py',
     'packet/unpack.py',
     'packet/utils.py',
     'packet/application/dns.py',
@@ -149,18 +160,25 @@ NFSTEST_ALLMODS = [
     'packet/internet/ipv6addr.py',
     'packet/link/ethernet.py',
     'packet/link/macaddr.py',
+    'packet/nfs/attrcache.py',
+    'packet/nfs/iopattern.py',
+    'packet/nfs/layoutmap.py',
+    'packet/nfs/lockwait.py',
+    'packet/nfs/lookupstorm.py',
     'packet/nfs/mount3.py',
     'packet/nfs/mount3_const.py',
     'packet/nfs/nfs3.py',
     'packet/nfs/nfs3_const.py',
     'packet/nfs/nfs4.py',
     'packet/nfs/nfs4_const.py',
+    'packet/nfs/nfs4state.py',
     'packet/nfs/nfs.py',
     'packet/nfs/nfsbase.py',
     'packet/nfs/nlm4.py',
     'packet/nfs/nlm4_const.py',
     'packet/nfs/portmap2.py',
     'packet/nfs/portmap2_const.py',
+    'packet/nfs/writecommit.py',
     'packet/transport/tcp.py',
     'packet/transport/udp.py',
 ]
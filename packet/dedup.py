@@ -0,0 +1,179 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Duplicate packet filter module
+
+Find the packets seen on more than one trace file when multiple trace files
+are merged, e.g., when capturing on both interfaces of a bonded link or when
+merging the client and server packet traces. The packet is identified using
+the raw record data so the duplicate packets are dropped before they are
+decoded. The packet key is given by the IP addresses, transport ports, TCP
+sequence and acknowledgment numbers, payload length and RPC xid (first four
+bytes of the RPC message).
+
+The packet keys are kept in a sliding window so the memory used does not
+depend on the number of packets. A packet is a duplicate only if the same
+key has been seen more times on another trace file, so packets seen more
+than once on the same trace file, e.g., TCP re-transmissions or duplicate
+ACKs, are not dropped.
+"""
+import struct
+import nfstest_config as c
+from baseobj import BaseObj
+from collections import OrderedDict
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+def packet_key(link_type, data):
+    """Return the key identifying the packet given by the raw record data,
+       None is returned if the packet is not a TCP or UDP packet
+
+       link_type:
+           Link type given by the trace file header
+       data:
+           Raw record data
+    """
+    if link_type != 1 or len(data) < 14:
+        return None
+    # Ethernet layer, skip any VLAN tags
+    off = 12
+    etype = struct.unpack("!H", data[off:off+2])[0]
+    while etype in (0x8100, 0x88a8) and len(data) >= off + 6:
+        off += 4
+        etype = struct.unpack("!H", data[off:off+2])[0]
+    off += 2
+
+    if etype == 0x0800 and len(data) >= off + 20:
+        # IPv4
+        ihl = (ord(data[off]) & 0x0f) * 4
+        total, = struct.unpack("!H", data[off+2:off+4])
+        proto = ord(data[off+9])
+        addrs = data[off+12:off+20]
+        size  = total - ihl
+        off  += ihl
+    elif etype == 0x86dd and len(data) >= off + 40:
+        # IPv6
+        size, = struct.unpack("!H", data[off+4:off+6])
+        proto = ord(data[off+6])
+        addrs = data[off+8:off+40]
+        off  += 40
+    else:
+        return None
+
+    if proto == 6 and len(data) >= off + 20:
+        # TCP: ports, sequence and acknowledgment numbers
+        ports = data[off:off+12]
+        hlen = (ord(data[off+12]) >> 4) * 4
+        size -= hlen
+        off  += hlen
+        # Skip the RPC record marker
+        xid = data[off+4:off+8] if size >= 8 else data[off:off+min(max(size, 0), 4)]
+    elif proto == 17 and len(data) >= off + 8:
+        # UDP
+        ports = data[off:off+4]
+        size -= 8
+        off  += 8
+        xid = data[off:off+4]
+    else:
+        return None
+    return (addrs, ports, size, xid)
+
+class DupFilter(BaseObj):
+    """Duplicate packet filter
+
+       Usage:
+           from packet.dedup import DupFilter
+
+           x = DupFilter(window=1.0)
+
+           # Check if packet has been seen on another trace file
+           if x.duplicate(secs, tfile_index, link_type, data):
+               # Drop packet
+
+       Object definition:
+
+       DupFilter(
+           window  = float, # Time window in seconds
+           maxsize = int,   # Maximum number of packets in the window
+           dropped = int,   # Number of duplicate packets found
+       )
+    """
+    # Class attributes
+    _attrlist = ("window", "maxsize", "dropped")
+
+    def __init__(self, window=1.0, maxsize=100000):
+        """Constructor
+
+           window:
+               Time window in seconds, a packet is compared to all packets
+               seen within this time, it should be larger than the clock
+               difference between the trace files [default: 1.0]
+           maxsize:
+               Maximum number of packets kept in the window, the oldest
+               packets are discarded once this limit is reached regardless
+               of the time window [default: 100000]
+        """
+        self.window  = window
+        self.maxsize = maxsize
+        self.dropped = 0
+        # Sliding window: key => [time first seen, {source: count}]
+        self._window = OrderedDict()
+
+    def reset(self):
+        """Forget all packets seen"""
+        self.dropped = 0
+        self._window = OrderedDict()
+
+    def duplicate(self, secs, source, link_type, data):
+        """Return True if the packet is a duplicate of a packet seen on
+           another trace file
+
+           secs:
+               Packet timestamp in seconds
+           source:
+               Trace file where the packet is seen, e.g., its index
+           link_type:
+               Link type given by the trace file header
+           data:
+               Raw record data
+        """
+        key = packet_key(link_type, data)
+        if key is None:
+            return False
+
+        # Discard all packets outside the time window
+        pwindow = self._window
+        while pwindow:
+            item = next(pwindow.itervalues())
+            if len(pwindow) < self.maxsize and secs - item[0] <= self.window:
+                break
+            pwindow.popitem(last=False)
+
+        entry = pwindow.get(key)
+        if entry is None:
+            pwindow[key] = [secs, {source: 1}]
+            return False
+        counts = entry[1]
+        count = counts.get(source, 0)
+        counts[source] = count + 1
+        for src, value in counts.iteritems():
+            if src != source and value > count:
+                # Another trace file has more copies of this packet
+                self.dropped += 1
+                return True
+        return False
@@ -0,0 +1,351 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Packet export module
+
+Export the decoded NFS packets as columnar data having a fixed schema, one
+row for every NFS packet, so the packet trace could be loaded for analysis,
+e.g., using pandas. The rows are written in chunks so the memory used does
+not depend on the number of packets.
+
+Formats:
+    CSV
+        One line for every packet having a header line with the column
+        names, missing values are empty
+    NumPy (.npz)
+        One array for every column, numeric columns are 64-bit integers
+        having -1 for missing values or 64-bit floats having NaN for missing
+        values and string columns are fixed width byte strings. The file is
+        written without NumPy, each column is written to a temporary .npy
+        file which is then added to the .npz file
+
+Columns:
+    index   Packet index
+    time    Timestamp in seconds since the epoch
+    src     Source IP address
+    sport   Source port
+    dst     Destination IP address
+    dport   Destination port
+    xid     RPC transaction id
+    type    RPC message type (0: call, 1: reply)
+    version NFS version, e.g., NFSv3 or NFSv4.1
+    op      NFSv3 procedure or main operation of the NFSv4 COMPOUND
+    status  NFS status of a reply
+    offset  File offset
+    count   Number of bytes
+    latency Time from the call to the reply
+    fh      File handle given as its crc32
+    name    File name
+
+For a reply, the file handle, offset, count and name are taken from the
+call if not given in the reply.
+"""
+import os
+import csv
+import struct
+import zipfile
+import tempfile
+import formatstr
+import nfstest_config as c
+from baseobj import BaseObj
+from packet.nfs.nfsbase import nfs_opinfo
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Number of rows to write at a time
+CHUNK_SIZE = 10000
+
+# Column types: "i" for 64-bit integers, "f" for 64-bit floats
+# and "s" for strings
+COLUMNS = (
+    ("index",   "i"),
+    ("time",    "f"),
+    ("src",     "s"),
+    ("sport",   "i"),
+    ("dst",     "s"),
+    ("dport",   "i"),
+    ("xid",     "i"),
+    ("type",    "i"),
+    ("version", "s"),
+    ("op",      "s"),
+    ("status",  "i"),
+    ("offset",  "i"),
+    ("count",   "i"),
+    ("latency", "f"),
+    ("fh",      "i"),
+    ("name",    "s"),
+)
+COLUMN_TYPES = dict(COLUMNS)
+COLUMN_NAMES = [x[0] for x in COLUMNS]
+
+# Missing values for each column type in the NumPy file
+_MISSING = {"i": -1, "f": float("nan"), "s": ""}
+
+# Size of the .npy header, it is written before the number of rows is
+# known and it is rewritten once all rows have been written
+_NPY_HEADER_SIZE = 128
+
+def _npy_header(descr, nrows):
+    """Return the header of a .npy file (format version 1.0)"""
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, nrows)
+    header = header.ljust(_NPY_HEADER_SIZE - 11) + "\n"
+    return "\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header
+
+def _get_value(item, name):
+    """Return the value of the given attribute of the operation or None,
+       methods are ignored since the attribute lookup of the decoded
+       objects could fall back to a string, e.g., "count" for OPEN
+       gives the method count of the file name
+    """
+    value = getattr(item, name, None)
+    return None if callable(value) else value
+
+def _get_fh(nfs, item):
+    """Return the file handle of the given operation, for an NFSv4 COMPOUND
+       it is the current file handle for the operation
+    """
+    fh = getattr(item, "fh", None)
+    if fh is None and hasattr(nfs, "array"):
+        for op in nfs.array:
+            if op is item:
+                break
+            if getattr(op, "fh", None) is not None:
+                fh = op.fh
+    return fh
+
+class PktExport(BaseObj):
+    """Packet export object
+
+       Usage:
+           from packet.pktt import Pktt
+           from packet.export import PktExport
+
+           x = Pktt("/traces/tracefile.cap")
+           e = PktExport("/traces/tracefile.npz")
+           for pkt in x:
+               e.add(pkt, x.pkt_call)
+           e.close()
+
+           # Load the data using pandas
+           import numpy, pandas
+           df = pandas.DataFrame(dict(numpy.load("/traces/tracefile.npz")))
+
+       Object definition:
+
+       PktExport(
+           outfile = str,  # Name of file to write
+           fields  = list, # List of columns to write
+           count   = int,  # Number of rows written
+       )
+    """
+    # Class attributes
+    _attrlist = ("outfile", "fields", "count")
+
+    def __init__(self, outfile, fields=None):
+        """Constructor
+
+           outfile:
+               Name of file to write, it is written as a NumPy .npz file
+               if the name ends with ".npz" or as a CSV file otherwise
+           fields:
+               List of columns to write, all columns are written if not
+               given [default: None]
+        """
+        if fields is None:
+            fields = COLUMN_NAMES
+        for name in fields:
+            if name not in COLUMN_TYPES:
+                raise ValueError("Invalid field: %s" % name)
+        self.outfile = outfile
+        self.fields  = list(fields)
+        self.count   = 0
+        self._rows   = []
+        self._npz    = outfile.endswith(".npz")
+        if self._npz:
+            # Temporary file for each column: [file object, file name, width]
+            # where width is the maximum length of a string column
+            self._columns = []
+            outdir = os.path.dirname(os.path.abspath(outfile))
+            for name in self.fields:
+                fd, tmpfile = tempfile.mkstemp(prefix=".%s." % name, dir=outdir)
+                fobj = os.fdopen(fd, "wb")
+                if COLUMN_TYPES[name] != "s":
+                    fobj.write(_npy_header("<i8", 0))
+                self._columns.append([fobj, tmpfile, 1])
+        else:
+            self._fd = open(outfile, "wb")
+            self._writer = csv.writer(self._fd)
+            self._writer.writerow(self.fields)
+
+    def __del__(self):
+        """Destructor
+
+           Remove all temporary files.
+        """
+        for item in getattr(self, "_columns", []):
+            item[0].close()
+            if os.path.exists(item[1]):
+                os.unlink(item[1])
+
+    def add(self, pkt, pkt_call=None):
+        """Add a row for the given packet if it is an NFS packet,
+           returns True if the row is added
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Packet call object if pkt is a reply [default: None]
+        """
+        if pkt != "nfs":
+            return False
+        rpc = pkt.rpc
+        nfs = pkt.nfs
+        version, opname, item = nfs_opinfo(pkt)
+        if pkt_call is not None and (pkt_call != "nfs" or pkt_call.rpc.xid != rpc.xid):
+            # Call is not in the packet trace
+            pkt_call = None
+
+        values = {
+            "index":   pkt.record.index,
+            "time":    pkt.record.secs,
+            "xid":     rpc.xid,
+            "type":    rpc.type,
+            "version": version,
+            "op":      opname,
+        }
+        if pkt.ip is not None:
+            values["src"] = pkt.ip.src
+            values["dst"] = pkt.ip.dst
+        layer = pkt.tcp if pkt.tcp is not None else pkt.udp
+        if layer is not None:
+            values["sport"] = layer.src_port
+            values["dport"] = layer.dst_port
+
+        citem = None
+        cnfs = None
+        if rpc.type:
+            # Reply
+            values["status"] = int(getattr(nfs, "status", 0))
+            if pkt_call is not None:
+                values["latency"] = pkt.record.secs - pkt_call.record.secs
+                cnfs = pkt_call.nfs
+                opname, citem = nfs_opinfo(pkt_call)[1:]
+                # The COMPOUND reply could be truncated on an error,
+                # use the operation from the call
+                values["op"] = opname
+                if hasattr(nfs, "array"):
+                    item = None
+                    for op in nfs.array:
+                        if op.op == getattr(citem, "op", None):
+                            item = op
+                            break
+
+        # Values taken from the call if not given in the reply
+        for name in ("offset", "count", "fh", "name"):
+            if name == "fh":
+                value = _get_fh(nfs, item) if item is not None else None
+                if value is None and citem is not None:
+                    value = _get_fh(cnfs, citem)
+                if value is not None:
+                    value = formatstr.crc32(value)
+            else:
+                value = _get_value(item, name)
+                if value is None:
+                    value = _get_value(citem, name)
+            if value is not None:
+                values[name] = value
+
+        row = []
+        for name in self.fields:
+            value = values.get(name)
+            if value is not None and COLUMN_TYPES[name] == "i":
+                # Display integers as plain numbers, e.g., xid
+                value = int(value)
+            row.append(value)
+        self._rows.append(row)
+        if len(self._rows) >= CHUNK_SIZE:
+            self._flush()
+        return True
+
+    def _flush(self):
+        """Write all rows added so far"""
+        rows = self._rows
+        if not rows:
+            return
+        if self._npz:
+            for idx in range(len(self.fields)):
+                ctype = COLUMN_TYPES[self.fields[idx]]
+                column = self._columns[idx]
+                data = [x[idx] for x in rows]
+                if ctype == "s":
+                    # Strings are saved with their length until the width
+                    # is known since names could have any character
+                    data = [str(x) if x is not None else "" for x in data]
+                    column[2] = max([column[2]] + [len(x) for x in data])
+                    column[0].write("".join(struct.pack("<I", len(x)) + x for x in data))
+                else:
+                    missing = _MISSING[ctype]
+                    data = [x if x is not None else missing for x in data]
+                    fmt = "<%d%s" % (len(data), "q" if ctype == "i" else "d")
+                    column[0].write(struct.pack(fmt, *data))
+        else:
+            for row in rows:
+                # Use repr for floats to keep all digits of the timestamp
+                self._writer.writerow(["" if x is None else repr(x) if isinstance(x, float) else x for x in row])
+        self.count += len(rows)
+        self._rows = []
+
+    def close(self):
+        """Write all rows left and close the file, returns the number of
+           rows written
+        """
+        self._flush()
+        if not self._npz:
+            self._fd.close()
+            return self.count
+
+        zfile = zipfile.ZipFile(self.outfile, "w", zipfile.ZIP_STORED, allowZip64=True)
+        try:
+            for idx in range(len(self.fields)):
+                name = self.fields[idx]
+                ctype = COLUMN_TYPES[name]
+                fobj, tmpfile, width = self._columns[idx]
+                if ctype == "s":
+                    # Rewrite the strings as a fixed width column
+                    fobj.close()
+                    fd, npyfile = tempfile.mkstemp(prefix=".%s." % name, dir=os.path.dirname(tmpfile))
+                    with os.fdopen(fd, "wb") as nfobj:
+                        nfobj.write(_npy_header("|S%d" % width, self.count))
+                        with open(tmpfile, "rb") as sfobj:
+                            for i in xrange(self.count):
+                                size = struct.unpack("<I", sfobj.read(4))[0]
+                                nfobj.write(sfobj.read(size).ljust(width, "\0"))
+                    os.unlink(tmpfile)
+                    self._columns[idx][1] = npyfile
+                    tmpfile = npyfile
+                else:
+                    # Rewrite the header having the actual number of rows
+                    fobj.seek(0)
+                    fobj.write(_npy_header("<i8" if ctype == "i" else "<f8", self.count))
+                    fobj.close()
+                zfile.write(tmpfile, name + ".npy")
+                os.unlink(tmpfile)
+        finally:
+            zfile.close()
+            self.__del__()
+        return self.count
@@ -0,0 +1,352 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Attribute cache effectiveness module
+
+Measure the revalidation traffic not absorbed by the client attribute and
+dentry caches in a single pass over the packet trace. A revalidation is an
+NFSv3 GETATTR, ACCESS or LOOKUP or an NFSv4 COMPOUND having GETATTR, ACCESS
+or LOOKUP as its main operation.
+
+A GETATTR or ACCESS revalidation is wasted when the attributes returned by
+the server show the file has not changed since the attributes were last
+seen by the client: the change attribute for NFSv4 or the ctime for NFSv3.
+The attributes returned by any other operation, e.g., the post operation
+attributes of a WRITE or the GETATTR in the same COMPOUND as a WRITE, are
+taken as known by the client as well. A revalidation where the attributes
+are not returned is not counted either way.
+
+A LOOKUP revalidation is counted for the directory and it is wasted when
+the server returns the same result (file handle or error) as the previous
+LOOKUP of the same name in the same directory.
+
+Files and directories are identified by the CRC32 of the file handle.
+"""
+import nfstest_config as c
+from baseobj import BaseObj
+from formatstr import crc32
+from packet.stats import Histogram
+import packet.nfs.nfs3_const as const3
+import packet.nfs.nfs4_const as const4
+from packet.nfs.nfsbase import is_callback, has_call, compound_ops
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Revalidation types
+GETATTR = 0
+ACCESS  = 1
+LOOKUP  = 2
+
+# Per file counters:
+# [getattr, access, lookup, wasted, unknown, wasted_time, change,
+#  first, last, names]
+_WASTED     = 3
+_UNKNOWN    = 4
+_WASTEDTIME = 5
+_CHANGE     = 6
+_FIRST      = 7
+_LAST       = 8
+_NAMES      = 9
+
+def v3_change(attrs):
+    """Return the ctime as a tuple from the NFSv3 attributes or None if
+       the attributes are not given
+    """
+    ctime = getattr(attrs, "ctime", None)
+    if ctime is None:
+        return None
+    return (ctime.seconds, ctime.nseconds)
+
+def v4_change(attrs):
+    """Return the change attribute from the NFSv4 attributes, the time
+       metadata is used if the change attribute is not given, None is
+       returned if neither of them is given
+    """
+    if attrs is None:
+        return None
+    change = attrs.get(const4.FATTR4_CHANGE)
+    if change is None:
+        ctime = attrs.get(const4.FATTR4_TIME_METADATA)
+        if ctime is not None:
+            change = (ctime.seconds, ctime.nseconds)
+    return change
+
+class AttrCache(BaseObj):
+    """Attribute cache effectiveness object
+
+       Usage:
+           from packet.pktt import Pktt
+           from packet.nfs.attrcache import AttrCache
+
+           x = Pktt("/traces/tracefile.cap")
+           acache = AttrCache()
+           for pkt in x:
+               acache.add(pkt, x.pkt_call)
+
+           # Summary for all files and directories
+           info = acache.summary()
+
+           # Files and directories having the most wasted revalidations
+           for key in acache.top(10):
+               info = acache.summary(key)
+
+       Object definition:
+
+       AttrCache(
+           nfiles = int, # Number of files and directories revalidated
+       )
+    """
+    # Class attributes
+    _attrlist = ("nfiles",)
+
+    def __init__(self, precision=0.01):
+        """Constructor
+
+           precision:
+               Relative error of the interval percentiles [default: 0.01]
+        """
+        self.nfiles = 0
+        # Per file counters: crc32(fh) => list of counters
+        self._files = {}
+        # Last attributes seen for files not yet revalidated
+        self._seen = {}
+        # Interval between revalidations with unchanged attributes
+        self._wasted = Histogram(precision)
+
+    def _get_file(self, key, secs):
+        """Return the counters for the given file"""
+        finfo = self._files.get(key)
+        if finfo is None:
+            finfo = [0, 0, 0, 0, 0, 0.0, self._seen.pop(key, None), secs, secs, None]
+            self._files[key] = finfo
+            self.nfiles += 1
+        return finfo
+
+    def observe(self, fh, change):
+        """The client has seen the attributes of the file
+
+           fh:
+               File handle
+           change:
+               Change attribute or ctime
+        """
+        if change is None:
+            return
+        key = crc32(fh)
+        finfo = self._files.get(key)
+        if finfo is None:
+            self._seen[key] = change
+        else:
+            finfo[_CHANGE] = change
+
+    def revalidate(self, secs, fh, rtype, change=None, name=None, result=None):
+        """Add a revalidation
+
+           secs:
+               Time of the revalidation
+           fh:
+               File handle, directory file handle for LOOKUP
+           rtype:
+               Revalidation type: GETATTR, ACCESS or LOOKUP
+           change:
+               Change attribute or ctime returned, None if the attributes
+               were not returned [default: None]
+           name:
+               Name looked up for LOOKUP [default: None]
+           result:
+               Result of LOOKUP: file handle or error [default: None]
+        """
+        key = crc32(fh)
+        finfo = self._get_file(key, secs)
+        finfo[rtype] += 1
+        if rtype == LOOKUP:
+            names = finfo[_NAMES]
+            if names is None:
+                names = {}
+                finfo[_NAMES] = names
+            nkey = crc32(str(name))
+            rkey = crc32(str(result))
+            wasted = names.get(nkey) == rkey
+            names[nkey] = rkey
+        elif change is None:
+            finfo[_UNKNOWN] += 1
+            wasted = False
+        else:
+            wasted = finfo[_CHANGE] == change
+            finfo[_CHANGE] = change
+        if wasted:
+            delta = max(secs - finfo[_LAST], 0.0)
+            finfo[_WASTED] += 1
+            finfo[_WASTEDTIME] += delta
+            self._wasted.add(delta)
+        finfo[_LAST] = secs
+
+    def add(self, pkt, pkt_call=None):
+        """Add the revalidations and attributes given by the reply
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Packet call object if pkt is a reply [default: None]
+        """
+        if pkt != "nfs" or pkt.rpc.type != 1:
+            return
+        if not has_call(pkt, pkt_call):
+            # Call is not in the packet trace
+            return
+        rpc = pkt_call.rpc
+        if is_callback(rpc):
+            # Ignore callbacks
+            return
+        if hasattr(pkt.nfs, "array") and hasattr(pkt_call.nfs, "array"):
+            self._add_v4(pkt, pkt_call)
+        elif rpc.version == 3:
+            self._add_v3(pkt, pkt_call)
+
+    def _add_v3(self, pkt, pkt_call):
+        """Add the NFSv3 reply"""
+        secs = pkt.record.secs
+        nfs = pkt.nfs
+        args = pkt_call.nfs
+        status = nfs.status
+        procedure = pkt_call.rpc.procedure
+        if procedure == const3.NFSPROC3_GETATTR:
+            change = v3_change(nfs.attributes) if status == 0 else None
+            self.revalidate(secs, args.fh, GETATTR, change)
+        elif procedure == const3.NFSPROC3_ACCESS:
+            self.revalidate(secs, args.fh, ACCESS, v3_change(getattr(nfs, "attributes", None)))
+        elif procedure == const3.NFSPROC3_LOOKUP:
+            result = nfs.fh if status == 0 else status
+            self.revalidate(secs, args.what.fh, LOOKUP, name=args.what.name, result=result)
+            if status == 0:
+                self.observe(nfs.fh, v3_change(nfs.attributes))
+            self.observe(args.what.fh, v3_change(getattr(nfs, "dir_attributes", None)))
+        elif procedure == const3.NFSPROC3_READ:
+            self.observe(args.fh, v3_change(getattr(nfs, "attributes", None)))
+        elif procedure == const3.NFSPROC3_WRITE:
+            wcc = getattr(nfs, "wcc", None)
+            self.observe(args.fh, v3_change(getattr(wcc, "after", None)))
+
+    def _add_v4(self, pkt, pkt_call):
+        """Add the NFSv4 reply"""
+        secs = pkt.record.secs
+        mainop = pkt_call.nfs.main_op()
+        revalidated = False
+        for idx, (op, citem, item, curfh, savedfh) in enumerate(compound_ops(pkt, pkt_call)):
+            status = getattr(item, "status", 0)
+            if op == const4.OP_LOOKUP:
+                if mainop == const4.OP_LOOKUP and not revalidated and curfh is not None:
+                    # Result is the file handle given by GETFH, if any
+                    result = status
+                    if status == 0:
+                        for ritem in pkt.nfs.array[idx+1:]:
+                            if ritem.op == const4.OP_GETFH and getattr(ritem, "status", 0) == 0:
+                                result = ritem.fh
+                                break
+                    self.revalidate(secs, curfh, LOOKUP, name=citem.name, result=result)
+                    revalidated = True
+            elif status != 0:
+                break
+            elif op in (const4.OP_ACCESS, const4.OP_GETATTR) and curfh is not None:
+                change = None
+                if op == const4.OP_GETATTR:
+                    change = v4_change(item.attributes)
+                elif idx + 1 < len(pkt.nfs.array) and pkt.nfs.array[idx+1].op == const4.OP_GETATTR and \
+                     getattr(pkt.nfs.array[idx+1], "status", 0) == 0:
+                    # ACCESS followed by GETATTR
+                    change = v4_change(pkt.nfs.array[idx+1].attributes)
+                if mainop == op and not revalidated:
+                    rtype = GETATTR if op == const4.OP_GETATTR else ACCESS
+                    self.revalidate(secs, curfh, rtype, change)
+                    revalidated = True
+                elif op == const4.OP_GETATTR:
+                    self.observe(curfh, change)
+
+    def keys(self):
+        """Return the list of file keys: CRC32 of the file handle"""
+        return self._files.keys()
+
+    def top(self, count, sortby="wasted"):
+        """Return the list of file keys having the largest value
+
+           count:
+               Number of file keys to return
+           sortby:
+               Value to sort the files by: wasted or revalidations
+               [default: "wasted"]
+        """
+        if sortby == "revalidations":
+            func = lambda x: x[GETATTR] + x[ACCESS] + x[LOOKUP]
+        else:
+            func = lambda x: (x[_WASTED], x[GETATTR] + x[ACCESS] + x[LOOKUP])
+        items = sorted(self._files.iteritems(), key=lambda x: func(x[1]), reverse=True)
+        return [x[0] for x in items[:count]]
+
+    def summary(self, key=None):
+        """Return a dictionary with the revalidations of the given file or
+           for all files if no key is given:
+               getattr, access, lookup:
+                   Number of revalidations of each type
+               revalidations:
+                   Total number of revalidations
+               wasted:
+                   Number of revalidations returning unchanged attributes
+                   or the same LOOKUP result
+               unknown:
+                   Number of revalidations without attributes
+               wasted_fraction:
+                   Fraction of the revalidations wasted, the revalidations
+                   without attributes are not included
+               wasted_interval:
+                   Average interval between a revalidation and the previous
+                   one for the wasted revalidations
+               rate:
+                   Revalidations per second from the first to the last
+                   revalidation (file only)
+               directory:
+                   True if the file is a directory revalidated by LOOKUP
+                   (file only)
+               hist:
+                   Histogram of the wasted revalidation intervals (all files only)
+        """
+        if key is not None:
+            flist = [self._files[key]]
+        else:
+            flist = self._files.itervalues()
+        info = {"getattr": 0, "access": 0, "lookup": 0, "wasted": 0, "unknown": 0}
+        wasted_time = 0.0
+        for finfo in flist:
+            info["getattr"] += finfo[GETATTR]
+            info["access"]  += finfo[ACCESS]
+            info["lookup"]  += finfo[LOOKUP]
+            info["wasted"]  += finfo[_WASTED]
+            info["unknown"] += finfo[_UNKNOWN]
+            wasted_time += finfo[_WASTEDTIME]
+        total = info["getattr"] + info["access"] + info["lookup"]
+        info["revalidations"] = total
+        known = total - info["unknown"]
+        info["wasted_fraction"] = float(info["wasted"]) / known if known > 0 else None
+        info["wasted_interval"] = wasted_time / info["wasted"] if info["wasted"] else None
+        if key is not None:
+            finfo = self._files[key]
+            duration = finfo[_LAST] - finfo[_FIRST]
+            info["rate"] = (total - 1) / duration if duration > 0 else None
+            info["directory"] = finfo[_NAMES] is not None
+        else:
+            info["hist"] = self._wasted
+        return info
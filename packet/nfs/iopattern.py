@@ -0,0 +1,321 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+NFS I/O access pattern module
+
+Classify the READ and WRITE operations (NFSv3 and NFSv4) sent for each file
+in a single pass over the packet trace:
+    sequential
+        The I/O starts where the previous I/O of the same type ended
+    strided
+        The distance from the previous I/O of the same type is the same
+        as the distance between the previous two
+    random
+        Any other I/O, including the first I/O if it does not start at
+        offset zero
+
+It also counts the I/O sizes in power of two buckets, the I/O not aligned
+to the given alignment and the reads following a write to the same file
+(read after write) with the time from the write to the read.
+
+Files are identified by the CRC32 of the file handle. The state kept for
+each file is a record with fixed slots for the counters and the last I/O
+of each type, and an array of counts covering only the range of size
+buckets seen for the file (at most 66 entries for 32-bit I/O sizes).
+This is about 700 bytes for each file having a couple of I/O sizes, so
+a packet trace having a million files needs under 1GB for the per file
+state.
+"""
+from array import array
+import nfstest_config as c
+from baseobj import BaseObj
+from formatstr import crc32
+from packet.stats import Histogram
+import packet.nfs.nfs3_const as const3
+import packet.nfs.nfs4_const as const4
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# I/O types
+READ  = 0
+WRITE = 1
+
+class _FileIO(object):
+    """Per file I/O counters, the last I/O of each type is given by the
+       entries (offset, end, delta, run) in the list last starting at
+       4*iotype and the size bucket counts are kept in the array sizes
+       where the bucket index 2*log2(bucket) + iotype is at the position
+       given by the bucket index minus sizebase
+    """
+    __slots__ = ("nreads", "nwrites", "rbytes", "wbytes", "sequential",
+                 "strided", "random", "unaligned", "nraw", "rawtime",
+                 "lastwrite", "stride", "strides", "sizes", "sizebase",
+                 "last")
+
+    def __init__(self):
+        self.nreads     = 0
+        self.nwrites    = 0
+        self.rbytes     = 0
+        self.wbytes     = 0
+        self.sequential = 0
+        self.strided    = 0
+        self.random     = 0
+        self.unaligned  = 0
+        self.nraw       = 0
+        self.rawtime    = 0.0
+        self.lastwrite  = None
+        self.stride     = None
+        self.strides    = 0
+        self.sizes      = array("L")
+        self.sizebase   = 0
+        self.last       = [None, None, None, 0, None, None, None, 0]
+
+class IOPattern(BaseObj):
+    """NFS I/O access pattern object
+
+       Usage:
+           from packet.pktt import Pktt
+           from packet.nfs.iopattern import IOPattern
+
+           x = Pktt("/traces/tracefile.cap")
+           iop = IOPattern(align=4096)
+           for pkt in x:
+               iop.add(pkt)
+
+           # Summary for all files
+           info = iop.summary()
+
+           # Files having the most bytes transferred
+           for key in iop.top(10):
+               info = iop.summary(key)
+
+       Object definition:
+
+       IOPattern(
+           align  = int, # Alignment in bytes
+           nfiles = int, # Number of files
+       )
+    """
+    # Class attributes
+    _attrlist = ("align", "nfiles")
+
+    def __init__(self, align=4096, precision=0.01):
+        """Constructor
+
+           align:
+               I/O having an offset or a size which is not a multiple of
+               this value is unaligned [default: 4096]
+           precision:
+               Relative error of the read after write interval percentiles
+               [default: 0.01]
+        """
+        self.align  = align
+        self.nfiles = 0
+        # Per file counters: crc32(fh) => _FileIO
+        self._files = {}
+        # Read after write intervals for all files
+        self._raw = Histogram(precision)
+
+    def add(self, pkt, pkt_call=None):
+        """Add all the READ and WRITE operations in the given packet,
+           only the calls are used so replies are ignored
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Not used, given for consistency with other analyzers
+               [default: None]
+        """
+        if pkt != "nfs" or pkt.rpc.type != 0:
+            return
+        nfs = pkt.nfs
+        secs = pkt.record.secs
+        if hasattr(nfs, "array"):
+            # NFSv4 COMPOUND
+            for item in nfs.array:
+                if item.op == const4.OP_READ:
+                    self.io(secs, item.fh, READ, item.offset, item.count)
+                elif item.op == const4.OP_WRITE:
+                    self.io(secs, item.fh, WRITE, item.offset, item.count)
+        elif pkt.rpc.version == 3:
+            procedure = pkt.rpc.procedure
+            if procedure == const3.NFSPROC3_READ:
+                self.io(secs, nfs.fh, READ, nfs.offset, nfs.count)
+            elif procedure == const3.NFSPROC3_WRITE:
+                self.io(secs, nfs.fh, WRITE, nfs.offset, nfs.count)
+
+    def io(self, secs, fh, iotype, offset, size):
+        """Add a single I/O
+
+           secs:
+               Time of the I/O
+           fh:
+               File handle
+           iotype:
+               I/O type: READ or WRITE
+           offset:
+               I/O offset
+           size:
+               I/O size
+        """
+        key = crc32(fh)
+        finfo = self._files.get(key)
+        if finfo is None:
+            finfo = _FileIO()
+            self._files[key] = finfo
+            self.nfiles += 1
+
+        if iotype == READ:
+            finfo.nreads += 1
+            finfo.rbytes += size
+            if finfo.lastwrite is not None:
+                # First read after a write
+                delta = max(secs - finfo.lastwrite, 0.0)
+                finfo.nraw += 1
+                finfo.rawtime += delta
+                finfo.lastwrite = None
+                self._raw.add(delta)
+        else:
+            finfo.nwrites += 1
+            finfo.wbytes += size
+            finfo.lastwrite = secs
+
+        if self.align and (offset % self.align or size % self.align):
+            finfo.unaligned += 1
+
+        # Size bucket index: 2*log2(bucket) + iotype where the bucket is
+        # the smallest power of two greater than or equal to the size
+        index = 2 * (size - 1).bit_length() + iotype if size > 1 else iotype
+        sizes = finfo.sizes
+        if not sizes:
+            finfo.sizebase = index
+        elif index < finfo.sizebase:
+            finfo.sizes = sizes = array("L", [0] * (finfo.sizebase - index)) + sizes
+            finfo.sizebase = index
+        index -= finfo.sizebase
+        if index >= len(sizes):
+            sizes.extend([0] * (index + 1 - len(sizes)))
+        sizes[index] += 1
+
+        # Classify the I/O using the previous I/O of the same type
+        last = finfo.last
+        pos = 4 * iotype
+        prev_offset, end, prev_delta, run = last[pos:pos+4]
+        if prev_offset is None:
+            delta = None
+            if offset == 0:
+                finfo.sequential += 1
+            else:
+                finfo.random += 1
+        else:
+            delta = offset - prev_offset
+            if offset == end:
+                finfo.sequential += 1
+                run = 0
+            elif delta == prev_delta and delta != 0:
+                finfo.strided += 1
+                run += 1
+                if run > finfo.strides:
+                    # Dominant stride is the one with the longest run
+                    finfo.stride = delta
+                    finfo.strides = run
+            else:
+                finfo.random += 1
+                run = 0
+        last[pos:pos+4] = [offset, offset + size, delta, run]
+
+    def keys(self):
+        """Return the list of file keys: CRC32 of the file handle"""
+        return self._files.keys()
+
+    def top(self, count, sortby="bytes"):
+        """Return the list of file keys having the largest value
+
+           count:
+               Number of file keys to return
+           sortby:
+               Value to sort the files by: bytes, ops, random or unaligned
+               [default: "bytes"]
+        """
+        if sortby == "ops":
+            func = lambda x: x.nreads + x.nwrites
+        elif sortby == "random":
+            func = lambda x: x.random
+        elif sortby == "unaligned":
+            func = lambda x: x.unaligned
+        else:
+            func = lambda x: x.rbytes + x.wbytes
+        items = sorted(self._files.iteritems(), key=lambda x: func(x[1]), reverse=True)
+        return [x[0] for x in items[:count]]
+
+    def summary(self, key=None):
+        """Return a dictionary with the access pattern of the given file or
+           for all files if no key is given:
+               reads, writes, rbytes, wbytes:
+                   Number of READ and WRITE operations and bytes
+               sequential, strided, random:
+                   Number of I/O operations in each class
+               unaligned:
+                   Number of unaligned I/O operations
+               stride, strides:
+                   Dominant stride in bytes and the longest run of strided
+                   I/O operations having this stride (file only)
+               raw, rawtime:
+                   Number of reads after a write and the average time from
+                   the write to the read
+               rawhist:
+                   Histogram of the read after write intervals (all files only)
+               sizes:
+                   Number of I/O operations for each size bucket:
+                   {(READ or WRITE, bucket): count}
+        """
+        if key is not None:
+            flist = [self._files[key]]
+        else:
+            flist = self._files.itervalues()
+        info = {
+            "reads": 0, "writes": 0, "rbytes": 0, "wbytes": 0,
+            "sequential": 0, "strided": 0, "random": 0, "unaligned": 0,
+            "raw": 0, "rawtime": None, "sizes": {},
+        }
+        rawtime = 0.0
+        sizes = info["sizes"]
+        for finfo in flist:
+            info["reads"]      += finfo.nreads
+            info["writes"]     += finfo.nwrites
+            info["rbytes"]     += finfo.rbytes
+            info["wbytes"]     += finfo.wbytes
+            info["sequential"] += finfo.sequential
+            info["strided"]    += finfo.strided
+            info["random"]     += finfo.random
+            info["unaligned"]  += finfo.unaligned
+            info["raw"]        += finfo.nraw
+            rawtime += finfo.rawtime
+            for index, count in enumerate(finfo.sizes, finfo.sizebase):
+                if count:
+                    bucket = (index & 1, 1 << (index >> 1))
+                    sizes[bucket] = sizes.get(bucket, 0) + int(count)
+        if info["raw"]:
+            info["rawtime"] = rawtime / info["raw"]
+        if key is not None:
+            finfo = self._files[key]
+            info["stride"]  = finfo.stride
+            info["strides"] = finfo.strides
+        else:
+            info["rawhist"] = self._raw
+        return info
@@ -0,0 +1,763 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+pNFS layout map module
+
+Map the I/O sent to the data servers back to the file using the NFSv4.1
+file layouts given by LAYOUTGET and the device information given by
+GETDEVICEINFO. The layout segments of each file are kept sorted by their
+offset so the segment for a given offset is found using a binary search.
+The segments using each data server file handle are kept sorted by the
+data server offsets they use, and the data server addresses are indexed,
+so each I/O packet is mapped to its stripe, data server and file offset
+without searching the layouts.
+
+Only the layouts held by the client are kept: LAYOUTRETURN and
+CB_LAYOUTRECALL remove the byte range given back or recalled, and a new
+LAYOUTGET replaces the byte range of the segments already held for the
+same file and iomode, so the packet trace must be processed in order.
+
+The stripe arithmetic follows RFC 5661 section 13.4:
+    relative_offset = file_offset - pattern_offset
+    SUn = floor(relative_offset / stripe_unit)
+    j   = (SUn + first_stripe_index) % stripe_count
+    ds  = stripe_indices[j]
+    fh  = fh_list[j] (or fh_list[0] if there is a single file handle)
+    dense:  ds_offset = floor(SUn / stripe_count) * stripe_unit + relative_offset % stripe_unit
+    sparse: ds_offset = file_offset
+
+The I/O packets could be queued so their offsets are converted in
+batches, using NumPy arrays if NumPy is available.
+"""
+import copy
+import bisect
+import nfstest_config as c
+from baseobj import BaseObj
+import packet.nfs.nfs4_const as const
+from packet.nfs.nfsbase import is_callback, has_call, compound_ops
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+def addr_port(uaddr):
+    """Return the tuple (ipaddr, port) given by the universal address"""
+    addr_list = uaddr.split('.')
+    if len(addr_list) == 6:
+        # IPv4 address
+        ipaddr = '.'.join(addr_list[:4])
+    else:
+        # IPv6 address
+        ipaddr = addr_list[0]
+    port = (int(addr_list[-2])<<8) + int(addr_list[-1])
+    return ipaddr, port
+
+def _range_end(offset, length):
+    """Return the end of the byte range, exclusive"""
+    if length == const.NFS4_UINT64_MAX:
+        return 1 << 64
+    return offset + length
+
+def _list_remove(keys, items, key, item):
+    """Remove the item from the list of items sorted by the list of keys"""
+    pos = bisect.bisect_left(keys, key)
+    while items[pos] is not item:
+        pos += 1
+    del keys[pos]
+    del items[pos]
+
+class LayoutSegment(BaseObj):
+    """NFSv4.1 file layout segment object
+
+       Usage:
+           from packet.nfs.layoutmap import LayoutMap
+
+           x = LayoutMap()
+           ...
+           seg = x.segment(filehandle, offset)
+
+           # Stripe position for the given file offset
+           j = seg.position(offset)
+
+           # Data server offset for the given file offset
+           ds_offset = seg.ds_offset(offset)
+
+       Object definition:
+
+       LayoutSegment(
+           fh                 = str,   # File handle given to the MDS
+           iomode             = int,   # Layout iomode
+           offset             = int,   # Segment offset
+           length             = int,   # Segment length
+           stateid            = str,   # Layout state id "other" field
+           deviceid           = str,   # Device id
+           stripe_size        = int,   # Stripe unit size
+           dense              = bool,  # Dense layout
+           commit_mds         = bool,  # Commit through the MDS
+           first_stripe_index = int,   # First stripe index
+           pattern_offset     = int,   # Pattern offset
+           filehandles        = list,  # Data server file handles
+           index              = int,   # Packet index of the LAYOUTGET reply
+       )
+    """
+    # Class attributes
+    _attrlist = ("fh", "iomode", "offset", "length", "stateid", "deviceid",
+                 "stripe_size", "dense", "commit_mds", "first_stripe_index",
+                 "pattern_offset", "filehandles", "index")
+
+    def __init__(self, fh, layout, stateid, index=None):
+        """Constructor
+
+           fh:
+               File handle given to the MDS
+           layout:
+               Layout segment object (layout4) of type LAYOUT4_NFSV4_1_FILES
+           stateid:
+               Layout state id "other" field
+           index:
+               Packet index of the LAYOUTGET reply [default: None]
+        """
+        body = layout.content.body
+        nfl_util = body.nfl_util
+        self.fh                 = fh
+        self.iomode             = layout.iomode
+        self.offset             = layout.offset
+        self.length             = layout.length
+        self.stateid            = stateid
+        self.deviceid           = body.deviceid
+        self.stripe_size        = nfl_util & const.NFL4_UFLG_STRIPE_UNIT_SIZE_MASK
+        self.dense              = (nfl_util & const.NFL4_UFLG_DENSE > 0)
+        self.commit_mds         = (nfl_util & const.NFL4_UFLG_COMMIT_THRU_MDS > 0)
+        self.first_stripe_index = body.first_stripe_index
+        self.pattern_offset     = body.pattern_offset
+        self.filehandles        = list(body.fh_list)
+        self.index              = index
+        # Stripe count, given by the device
+        self._count = None
+        # Data server offsets used by the segment when it was indexed
+        self._dsrange = None
+
+    def end(self):
+        """Return the end of the segment, exclusive"""
+        return _range_end(self.offset, self.length)
+
+    def trim(self, start, end):
+        """Return a copy of the segment covering only the byte range
+           from start to end, exclusive
+        """
+        seg = copy.copy(self)
+        seg.offset = start
+        seg.length = const.NFS4_UINT64_MAX if end == 1 << 64 else end - start
+        return seg
+
+    def ds_range(self):
+        """Return the tuple (start, end) of the data server offsets used
+           by the segment, end is exclusive
+        """
+        end = self.end()
+        if not self.dense:
+            return (self.offset, end)
+        if self.stripe_size == 0:
+            return (0, 1 << 64)
+        size = self.stripe_size * self.stripe_count()
+        start = max(self.offset - self.pattern_offset, 0) // size * self.stripe_size
+        end = ((end - self.pattern_offset - 1) // size + 1) * self.stripe_size
+        return (start, max(start, end))
+
+    def contains(self, offset):
+        """Return True if the file offset is within the segment"""
+        return self.offset <= offset < self.end()
+
+    def stripe_count(self):
+        """Return the number of stripes, given by the number of stripe
+           indices of the device if known or by the number of data server
+           file handles otherwise
+        """
+        if self._count:
+            return self._count
+        return max(len(self.filehandles), 1)
+
+    def filehandle(self, position):
+        """Return the data server file handle for the given stripe position"""
+        if len(self.filehandles) > 1:
+            return self.filehandles[position]
+        return self.filehandles[0]
+
+    def position(self, offset):
+        """Return the stripe position for the given file offset"""
+        sun = (offset - self.pattern_offset) // self.stripe_size
+        return (sun + self.first_stripe_index) % self.stripe_count()
+
+    def ds_offset(self, offset):
+        """Return the data server offset for the given file offset"""
+        if not self.dense:
+            return offset
+        rel = offset - self.pattern_offset
+        sun = rel // self.stripe_size
+        return (sun // self.stripe_count()) * self.stripe_size + rel % self.stripe_size
+
+    def file_offset(self, offset, position):
+        """Return the file offset for the given data server offset sent to
+           the data server at the given stripe position
+        """
+        if not self.dense:
+            return offset
+        count = self.stripe_count()
+        # Stripe unit number relative to the first stripe index
+        sun = (offset // self.stripe_size) * count + (position - self.first_stripe_index) % count
+        return sun * self.stripe_size + offset % self.stripe_size + self.pattern_offset
+
+    def verify(self, offset, size, position):
+        """Return True if the I/O given by the file offset and size is
+           within a single stripe unit belonging to the stripe position
+        """
+        if self.stripe_size == 0 or size <= 0:
+            return False
+        first = (offset - self.pattern_offset) // self.stripe_size
+        last  = (offset + size - 1 - self.pattern_offset) // self.stripe_size
+        return first == last and self.position(offset) == position
+
+    def positions(self, offsets):
+        """Return the stripe positions for the list of file offsets,
+           a NumPy array is returned if NumPy is available
+        """
+        if numpy is not None:
+            offsets = numpy.asarray(offsets, dtype=numpy.int64)
+            return ((offsets - self.pattern_offset) // self.stripe_size + self.first_stripe_index) % self.stripe_count()
+        return [self.position(x) for x in offsets]
+
+    def file_offsets(self, offsets, position):
+        """Return the file offsets for the list of data server offsets sent
+           to the data server at the given stripe position, a NumPy array
+           is returned if NumPy is available
+        """
+        if numpy is not None:
+            offsets = numpy.asarray(offsets, dtype=numpy.int64)
+            if not self.dense:
+                return offsets
+            count = self.stripe_count()
+            sun = (offsets // self.stripe_size) * count + (position - self.first_stripe_index) % count
+            return sun * self.stripe_size + offsets % self.stripe_size + self.pattern_offset
+        return [self.file_offset(x, position) for x in offsets]
+
+    def verify_all(self, offsets, sizes, position):
+        """Return the list of verify() results for the list of file offsets
+           and sizes, a NumPy array is returned if NumPy is available
+        """
+        if numpy is not None:
+            offsets = numpy.asarray(offsets, dtype=numpy.int64)
+            sizes = numpy.asarray(sizes, dtype=numpy.int64)
+            if self.stripe_size == 0:
+                return numpy.zeros(len(offsets), dtype=bool)
+            rel = offsets - self.pattern_offset
+            first = rel // self.stripe_size
+            last  = (rel + sizes - 1) // self.stripe_size
+            pos = (first + self.first_stripe_index) % self.stripe_count()
+            return (sizes > 0) & (first == last) & (pos == position)
+        return [self.verify(x, y, position) for x, y in zip(offsets, sizes)]
+
+class LayoutMap(BaseObj):
+    """pNFS file layout map object
+
+       Usage:
+           from packet.pktt import Pktt
+           from packet.nfs.layoutmap import LayoutMap
+
+           x = Pktt("/traces/tracefile.cap")
+           lmap = LayoutMap()
+           for pkt in x:
+               lmap.add(pkt, x.pkt_call)
+               if pkt.rpc.type == 0:
+                   # Map I/O sent to the data servers
+                   for item in lmap.classify(pkt):
+                       (seg, position, ds_index, offset, size, valid) = item
+
+           # Map I/O sent to the data servers in batches
+           for pkt in x:
+               lmap.add(pkt, x.pkt_call)
+               if pkt.rpc.type == 0:
+                   lmap.queue(pkt)
+           for item in lmap.flush():
+               (index, xid, seg, position, ds_index, offset, size, valid) = item
+
+       Object definition:
+
+       LayoutMap(
+           nsegments = int, # Number of layout segments held
+           ndevices  = int, # Number of devices
+       )
+    """
+    # Class attributes
+    _attrlist = ("nsegments", "ndevices")
+
+    def __init__(self, batch=4096):
+        """Constructor
+
+           batch:
+               Number of I/O operations queued before they are mapped
+               to the file [default: 4096]
+        """
+        self.nsegments = 0
+        self.ndevices  = 0
+        self.batch     = batch
+        # Layout segments for each MDS file handle sorted by offset:
+        #   fh => ([offset, ...], [segment, ...])
+        self._segments = {}
+        # Layout segments using each data server file handle sorted by
+        # the first data server offset used by the segment:
+        #   dsfh => [[dsoffset, ...], [segment, ...], largest data server range]
+        self._dsfh = {}
+        # Device info: deviceid => (stripe_indices, [[(ipaddr, port), ...], ...])
+        self._devices = {}
+        # Data server index for each address: (ipaddr, port) => {deviceid: set(ds_index)}
+        self._dsaddr = {}
+        # I/O operations queued: [(fh, addr, offset, size), ...]
+        # and [(index, xid, size), ...]
+        self._iolist = []
+        self._ioinfo = []
+        # I/O operations mapped but not yet returned by flush()
+        self._resolved = []
+
+    def _insert(self, seg):
+        """Add the layout segment to the indexes"""
+        offsets, segments = self._segments.setdefault(seg.fh, ([], []))
+        # Insert after all segments having the same offset so the
+        # latest segment is found first
+        pos = bisect.bisect_right(offsets, seg.offset)
+        offsets.insert(pos, seg.offset)
+        segments.insert(pos, seg)
+        for dsfh in set(seg.filehandles):
+            self._dsfh_insert(dsfh, seg)
+        self.nsegments += 1
+
+    def _remove(self, seg):
+        """Remove the layout segment from the indexes"""
+        offsets, segments = self._segments[seg.fh]
+        _list_remove(offsets, segments, seg.offset, seg)
+        if len(segments) == 0:
+            del self._segments[seg.fh]
+        for dsfh in set(seg.filehandles):
+            self._dsfh_remove(dsfh, seg)
+        self.nsegments -= 1
+
+    def _dsfh_insert(self, dsfh, seg):
+        """Add the layout segment to the data server file handle index"""
+        seg._dsrange = seg.ds_range()
+        start, end = seg._dsrange
+        entry = self._dsfh.setdefault(dsfh, [[], [], 0])
+        pos = bisect.bisect_right(entry[0], start)
+        entry[0].insert(pos, start)
+        entry[1].insert(pos, seg)
+        entry[2] = max(entry[2], end - start)
+
+    def _dsfh_remove(self, dsfh, seg):
+        """Remove the layout segment from the data server file handle index"""
+        entry = self._dsfh[dsfh]
+        _list_remove(entry[0], entry[1], seg._dsrange[0], seg)
+        if len(entry[1]) == 0:
+            del self._dsfh[dsfh]
+        else:
+            entry[2] = max(x._dsrange[1] - x._dsrange[0] for x in entry[1])
+
+    def _return_range(self, fh, iomode, offset, length):
+        """Remove the byte range from the layout segments of the given file
+           handle having the given iomode, the segments partially covered by
+           the range are trimmed
+
+           fh:
+               File handle given to the MDS, None for all files
+           iomode:
+               Layout iomode, LAYOUTIOMODE4_ANY for all iomodes
+           offset:
+               Offset of the byte range
+           length:
+               Length of the byte range
+        """
+        self._flush_io()
+        end = _range_end(offset, length)
+        if fh is None:
+            seglist = [x for item in self._segments.values() for x in item[1]]
+        else:
+            seglist = list(self._segments.get(fh, ([], []))[1])
+        for seg in seglist:
+            if iomode != const.LAYOUTIOMODE4_ANY and seg.iomode != iomode:
+                continue
+            send = seg.end()
+            if send <= offset or seg.offset >= end:
+                continue
+            self._remove(seg)
+            if seg.offset < offset:
+                self._insert(seg.trim(seg.offset, offset))
+            if send > end:
+                self._insert(seg.trim(end, send))
+
+    def add_device(self, deviceid, device_addr):
+        """Add the device information given by GETDEVICEINFO
+
+           deviceid:
+               Device id
+           device_addr:
+               Device address object (device_addr4)
+        """
+        if device_addr.type != const.LAYOUT4_NFSV4_1_FILES:
+            return
+        self._flush_io()
+        body = device_addr.body
+        dslist = []
+        for ds_index, ds_list in enumerate(body.multipath_ds_list):
+            dslist.append([])
+            for item in ds_list:
+                addr = addr_port(item.addr)
+                dslist[-1].append(addr)
+                self._dsaddr.setdefault(addr, {}).setdefault(deviceid, set()).add(ds_index)
+        if deviceid not in self._devices:
+            self.ndevices += 1
+        stripe_indices = list(body.stripe_indices)
+        self._devices[deviceid] = (stripe_indices, dslist)
+        for segments in self._segments.values():
+            for seg in segments[1]:
+                if seg.deviceid == deviceid and seg._count != len(stripe_indices):
+                    # The data server offsets used by the segment
+                    # depend on the stripe count
+                    for dsfh in set(seg.filehandles):
+                        self._dsfh_remove(dsfh, seg)
+                    seg._count = len(stripe_indices)
+                    for dsfh in set(seg.filehandles):
+                        self._dsfh_insert(dsfh, seg)
+
+    def add_layout(self, fh, layout, stateid, index=None):
+        """Add the layout segment given by LAYOUTGET, only file layouts
+           are added. The segment replaces the byte range of the segments
+           already held for the same file and iomode.
+
+           fh:
+               File handle given to the MDS
+           layout:
+               Layout segment object (layout4)
+           stateid:
+               Layout state id "other" field
+           index:
+               Packet index of the LAYOUTGET reply [default: None]
+        """
+        if layout.content.type != const.LAYOUT4_NFSV4_1_FILES:
+            return None
+        seg = LayoutSegment(fh, layout, stateid, index)
+        device = self._devices.get(seg.deviceid)
+        if device is not None:
+            seg._count = len(device[0])
+        self._return_range(fh, seg.iomode, seg.offset, seg.length)
+        self._insert(seg)
+        return seg
+
+    def layout_return(self, fh, iomode, layoutreturn):
+        """Remove the layout segments given back by LAYOUTRETURN, all the
+           layouts are removed for LAYOUTRETURN4_FSID since the file system
+           of each layout is not known
+
+           fh:
+               Current file handle of LAYOUTRETURN
+           iomode:
+               Layout iomode
+           layoutreturn:
+               Layout return object (layoutreturn4)
+        """
+        if layoutreturn.returntype == const.LAYOUTRETURN4_FILE:
+            self._return_range(fh, iomode, layoutreturn.offset, layoutreturn.length)
+        else:
+            self._return_range(None, iomode, 0, const.NFS4_UINT64_MAX)
+
+    def layout_recall(self, iomode, recall):
+        """Remove the layout segments recalled by CB_LAYOUTRECALL, the
+           client does not send new I/O using a recalled layout and all
+           the layouts are removed for LAYOUTRECALL4_FSID since the file
+           system of each layout is not known
+
+           iomode:
+               Layout iomode
+           recall:
+               Layout recall object (layoutrecall4)
+        """
+        if recall.recalltype == const.LAYOUTRECALL4_FILE:
+            self._return_range(recall.fh, iomode, recall.offset, recall.length)
+        else:
+            self._return_range(None, iomode, 0, const.NFS4_UINT64_MAX)
+
+    def add(self, pkt, pkt_call=None):
+        """Add the layouts and devices given by the LAYOUTGET and
+           GETDEVICEINFO replies, and remove the layouts given back by
+           LAYOUTRETURN or recalled by CB_LAYOUTRECALL
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Packet call object if pkt is a reply [default: None]
+        """
+        if pkt != "nfs" or not hasattr(pkt.nfs, "array"):
+            return
+        rpc = pkt.rpc
+        if is_callback(rpc):
+            # Callbacks change the layouts on the call
+            if rpc.type == 0:
+                for item in pkt.nfs.array:
+                    if item.op == const.OP_CB_LAYOUTRECALL and item.type == const.LAYOUT4_NFSV4_1_FILES:
+                        self.layout_recall(item.iomode, item.recall)
+            return
+        if rpc.type != 1:
+            return
+        if not has_call(pkt, pkt_call) or not hasattr(pkt_call.nfs, "array"):
+            return
+        for op, citem, item, curfh, savedfh in compound_ops(pkt, pkt_call):
+            if getattr(item, "status", 0) != 0:
+                break
+            if op == const.OP_LAYOUTGET:
+                for layout in item.layout:
+                    self.add_layout(citem.fh, layout, item.stateid.other, pkt.record.index)
+            elif op == const.OP_GETDEVICEINFO:
+                self.add_device(citem.deviceid, item.device_addr)
+            elif op == const.OP_LAYOUTRETURN:
+                if citem.type == const.LAYOUT4_NFSV4_1_FILES:
+                    self.layout_return(citem.fh, citem.iomode, citem.layoutreturn)
+
+    def segments(self, fh):
+        """Return the list of layout segments for the given file handle
+           sorted by offset
+        """
+        return list(self._segments.get(fh, ([], []))[1])
+
+    def segment(self, fh, offset, iomode=None):
+        """Return the latest layout segment for the given file handle
+           containing the file offset or None if not found
+
+           fh:
+               File handle given to the MDS
+           offset:
+               File offset
+           iomode:
+               Layout iomode, any iomode if not given [default: None]
+        """
+        offsets, segments = self._segments.get(fh, ([], []))
+        pos = bisect.bisect_right(offsets, offset)
+        while pos > 0:
+            pos -= 1
+            seg = segments[pos]
+            if seg.contains(offset) and (iomode is None or seg.iomode == iomode):
+                return seg
+        return None
+
+    def dslist(self, deviceid):
+        """Return the multipath list of data server addresses for the given
+           device: [[(ipaddr, port), ...], ...]
+        """
+        return self._devices.get(deviceid, ([], []))[1]
+
+    def ds_index(self, seg, position):
+        """Return the data server index for the stripe position given"""
+        device = self._devices.get(seg.deviceid)
+        if device is None or position >= len(device[0]):
+            # Device is not known, assume one data server per stripe
+            return position
+        return device[0][position]
+
+    def _candidates(self, fh, addr, start, end):
+        """Return the list of (segment, [position, ...], addr_ok) for the I/O
+           sent to the data server address using the data server file handle
+           with data server offsets from start to end, inclusive, where
+           addr_ok is False if the file handle does not belong to the data
+           server at the given address. The latest segments are given first.
+        """
+        ret = []
+        entry = self._dsfh.get(fh)
+        if entry is None:
+            return ret
+        dsoffsets, segments, span = entry
+        pos = bisect.bisect_right(dsoffsets, end)
+        while pos > 0:
+            pos -= 1
+            if dsoffsets[pos] + span <= start:
+                # No segment starting before this one reaches the start
+                break
+            seg = segments[pos]
+            if seg._dsrange[1] <= start:
+                continue
+            count = seg.stripe_count()
+            if len(seg.filehandles) > 1:
+                plist = [j for j in range(len(seg.filehandles)) if seg.filehandles[j] == fh]
+            else:
+                plist = range(count)
+            device = self._devices.get(seg.deviceid)
+            dsset = self._dsaddr.get(addr, {}).get(seg.deviceid) if addr is not None else None
+            addr_ok = True
+            if device is not None and addr is not None:
+                stripe_indices = device[0]
+                alist = [j for j in plist if dsset and j < len(stripe_indices) and stripe_indices[j] in dsset]
+                if alist:
+                    plist = alist
+                else:
+                    # Data server file handle sent to the wrong data server
+                    addr_ok = False
+            if plist:
+                ret.append((seg, plist, addr_ok))
+        return ret
+
+    def resolve(self, fh, addr, offset, size):
+        """Map the I/O sent to a data server back to the file
+
+           fh:
+               File handle sent to the data server
+           addr:
+               Data server address (ipaddr, port), None to match any address
+           offset:
+               Offset sent to the data server
+           size:
+               I/O size
+
+           Return a tuple (segment, position, ds_index, file_offset, valid)
+           where valid is True if the I/O is within a single stripe unit
+           and it has been sent to the correct data server, None is returned
+           if the file handle is not a data server file handle of a known
+           layout segment.
+        """
+        ret = None
+        for seg, plist, addr_ok in self._candidates(fh, addr, offset, offset):
+            for position in plist:
+                file_offset = seg.file_offset(offset, position)
+                if not seg.contains(file_offset):
+                    continue
+                valid = addr_ok and seg.verify(file_offset, size, position)
+                if valid or ret is None:
+                    ret = (seg, position, self.ds_index(seg, position), file_offset, valid)
+                if valid:
+                    return ret
+        return ret
+
+    def _io_list(self, pkt):
+        """Return the list of (fh, addr, offset, size) for the READ and
+           WRITE operations in the NFSv4 call
+        """
+        ret = []
+        if pkt != "nfs" or pkt.rpc.type != 0 or not hasattr(pkt.nfs, "array") or pkt.ip is None:
+            return ret
+        transport = pkt.tcp if pkt == "tcp" else pkt.udp
+        addr = (pkt.ip.dst, transport.dst_port) if transport is not None else None
+        for item in pkt.nfs.array:
+            if item.op == const.OP_READ:
+                size = item.count
+            elif item.op == const.OP_WRITE:
+                size = len(item.data)
+            else:
+                continue
+            ret.append((item.fh, addr, item.offset, size))
+        return ret
+
+    def classify(self, pkt):
+        """Map all the READ and WRITE operations in the NFSv4 call back
+           to the file
+
+           pkt:
+               Packet call object (packet.pkt.Pkt)
+
+           Return a list of tuples (segment, position, ds_index, file_offset,
+           size, valid) as given by resolve(), one for each READ or WRITE
+           sent to a data server.
+        """
+        ret = []
+        for fh, addr, offset, size in self._io_list(pkt):
+            info = self.resolve(fh, addr, offset, size)
+            if info is not None:
+                ret.append(info[:4] + (size,) + info[4:])
+        return ret
+
+    def queue(self, pkt):
+        """Queue all the READ and WRITE operations in the NFSv4 call to be
+           mapped back to the file using bulk_resolve(). The operations
+           queued are mapped every time the number of operations reaches
+           the batch size and before the layouts or devices are changed,
+           so each operation is mapped using the layouts held at the time
+           it was sent.
+
+           pkt:
+               Packet call object (packet.pkt.Pkt)
+        """
+        for item in self._io_list(pkt):
+            self._iolist.append(item)
+            self._ioinfo.append((pkt.record.index, pkt.rpc.xid, item[3]))
+        if len(self._iolist) >= self.batch:
+            self._flush_io()
+
+    def _flush_io(self):
+        """Map all the I/O operations queued"""
+        if len(self._iolist) == 0:
+            return
+        for info, item in zip(self._ioinfo, self.bulk_resolve(self._iolist)):
+            if item is not None:
+                self._resolved.append(info[:2] + item[:4] + info[2:] + item[4:])
+        self._iolist = []
+        self._ioinfo = []
+
+    def flush(self):
+        """Map all the I/O operations queued by queue()
+
+           Return the list of tuples (index, xid, segment, position,
+           ds_index, file_offset, size, valid) for all the READ and WRITE
+           operations queued since the last call, where index and xid are
+           given by the call and the rest is given by resolve(). The
+           operations not sent to a data server are not included.
+        """
+        self._flush_io()
+        ret = self._resolved
+        self._resolved = []
+        return ret
+
+    def bulk_resolve(self, iolist):
+        """Map many I/O operations sent to the data servers back to the
+           file. The I/O operations are grouped by data server file handle
+           and address so the stripe arithmetic for each group is done at
+           once using NumPy arrays if NumPy is available.
+
+           iolist:
+               List of tuples (fh, addr, offset, size) as given to resolve()
+
+           Return a list of (segment, position, ds_index, file_offset, valid)
+           or None for each item in iolist.
+        """
+        ret = [None] * len(iolist)
+        groups = {}
+        for idx, (fh, addr, offset, size) in enumerate(iolist):
+            groups.setdefault((fh, addr), []).append(idx)
+        for (fh, addr), idxlist in groups.iteritems():
+            offsets = [iolist[i][2] for i in idxlist]
+            sizes = [iolist[i][3] for i in idxlist]
+            for seg, plist, addr_ok in self._candidates(fh, addr, min(offsets), max(offsets)):
+                start, end = seg.offset, seg.end()
+                for position in plist:
+                    foffsets = seg.file_offsets(offsets, position)
+                    valid = seg.verify_all(foffsets, sizes, position)
+                    if not addr_ok:
+                        valid = [False] * len(idxlist)
+                    ds_index = self.ds_index(seg, position)
+                    for k, idx in enumerate(idxlist):
+                        file_offset = int(foffsets[k])
+                        if file_offset < start or file_offset >= end:
+                            continue
+                        item = ret[idx]
+                        if item is None or (not item[4] and valid[k]):
+                            ret[idx] = (seg, position, ds_index, file_offset, bool(valid[k]))
+        return ret
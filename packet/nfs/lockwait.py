@@ -0,0 +1,593 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Lock contention module
+
+Rebuild the lock wait chains from the NFSv4 LOCK, LOCKT and LOCKU operations
+and from the NLM v4 procedures, including the asynchronous (_MSG and _RES)
+procedures and the GRANTED callback used for blocking locks.
+
+A wait chain starts with the first lock request denied by the server
+(NFS4ERR_DENIED, NLM4_DENIED or NLM4_BLOCKED) for a given client, file and
+lock owner. Every lock request sent afterwards by the same owner on the
+same file is a retry and the chain ends when the lock is granted, either
+by the reply to a lock request or by the NLM GRANTED callback, or when the
+blocked lock is cancelled. The owners holding the conflicting locks are
+taken from the denied replies when given (NFSv4 LOCK and LOCKT, NLM TEST)
+and from the locks granted in the packet trace overlapping the requested
+range.
+
+The contention is summarized for each file, identified by the CRC32 of the
+file handle, and for each lock owner. The NFSv4 lock owner is given as the
+CRC32 of the client id and owner and the NLM lock owner is given as the
+caller name and the system identifier (svid) of the process.
+"""
+import struct
+import nfstest_config as c
+from baseobj import BaseObj
+from formatstr import crc16, crc32
+from packet.stats import Histogram
+import packet.nfs.nlm4_const as nlm4
+import packet.nfs.nfs4_const as const4
+from packet.nfs.nfsbase import is_callback, has_call, compound_ops
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Lock protocols
+NFS4 = "NFSv4"
+NLM  = "NLM"
+
+# Wait chain results
+PENDING   = "pending"
+GRANTED   = "granted"
+CANCELLED = "cancelled"
+
+# Maximum number of conflicting owners kept for each wait chain
+MAX_CONFLICTS = 16
+
+# Lock request results
+_GRANTED = 0
+_DENIED  = 1
+_BLOCKED = 2
+
+# Per file and per owner counters:
+# [requests, denied, waits, granted, cancelled, retries, waittime, maxwait,
+#  conflicts]
+_REQUESTS  = 0
+_DENIEDS   = 1
+_WAITS     = 2
+_GRANTS    = 3
+_CANCELS   = 4
+_RETRIES   = 5
+_WAITTIME  = 6
+_MAXWAIT   = 7
+_CONFLICTS = 8
+
+def v4_owner(owner):
+    """Return the lock owner key for the NFSv4 lock owner (state_owner4)"""
+    return "0x%08x" % crc32(struct.pack("!Q", owner.clientid) + owner.owner)
+
+def nlm_owner(caller, svid):
+    """Return the lock owner key for the NLM caller name and svid"""
+    return "%s:%d" % (caller, svid)
+
+class LockWait(BaseObj):
+    """Lock wait chain object
+
+       Object definition:
+
+       LockWait(
+           protocol   = str,   # Lock protocol: NFSv4 or NLM
+           client     = str,   # Client IP address
+           server     = str,   # Server IP address
+           fh         = int,   # CRC32 of the file handle
+           owner      = str,   # Lock owner waiting for the lock
+           offset     = int,   # Offset of the first lock request denied
+           length     = int,   # Length of the first lock request denied
+           exclusive  = bool,  # Exclusive (write) lock
+           blocked    = bool,  # The server blocked the NLM lock request
+           start_time = float, # Time of the first lock request denied
+           end_time   = float, # Time the lock is granted or cancelled
+           retries    = int,   # Lock requests sent after the first one
+           conflicts  = set,   # Owners holding the conflicting locks
+           result     = str,   # Result: pending, granted or cancelled
+           index      = int,   # Packet index of the first lock request denied
+       )
+    """
+    # Class attributes
+    _attrlist = ("protocol", "client", "server", "fh", "owner", "offset",
+                 "length", "exclusive", "blocked", "start_time", "end_time",
+                 "retries", "conflicts", "result", "index")
+
+    def __init__(self, **kwds):
+        self.protocol   = None
+        self.client     = None
+        self.server     = None
+        self.fh         = None
+        self.owner      = None
+        self.offset     = None
+        self.length     = None
+        self.exclusive  = False
+        self.blocked    = False
+        self.start_time = None
+        self.end_time   = None
+        self.retries    = 0
+        self.conflicts  = set()
+        self.result     = PENDING
+        self.index      = None
+        BaseObj.__init__(self, **kwds)
+
+    def wait_time(self):
+        """Return the time from the first lock request denied to the
+           time the lock is granted or cancelled, None if still waiting
+        """
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+class LockContention(BaseObj):
+    """Lock contention object
+
+       Usage:
+           from packet.pktt import Pktt
+           from packet.nfs.lockwait import LockContention
+
+           x = Pktt("/traces/tracefile.cap")
+           locks = LockContention()
+           for pkt in x:
+               locks.add(pkt, x.pkt_call)
+
+           # Summary for all files
+           info = locks.summary()
+
+           # Owners having the most denied lock requests
+           for key in locks.top(10, owners=True):
+               info = locks.summary(key, owners=True)
+
+           # All wait chains
+           for wait in locks.waits():
+               print wait.owner, wait.retries, wait.wait_time()
+
+       Object definition:
+
+       LockContention(
+           requests = int, # Number of lock requests
+           denied   = int, # Number of lock requests denied or blocked
+       )
+    """
+    # Class attributes
+    _attrlist = ("requests", "denied")
+
+    def __init__(self, precision=0.01):
+        """Constructor
+
+           precision:
+               Relative error of the wait time percentiles [default: 0.01]
+        """
+        self.requests = 0
+        self.denied   = 0
+        # Per file and per owner counters
+        self._files  = {}
+        self._owners = {}
+        # Wait chains: completed and waiting by (client, fh, owner)
+        self._waits   = []
+        self._waiting = {}
+        # Locks granted by file: fh => [[owner, offset, end, exclusive], ...]
+        self._held = {}
+        # NFSv4 lock owner by lock stateid
+        self._stid_owner = {}
+        # NLM lock owner by owner handle
+        self._oh_owner = {}
+        # Asynchronous NLM requests: (client, cookie) => (secs, index, args)
+        self._msgs = {}
+        # Wait times for all wait chains
+        self._hist = Histogram(precision)
+
+    def _get_stats(self, table, key):
+        """Return the counters for the given file or owner"""
+        stats = table.get(key)
+        if stats is None:
+            stats = [0, 0, 0, 0, 0, 0, 0.0, 0.0, set()]
+            table[key] = stats
+        return stats
+
+    def _conflicts(self, fh, owner, offset, end, exclusive):
+        """Return the owners of the locks granted on the file which
+           conflict with the given range
+        """
+        ret = set()
+        for hold in self._held.get(fh, []):
+            if hold[0] == owner or not (exclusive or hold[3]):
+                continue
+            if (end is None or hold[1] < end) and (hold[2] is None or offset < hold[2]):
+                ret.add(hold[0])
+        return ret
+
+    def _hold(self, fh, owner, offset, end, exclusive):
+        """Add a lock granted"""
+        holds = self._held.setdefault(fh, [])
+        for hold in holds:
+            if hold[0] == owner and hold[1] == offset and hold[2] == end:
+                hold[3] = exclusive
+                return
+        holds.append([owner, offset, end, exclusive])
+
+    def _unlock(self, fh, owner, offset, end):
+        """Remove the locks of the owner overlapping the given range"""
+        holds = self._held.get(fh)
+        if not holds:
+            return
+        holds[:] = [x for x in holds if x[0] != owner or not
+                    ((end is None or x[1] < end) and (x[2] is None or offset < x[2]))]
+        if not holds:
+            self._held.pop(fh)
+
+    def _end_wait(self, wait, secs, result):
+        """End the wait chain"""
+        self._waiting.pop((wait.client, wait.fh, wait.owner), None)
+        wait.end_time = max(secs, wait.start_time)
+        wait.result = result
+        waittime = wait.end_time - wait.start_time
+        index = _GRANTS if result == GRANTED else _CANCELS
+        for stats in (self._files[wait.fh], self._owners[wait.owner]):
+            stats[index] += 1
+            stats[_WAITTIME] += waittime
+            stats[_MAXWAIT] = max(stats[_MAXWAIT], waittime)
+        self._hist.add(waittime)
+
+    def _lock(self, secs, reqsecs, index, protocol, client, server, fh, owner,
+              offset, end, exclusive, result, conflict=None, test=False):
+        """Add a lock request and its result
+
+           secs:
+               Time of the result
+           reqsecs:
+               Time of the lock request
+           index:
+               Packet index of the lock request
+           protocol:
+               Lock protocol: NFS4 or NLM
+           client, server:
+               Client and server IP addresses
+           fh:
+               CRC32 of the file handle
+           owner:
+               Lock owner key
+           offset, end:
+               Lock range, end is None for a lock to the end of the file
+           exclusive:
+               Exclusive (write) lock
+           result:
+               Lock request result: _GRANTED, _DENIED or _BLOCKED
+           conflict:
+               Owner of the conflicting lock if given by the server
+               [default: None]
+           test:
+               Lock test (NFSv4 LOCKT or NLM TEST) [default: False]
+        """
+        self.requests += 1
+        fstats = self._get_stats(self._files, fh)
+        ostats = self._get_stats(self._owners, owner)
+        fstats[_REQUESTS] += 1
+        ostats[_REQUESTS] += 1
+        wkey = (client, fh, owner)
+        wait = self._waiting.get(wkey)
+        if wait is not None:
+            wait.retries += 1
+            fstats[_RETRIES] += 1
+            ostats[_RETRIES] += 1
+
+        if result == _GRANTED:
+            if not test:
+                self._hold(fh, owner, offset, end, exclusive)
+                if wait is not None:
+                    self._end_wait(wait, secs, GRANTED)
+            return
+
+        self.denied += 1
+        fstats[_DENIEDS] += 1
+        ostats[_DENIEDS] += 1
+        if wait is None:
+            wait = LockWait(
+                protocol   = protocol,
+                client     = client,
+                server     = server,
+                fh         = fh,
+                owner      = owner,
+                offset     = offset,
+                length     = None if end is None else end - offset,
+                exclusive  = exclusive,
+                start_time = reqsecs,
+                index      = index,
+            )
+            self._waits.append(wait)
+            self._waiting[wkey] = wait
+            fstats[_WAITS] += 1
+            ostats[_WAITS] += 1
+        if result == _BLOCKED:
+            wait.blocked = True
+        conflicts = self._conflicts(fh, owner, offset, end, exclusive)
+        if conflict is not None and conflict != owner:
+            conflicts.add(conflict)
+        for item in conflicts:
+            if len(wait.conflicts) >= MAX_CONFLICTS:
+                break
+            wait.conflicts.add(item)
+        for stats in (fstats, ostats):
+            if len(stats[_CONFLICTS]) < MAX_CONFLICTS:
+                stats[_CONFLICTS].update(conflicts)
+
+    def granted(self, secs, client, fh, owner, offset, end, exclusive):
+        """Add a lock granted by the server without a lock request,
+           e.g., the NLM GRANTED callback for a blocked lock
+        """
+        self._hold(fh, owner, offset, end, exclusive)
+        wait = self._waiting.get((client, fh, owner))
+        if wait is not None:
+            self._end_wait(wait, secs, GRANTED)
+
+    def cancel(self, secs, client, fh, owner):
+        """Cancel the wait chain of the owner"""
+        wait = self._waiting.get((client, fh, owner))
+        if wait is not None:
+            self._end_wait(wait, secs, CANCELLED)
+
+    def add(self, pkt, pkt_call=None):
+        """Add the lock requests and results given by the packet
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Packet call object if pkt is a reply [default: None]
+        """
+        if pkt == "nlm":
+            if pkt.rpc.type == 0:
+                self._add_nlm_call(pkt)
+            elif pkt_call is not None and pkt_call == "nlm" and \
+                 pkt_call.rpc.xid == pkt.rpc.xid:
+                self._add_nlm_reply(pkt, pkt_call)
+            return
+        if pkt != "nfs" or pkt.rpc.type != 1:
+            return
+        if not has_call(pkt, pkt_call):
+            # Call is not in the packet trace
+            return
+        if not hasattr(pkt.nfs, "array") or not hasattr(pkt_call.nfs, "array"):
+            return
+        rpc = pkt_call.rpc
+        if is_callback(rpc):
+            # Ignore callbacks
+            return
+        self._add_v4(pkt, pkt_call)
+
+    def _add_v4(self, pkt, pkt_call):
+        """Add the NFSv4 reply"""
+        secs = pkt.record.secs
+        reqsecs = pkt_call.record.secs
+        index = pkt_call.record.index
+        client = pkt_call.ip.src if pkt_call.ip is not None else None
+        server = pkt_call.ip.dst if pkt_call.ip is not None else None
+        for op, citem, item, curfh, savedfh in compound_ops(pkt, pkt_call):
+            status = getattr(item, "status", 0)
+            if op in (const4.OP_LOCK, const4.OP_LOCKT):
+                if status == const4.NFS4_OK:
+                    result = _GRANTED
+                elif status == const4.NFS4ERR_DENIED:
+                    result = _DENIED
+                else:
+                    break
+                if op == const4.OP_LOCKT:
+                    owner = v4_owner(citem.owner)
+                else:
+                    locker = citem.locker
+                    if locker.new_lock_owner:
+                        owner = v4_owner(locker.open_owner.lock_owner)
+                    else:
+                        other = locker.lock_owner.stateid.other
+                        owner = self._stid_owner.get(other)
+                        if owner is None:
+                            # Lock stateid not seen in the packet trace
+                            owner = "stid:0x%04x" % crc16(other)
+                            self._stid_owner[other] = owner
+                    if result == _GRANTED:
+                        self._stid_owner[item.stateid.other] = owner
+                conflict = None
+                if result == _DENIED:
+                    conflict = v4_owner(item.denied.owner)
+                offset = citem.offset
+                end = None if citem.length == const4.NFS4_UINT64_MAX else offset + citem.length
+                exclusive = citem.locktype in (const4.WRITE_LT, const4.WRITEW_LT)
+                self._lock(secs, reqsecs, index, NFS4, client, server, crc32(citem.fh),
+                           owner, offset, end, exclusive, result, conflict,
+                           test=(op == const4.OP_LOCKT))
+            elif op == const4.OP_LOCKU and status == const4.NFS4_OK:
+                owner = self._stid_owner.get(citem.stateid.other)
+                if owner is not None:
+                    offset = citem.offset
+                    end = None if citem.length == const4.NFS4_UINT64_MAX else offset + citem.length
+                    self._unlock(crc32(citem.fh), owner, offset, end)
+
+    def _nlm_lock(self, locker):
+        """Return the file key, owner and range for the NLM lock"""
+        owner = nlm_owner(locker.owner, locker.svid)
+        self._oh_owner[locker.oh] = owner
+        offset = locker.offset
+        end = None if locker.length == 0 else offset + locker.length
+        return (crc32(locker.fh), owner, offset, end)
+
+    def _nlm_result(self, secs, reqsecs, index, client, server, procedure, args, res):
+        """Add the result of the NLM request given by its arguments"""
+        status = res.status
+        if procedure in (nlm4.NLMPROC4_LOCK, nlm4.NLMPROC4_NM_LOCK,
+                         nlm4.NLMPROC4_TEST):
+            if status == nlm4.NLM4_GRANTED:
+                result = _GRANTED
+            elif status == nlm4.NLM4_DENIED:
+                result = _DENIED
+            elif status == nlm4.NLM4_BLOCKED:
+                result = _BLOCKED
+            else:
+                return
+            fh, owner, offset, end = self._nlm_lock(args.locker)
+            conflict = None
+            if procedure == nlm4.NLMPROC4_TEST and result == _DENIED:
+                holder = res.stat.denied
+                conflict = self._oh_owner.get(holder.oh, "svid:%d" % holder.svid)
+            self._lock(secs, reqsecs, index, NLM, client, server, fh, owner,
+                       offset, end, bool(args.exclusive), result, conflict,
+                       test=(procedure == nlm4.NLMPROC4_TEST))
+        elif status == nlm4.NLM4_GRANTED:
+            fh, owner, offset, end = self._nlm_lock(args.locker)
+            if procedure == nlm4.NLMPROC4_CANCEL:
+                self.cancel(secs, client, fh, owner)
+            elif procedure == nlm4.NLMPROC4_UNLOCK:
+                self._unlock(fh, owner, offset, end)
+
+    def _add_nlm_call(self, pkt):
+        """Add the NLM call, only the asynchronous procedures and the
+           GRANTED callback are processed on the call
+        """
+        nlm = pkt.nlm
+        procedure = nlm.procedure
+        secs = pkt.record.secs
+        src = pkt.ip.src if pkt.ip is not None else None
+        dst = pkt.ip.dst if pkt.ip is not None else None
+        if procedure in (nlm4.NLMPROC4_LOCK_MSG, nlm4.NLMPROC4_TEST_MSG,
+                         nlm4.NLMPROC4_CANCEL_MSG, nlm4.NLMPROC4_UNLOCK_MSG):
+            # Asynchronous request, the result is given by the _RES call
+            self._msgs[(src, nlm.cookie)] = (secs, pkt.record.index, nlm)
+        elif procedure in (nlm4.NLMPROC4_LOCK_RES, nlm4.NLMPROC4_TEST_RES,
+                           nlm4.NLMPROC4_CANCEL_RES, nlm4.NLMPROC4_UNLOCK_RES):
+            # Asynchronous result sent by the server to the client
+            item = self._msgs.pop((dst, nlm.cookie), None)
+            if item is not None:
+                reqsecs, index, args = item
+                # Procedure number of the synchronous request
+                sproc = args.procedure - nlm4.NLMPROC4_TEST_MSG + nlm4.NLMPROC4_TEST
+                self._nlm_result(secs, reqsecs, index, dst, src, sproc, args, nlm)
+        elif procedure in (nlm4.NLMPROC4_GRANTED, nlm4.NLMPROC4_GRANTED_MSG):
+            # Blocked lock granted, callback sent by the server to the client
+            fh, owner, offset, end = self._nlm_lock(nlm.locker)
+            self.granted(secs, dst, fh, owner, offset, end, bool(nlm.exclusive))
+
+    def _add_nlm_reply(self, pkt, pkt_call):
+        """Add the NLM reply"""
+        procedure = pkt_call.nlm.procedure
+        if procedure in (nlm4.NLMPROC4_LOCK, nlm4.NLMPROC4_NM_LOCK, nlm4.NLMPROC4_TEST,
+                         nlm4.NLMPROC4_CANCEL, nlm4.NLMPROC4_UNLOCK):
+            client = pkt_call.ip.src if pkt_call.ip is not None else None
+            server = pkt_call.ip.dst if pkt_call.ip is not None else None
+            self._nlm_result(pkt.record.secs, pkt_call.record.secs,
+                             pkt_call.record.index, client, server,
+                             procedure, pkt_call.nlm, pkt.nlm)
+
+    def waits(self, result=None):
+        """Return the list of wait chains sorted by start time
+
+           result:
+               Return only the wait chains having this result: PENDING,
+               GRANTED or CANCELLED [default: None(all wait chains)]
+        """
+        return [x for x in self._waits if result is None or x.result == result]
+
+    def keys(self, owners=False):
+        """Return the list of file keys (CRC32 of the file handle) or the
+           list of lock owners if owners is True
+        """
+        table = self._owners if owners else self._files
+        return table.keys()
+
+    def top(self, count, owners=False, sortby="denied"):
+        """Return the list of file keys or lock owners having the largest
+           value
+
+           count:
+               Number of keys to return
+           owners:
+               Return the lock owners instead of the file keys [default: False]
+           sortby:
+               Value to sort by: denied, retries, waits or waittime
+               [default: "denied"]
+        """
+        index = {
+            "retries":  _RETRIES,
+            "waits":    _WAITS,
+            "waittime": _WAITTIME,
+        }.get(sortby, _DENIEDS)
+        table = self._owners if owners else self._files
+        items = sorted(table.iteritems(), key=lambda x: x[1][index], reverse=True)
+        return [x[0] for x in items[:count]]
+
+    def summary(self, key=None, owners=False):
+        """Return a dictionary with the lock contention of the given file
+           or lock owner or for all files if no key is given:
+               requests:
+                   Number of lock requests, including lock tests
+               denied:
+                   Number of lock requests denied or blocked
+               waits:
+                   Number of wait chains
+               granted, cancelled, pending:
+                   Number of wait chains granted, cancelled and still
+                   waiting at the end of the packet trace
+               retries:
+                   Number of lock requests sent while waiting for the lock
+               waittime:
+                   Average time waiting for the lock, only for the wait
+                   chains granted or cancelled
+               maxwait:
+                   Maximum time waiting for the lock
+               conflicts:
+                   Set of owners holding the conflicting locks, up to
+                   a limit (file or lock owner only)
+               hist:
+                   Histogram of the wait times (all files only)
+
+           key:
+               File key or lock owner [default: None]
+           owners:
+               The key is a lock owner [default: False]
+        """
+        table = self._owners if owners else self._files
+        if key is not None:
+            slist = [table[key]]
+        else:
+            slist = table.itervalues()
+        info = {
+            "requests": 0, "denied": 0, "waits": 0, "granted": 0,
+            "cancelled": 0, "retries": 0, "maxwait": None,
+        }
+        waittime = 0.0
+        for stats in slist:
+            info["requests"]  += stats[_REQUESTS]
+            info["denied"]    += stats[_DENIEDS]
+            info["waits"]     += stats[_WAITS]
+            info["granted"]   += stats[_GRANTS]
+            info["cancelled"] += stats[_CANCELS]
+            info["retries"]   += stats[_RETRIES]
+            waittime += stats[_WAITTIME]
+            if stats[_GRANTS] + stats[_CANCELS]:
+                info["maxwait"] = max(info["maxwait"], stats[_MAXWAIT])
+        ended = info["granted"] + info["cancelled"]
+        info["pending"] = info["waits"] - ended
+        info["waittime"] = waittime / ended if ended else None
+        if key is not None:
+            info["conflicts"] = table[key][_CONFLICTS]
+        else:
+            info["hist"] = self._hist
+        return info
@@ -0,0 +1,300 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+LOOKUP storm detector module
+
+Find the names looked up over and over in the same directory, e.g., many
+clients walking the same path or applications probing for files which do
+not exist. The name lookups are taken from the NFSv3 LOOKUP, the NFSv4
+LOOKUP and LOOKUPP and the NFSv4 OPEN by name, and a lookup is negative
+when the server returns NOENT.
+
+The packet trace is split in time windows and for each window the lookups
+of each (directory, name) are counted using count-min sketches so the
+memory used does not depend on the number of distinct names. Only a
+bounded number of candidates having the largest counts are kept for each
+window to report the top offenders, together with the number of different
+clients looking up the name (up to a limit).
+"""
+import binascii
+import nfstest_config as c
+from baseobj import BaseObj
+from formatstr import crc32
+import packet.nfs.nfs3_const as const3
+import packet.nfs.nfs4_const as const4
+from packet.nfs.nfsbase import is_callback, has_call, compound_ops
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Maximum number of different clients kept for each candidate
+MAX_CLIENTS = 64
+
+class CountMinSketch(BaseObj):
+    """Count-min sketch
+
+       Approximate counter for a large number of keys using fixed memory.
+       The count given for a key is never less than the real count and it
+       exceeds it by at most 2*N/width with probability 1 - 1/2**depth,
+       where N is the total count of all keys.
+
+       Usage:
+           from packet.nfs.lookupstorm import CountMinSketch
+
+           x = CountMinSketch(width=2048, depth=4)
+           x.add("key")
+           count = x.estimate("key")
+
+       Object definition:
+
+       CountMinSketch(
+           width = int, # Number of counters in each row
+           depth = int, # Number of rows
+           total = int, # Total count of all keys
+       )
+    """
+    # Class attributes
+    _attrlist = ("width", "depth", "total")
+
+    def __init__(self, width=2048, depth=4):
+        """Constructor
+
+           width:
+               Number of counters in each row [default: 2048]
+           depth:
+               Number of rows, each row uses a different hash function
+               [default: 4]
+        """
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._rows = [[0] * width for i in range(depth)]
+
+    def _indices(self, key):
+        """Return the counter index for the key on each row"""
+        return [(binascii.crc32(key, i * 0x9e3779b1) & 0xffffffff) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Add count to the key and return its new estimated count"""
+        ret = None
+        self.total += count
+        for row, idx in zip(self._rows, self._indices(key)):
+            row[idx] += count
+            if ret is None or row[idx] < ret:
+                ret = row[idx]
+        return ret
+
+    def estimate(self, key):
+        """Return the estimated count of the key"""
+        return min([row[idx] for row, idx in zip(self._rows, self._indices(key))])
+
+class LookupStorm(BaseObj):
+    """LOOKUP storm detector object
+
+       Usage:
+           from packet.pktt import Pktt
+           from packet.nfs.lookupstorm import LookupStorm
+
+           x = Pktt("/traces/tracefile.cap")
+           storm = LookupStorm(window=1.0, topn=10)
+           for pkt in x:
+               storm.add(pkt, x.pkt_call)
+
+           # Top offenders for each time window
+           for winfo in storm.windows():
+               for item in winfo["top"]:
+                   (dirkey, name, count, negative, nclients) = item
+
+       Object definition:
+
+       LookupStorm(
+           window   = float, # Time window in seconds
+           topn     = int,   # Number of top offenders kept for each window
+           lookups  = int,   # Total number of lookups
+           negative = int,   # Total number of negative lookups
+       )
+    """
+    # Class attributes
+    _attrlist = ("window", "topn", "lookups", "negative")
+
+    def __init__(self, window=1.0, topn=10, width=2048, depth=4, threshold=1):
+        """Constructor
+
+           window:
+               Time window in seconds [default: 1.0]
+           topn:
+               Number of top offenders kept for each window [default: 10]
+           width:
+               Number of counters in each count-min sketch row [default: 2048]
+           depth:
+               Number of rows in each count-min sketch [default: 4]
+           threshold:
+               Minimum number of lookups of the same name in the same
+               directory within a window to be reported [default: 1]
+        """
+        self.window    = window
+        self.topn      = topn
+        self.width     = width
+        self.depth     = depth
+        self.threshold = threshold
+        self.lookups   = 0
+        self.negative  = 0
+        # Summary for each closed window
+        self._windows = []
+        # State of the current window
+        self._start = None
+        self._reset()
+
+    def _reset(self):
+        """Start a new window"""
+        self._count = 0
+        self._neg = 0
+        self._clients = set()
+        self._sketch = CountMinSketch(self.width, self.depth)
+        self._negsketch = CountMinSketch(self.width, self.depth)
+        # Candidates: key => [dirkey, name, set(clients)]
+        self._cand = {}
+        self._minest = 0
+
+    def _summary(self):
+        """Return the summary of the current window"""
+        top = []
+        for key, (dirkey, name, clients) in self._cand.iteritems():
+            count = self._sketch.estimate(key)
+            if count >= self.threshold:
+                negative = min(self._negsketch.estimate(key), count)
+                top.append((dirkey, name, count, negative, len(clients)))
+        top.sort(key=lambda x: (x[2], x[3]), reverse=True)
+        return {
+            "start":    self._start,
+            "end":      self._start + self.window,
+            "lookups":  self._count,
+            "negative": self._neg,
+            "clients":  len(self._clients),
+            "top":      top[:self.topn],
+        }
+
+    def lookup(self, secs, dirfh, name, client=None, negative=False):
+        """Add a name lookup
+
+           secs:
+               Time of the lookup
+           dirfh:
+               Directory file handle
+           name:
+               Name looked up
+           client:
+               Client IP address [default: None]
+           negative:
+               The name does not exist [default: False]
+        """
+        if self._start is None:
+            self._start = secs
+        elif secs >= self._start + self.window:
+            self._windows.append(self._summary())
+            # Skip empty windows
+            nwin = int((secs - self._start) / self.window)
+            self._start += nwin * self.window
+            self._reset()
+
+        self.lookups += 1
+        self._count += 1
+        if len(self._clients) < MAX_CLIENTS:
+            self._clients.add(client)
+        dirkey = crc32(dirfh)
+        name = str(name)
+        key = "%08x/%s" % (dirkey, name)
+        count = self._sketch.add(key)
+        if negative:
+            self.negative += 1
+            self._neg += 1
+            self._negsketch.add(key)
+
+        cand = self._cand.get(key)
+        if cand is None:
+            maxcand = 4 * self.topn
+            if len(self._cand) >= maxcand:
+                if count <= self._minest:
+                    return
+                # Replace the candidate having the smallest count
+                ests = [(self._sketch.estimate(x), x) for x in self._cand]
+                ests.sort()
+                self._cand.pop(ests[0][1])
+                self._minest = ests[1][0] if len(ests) > 1 else 0
+            cand = [dirkey, name, set()]
+            self._cand[key] = cand
+        if len(cand[2]) < MAX_CLIENTS:
+            cand[2].add(client)
+
+    def add(self, pkt, pkt_call=None):
+        """Add the name lookups given by the reply
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Packet call object if pkt is a reply [default: None]
+        """
+        if pkt != "nfs" or pkt.rpc.type != 1:
+            return
+        if not has_call(pkt, pkt_call):
+            # Call is not in the packet trace
+            return
+        rpc = pkt_call.rpc
+        if is_callback(rpc):
+            # Ignore callbacks
+            return
+        secs = pkt.record.secs
+        client = pkt_call.ip.src if pkt_call.ip is not None else None
+        if hasattr(pkt.nfs, "array") and hasattr(pkt_call.nfs, "array"):
+            self._add_v4(secs, client, pkt, pkt_call)
+        elif rpc.version == 3 and rpc.procedure == const3.NFSPROC3_LOOKUP:
+            what = pkt_call.nfs.what
+            negative = pkt.nfs.status == const3.NFS3ERR_NOENT
+            self.lookup(secs, what.fh, what.name, client, negative)
+
+    def _add_v4(self, secs, client, pkt, pkt_call):
+        """Add the NFSv4 reply"""
+        for op, citem, item, curfh, savedfh in compound_ops(pkt, pkt_call):
+            negative = getattr(item, "status", 0) == const4.NFS4ERR_NOENT
+            if curfh is None:
+                continue
+            if op == const4.OP_LOOKUP:
+                self.lookup(secs, curfh, citem.name, client, negative)
+            elif op == const4.OP_LOOKUPP:
+                self.lookup(secs, curfh, "..", client, negative)
+            elif op == const4.OP_OPEN and citem.claim.claim == const4.CLAIM_NULL:
+                self.lookup(secs, curfh, citem.claim.name, client, negative)
+
+    def windows(self):
+        """Return the list of time windows having any lookups, each window
+           is given as a dictionary:
+               start, end:
+                   Start and end time of the window
+               lookups, negative:
+                   Number of lookups and negative lookups
+               clients:
+                   Number of different clients (up to a limit)
+               top:
+                   Top offenders sorted by the number of lookups:
+                   [(dirkey, name, count, negative, nclients), ...]
+                   where dirkey is the CRC32 of the directory file handle
+                   and the counts are estimates which could be larger
+                   than the real counts
+        """
+        if self._count == 0:
+            return list(self._windows)
+        return self._windows + [self._summary()]
@@ -0,0 +1,549 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+NFSv4 state tracker module
+
+Rebuild the NFSv4 open, lock, delegation and layout state from the packets
+as they are decoded so the state could be queried after a single pass over
+the packet trace instead of searching the packet trace for every query.
+
+The state is changed by the replies using the arguments of their calls and
+by the callbacks sent by the server:
+    OPEN, OPEN_CONFIRM, OPEN_DOWNGRADE, CLOSE
+        Open state ids and the delegations given by OPEN
+    LOCK, LOCKU
+        Lock state ids and the byte ranges locked
+    DELEGRETURN, CB_RECALL
+        Delegation returns and recalls
+    LAYOUTGET, LAYOUTRETURN, CB_LAYOUTRECALL
+        Layout state ids and the layout segments held
+    FREE_STATEID
+        Any state id
+
+Each state id is identified by its "other" field and the server, the seqid
+is updated every time the state id is returned by the server. The current
+file handle is followed through the COMPOUND (PUTFH, GETFH, SAVEFH and
+RESTOREFH) so the file handle of each state id is known.
+
+The state ids not yet released are indexed by file handle and the layouts
+by client and server, and the lock state ids are indexed by their open
+state id, so every packet is processed in constant time regardless of
+the number of state ids seen so far.
+"""
+from collections import OrderedDict
+import nfstest_config as c
+from baseobj import BaseObj
+import packet.nfs.nfs4_const as const
+from packet.nfs.nfsbase import OPEN_BYNAME, is_callback, has_call, compound_ops
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# State id types
+OPEN   = "OPEN"
+LOCK   = "LOCK"
+DELEG  = "DELEG"
+LAYOUT = "LAYOUT"
+
+# Byte range end for a length of all ones (to the end of the file)
+_EOF = 1 << 64
+
+def _range_end(offset, length):
+    """Return the end of the byte range, exclusive"""
+    if length == const.NFS4_UINT64_MAX:
+        return _EOF
+    return min(offset + length, _EOF)
+
+def _range_remove(segments, offset, length, match=None):
+    """Remove the byte range from the list of segments [key, offset, length]
+       where the segments having a key not matching are not changed,
+       returns the new list of segments
+    """
+    end = _range_end(offset, length)
+    ret = []
+    for seg in segments:
+        soff = seg[1]
+        send = _range_end(soff, seg[2])
+        if (match is not None and not match(seg[0])) or send <= offset or soff >= end:
+            ret.append(seg)
+            continue
+        if soff < offset:
+            ret.append([seg[0], soff, offset - soff])
+        if send > end:
+            ret.append([seg[0], end, const.NFS4_UINT64_MAX if send == _EOF else send - end])
+    return ret
+
+class StateID(BaseObj):
+    """NFSv4 state id object
+
+       Usage:
+           from packet.nfs.nfs4state import NFS4State
+
+           x = NFS4State()
+           ...
+           for stobj in x.states(stype="DELEG"):
+               print stobj.fh, stobj.recall_time, stobj.return_time
+
+       Object definition:
+
+       StateID(
+           stype       = str,   # State id type: OPEN, LOCK, DELEG or LAYOUT
+           other       = str,   # State id "other" field
+           seqid       = int,   # Last seqid given by the server
+           client      = str,   # Client IP address
+           server      = str,   # Server IP address
+           fh          = str,   # File handle
+           owner       = str,   # Open or lock owner
+           parent      = str,   # Open state id "other" for a lock state id
+           access      = int,   # Share access for an open state id
+           deny        = int,   # Share deny for an open state id
+           deleg_type  = int,   # Delegation type
+           ltype       = int,   # Layout type
+           segments    = list,  # Byte ranges held: [[locktype or iomode, offset, length], ...]
+           start_time  = float, # Time the state id was given by the server
+           recall_time = float, # Time of the first recall
+           return_time = float, # Time of the first return after the recall
+           end_time    = float, # Time the state id was released
+           nrecalls    = int,   # Number of recalls
+           index       = int,   # Packet index where the state id was given
+       )
+    """
+    # Class attributes
+    _attrlist = ("stype", "other", "seqid", "client", "server", "fh", "owner",
+                 "parent", "access", "deny", "deleg_type", "ltype", "segments",
+                 "start_time", "recall_time", "return_time", "end_time",
+                 "nrecalls", "index")
+
+    def __init__(self, stype, other, seqid, client, server, fh, secs, index):
+        """Constructor
+
+           stype:
+               State id type: OPEN, LOCK, DELEG or LAYOUT
+           other:
+               State id "other" field
+           seqid:
+               State id seqid
+           client:
+               Client IP address
+           server:
+               Server IP address
+           fh:
+               File handle
+           secs:
+               Time the state id was given by the server
+           index:
+               Packet index where the state id was given
+        """
+        self.stype       = stype
+        self.other       = other
+        self.seqid       = seqid
+        self.client      = client
+        self.server      = server
+        self.fh          = fh
+        self.owner       = None
+        self.parent      = None
+        self.access      = None
+        self.deny        = None
+        self.deleg_type  = None
+        self.ltype       = None
+        self.segments    = []
+        self.start_time  = secs
+        self.recall_time = None
+        self.return_time = None
+        self.end_time    = None
+        self.nrecalls    = 0
+        self.index       = index
+        # Position in the order the state ids were given by the server
+        self._order      = 0
+
+    def active(self, secs=None):
+        """Return True if the state id is held at the given time or
+           if it has not been released if no time is given
+        """
+        if secs is None:
+            return self.end_time is None
+        return self.start_time <= secs and (self.end_time is None or self.end_time > secs)
+
+    def recall_latency(self):
+        """Return the time from the recall to the return or None if
+           the state id has not been recalled and returned
+        """
+        if self.recall_time is None or self.return_time is None:
+            return None
+        return self.return_time - self.recall_time
+
+class NFS4State(BaseObj):
+    """NFSv4 state tracker object
+
+       Usage:
+           from packet.pktt import Pktt
+           from packet.nfs.nfs4state import NFS4State
+
+           x = Pktt("/traces/tracefile.cap")
+           state = NFS4State()
+           for pkt in x:
+               state.add(pkt, x.pkt_call)
+
+           # State id to be used for I/O on the file
+           stobj = state.io_stateid(filehandle)
+
+           # Delegation recall latencies
+           latencies = [x.recall_latency() for x in state.recalled("DELEG")]
+
+           # Layouts outstanding at the given time
+           layouts = state.states("LAYOUT", secs=1500000000.5)
+
+       Object definition:
+
+       NFS4State(
+           count = int, # Number of state ids given by the server
+       )
+    """
+    # Class attributes
+    _attrlist = ("count",)
+
+    def __init__(self):
+        """Constructor"""
+        self.count = 0
+        # All state ids in the order given by the server
+        self._states = []
+        # Current state id for each (server, other)
+        self._stmap = {}
+        # Last state id given for each "other"
+        self._others = {}
+        # All state ids for each file handle
+        self._files = {}
+        # State ids not yet released: (server, other) => state id
+        self._active = OrderedDict()
+        # State ids not yet released for each file handle
+        self._active_fh = {}
+        # Layouts not yet released for each (client, server)
+        self._layouts = {}
+        # Lock state ids for each open state id (server, other)
+        self._locks = {}
+        # State ids recalled by the server
+        self._recalled = []
+
+    def __len__(self):
+        """Number of state ids given by the server"""
+        return self.count
+
+    def get(self, stateid, server=None):
+        """Return the state id object for the given state id or None if
+           the state id is not found
+
+           stateid:
+               State id given either as a stateid4 object or its "other" field
+           server:
+               Server IP address, any server if not given [default: None]
+        """
+        other = getattr(stateid, "other", stateid)
+        if server is not None:
+            return self._stmap.get((server, other))
+        return self._others.get(other)
+
+    def states(self, stype=None, fh=None, client=None, server=None, secs=None, active=False):
+        """Return the list of state id objects matching all the given
+           arguments in the order given by the server
+
+           stype:
+               State id type: OPEN, LOCK, DELEG or LAYOUT [default: None]
+           fh:
+               File handle [default: None]
+           client:
+               Client IP address [default: None]
+           server:
+               Server IP address [default: None]
+           secs:
+               Only include the state ids held at this time [default: None]
+           active:
+               Only include the state ids not yet released [default: False]
+        """
+        if active and fh is not None:
+            slist = self._active_fh.get(fh, {}).itervalues()
+        elif active and stype == LAYOUT and client is not None and server is not None:
+            slist = self._layouts.get((client, server), {}).itervalues()
+        elif active:
+            slist = self._active.itervalues()
+        elif fh is not None:
+            slist = self._files.get(fh, [])
+        else:
+            slist = self._states
+        ret = []
+        for stobj in slist:
+            if (stype is not None and stobj.stype != stype) or \
+               (fh is not None and stobj.fh != fh) or \
+               (client is not None and stobj.client != client) or \
+               (server is not None and stobj.server != server):
+                continue
+            if secs is not None and not stobj.active(secs):
+                continue
+            if active and not stobj.active():
+                continue
+            ret.append(stobj)
+        return ret
+
+    def recalled(self, stype=None):
+        """Return the list of state id objects recalled by the server
+
+           stype:
+               State id type: DELEG or LAYOUT [default: None]
+        """
+        # Keep the order given by the server
+        slist = sorted(self._recalled, key=lambda x: x._order)
+        return [x for x in slist if stype is None or x.stype == stype]
+
+    def io_stateid(self, fh, client=None):
+        """Return the state id object the client should use for I/O on the
+           given file: the delegation state id if the file is delegated,
+           otherwise the lock state id if the file is locked, otherwise the
+           open state id. The last state id given for the file which has
+           not been released is used.
+
+           fh:
+               File handle
+           client:
+               Client IP address [default: None]
+        """
+        ret = {}
+        for stobj in self._active_fh.get(fh, {}).itervalues():
+            if client is None or stobj.client == client:
+                # Keep the last state id given for each type
+                ret[stobj.stype] = stobj
+        for stype in (DELEG, LOCK, OPEN):
+            if stype in ret:
+                return ret[stype]
+        return None
+
+    def _new_state(self, stype, stateid, client, server, fh, secs, index):
+        """Return the state id object for the state id given by the server,
+           a new object is created if the state id is not known or if it
+           has been released
+        """
+        other = stateid.other
+        key = (server, other)
+        stobj = self._stmap.get(key)
+        if stobj is None or stobj.end_time is not None:
+            stobj = StateID(stype, other, stateid.seqid, client, server, None, secs, index)
+            stobj._order = self.count
+            self._stmap[key] = stobj
+            self._others[other] = stobj
+            self._states.append(stobj)
+            self._active[key] = stobj
+            if stype == LAYOUT:
+                self._layouts.setdefault((client, server), OrderedDict())[key] = stobj
+            self.count += 1
+        else:
+            stobj.seqid = stateid.seqid
+        self._set_fh(stobj, fh)
+        return stobj
+
+    def _set_fh(self, stobj, fh):
+        """Set the file handle of the state id if it is not known"""
+        if stobj.fh is None and fh is not None:
+            stobj.fh = fh
+            self._files.setdefault(fh, []).append(stobj)
+            if stobj.end_time is None:
+                key = (stobj.server, stobj.other)
+                self._active_fh.setdefault(fh, OrderedDict())[key] = stobj
+
+    def _set_parent(self, stobj, parent):
+        """Set the open state id "other" of the lock state id"""
+        if stobj.parent != parent:
+            if stobj.stype == LOCK:
+                llist = self._locks.get((stobj.server, stobj.parent))
+                if llist is not None:
+                    # Lock state id given again for a different open
+                    llist[:] = [x for x in llist if x is not stobj]
+                self._locks.setdefault((stobj.server, parent), []).append(stobj)
+            stobj.parent = parent
+
+    def _update(self, stateid, server):
+        """Update the seqid of a known state id and return its object"""
+        stobj = self._stmap.get((server, stateid.other))
+        if stobj is not None:
+            stobj.seqid = stateid.seqid
+        return stobj
+
+    def _release(self, stobj, secs):
+        """Release the given state id"""
+        if stobj is not None and stobj.end_time is None:
+            stobj.end_time = secs
+            key = (stobj.server, stobj.other)
+            self._active.pop(key, None)
+            self._remove(self._active_fh, stobj.fh, key)
+            if stobj.stype == LAYOUT:
+                self._remove(self._layouts, (stobj.client, stobj.server), key)
+            elif stobj.stype == OPEN:
+                # Lock state ids are released on CLOSE
+                for lobj in self._locks.pop(key, []):
+                    self._release(lobj, secs)
+
+    def _remove(self, index, ikey, key):
+        """Remove the state id given by key from the index entry ikey"""
+        stmap = index.get(ikey)
+        if stmap is not None:
+            stmap.pop(key, None)
+            if len(stmap) == 0:
+                index.pop(ikey)
+
+    def _recall(self, stobj, secs):
+        """Recall the given state id"""
+        if stobj is not None and stobj.end_time is None:
+            if stobj.nrecalls == 0:
+                stobj.recall_time = secs
+                self._recalled.append(stobj)
+            stobj.nrecalls += 1
+
+    def _returned(self, stobj, secs):
+        """Delegation or layout returned"""
+        if stobj.recall_time is not None and stobj.return_time is None:
+            stobj.return_time = secs
+
+    def add(self, pkt, pkt_call=None):
+        """Update the state using the given packet, returns True if the
+           packet is an NFSv4 packet
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Packet call object if pkt is a reply [default: None]
+        """
+        if pkt != "nfs" or not hasattr(pkt.nfs, "array") or pkt.ip is None:
+            return False
+        rpc = pkt.rpc
+        secs = pkt.record.secs
+        if is_callback(rpc):
+            # Callbacks change the state on the call
+            if rpc.type == 0:
+                self._add_callback(pkt, secs)
+            return True
+        if rpc.type == 0:
+            return True
+        if not has_call(pkt, pkt_call) or not hasattr(pkt_call.nfs, "array"):
+            # Call is not in the packet trace
+            return True
+
+        client = pkt.ip.dst
+        server = pkt.ip.src
+        index = pkt.record.index
+        pending = []  # State ids waiting for GETFH
+        for op, citem, item, curfh, savedfh in compound_ops(pkt, pkt_call):
+            if getattr(item, "status", 0) != 0:
+                break
+            if op == const.OP_GETFH:
+                for stobj in pending:
+                    self._set_fh(stobj, curfh)
+                pending = []
+            elif op == const.OP_OPEN:
+                if citem.claim.claim in OPEN_BYNAME:
+                    # Open by name, the file handle is given by GETFH
+                    curfh = None
+                stobj = self._new_state(OPEN, item.stateid, client, server, curfh, secs, index)
+                stobj.owner = getattr(citem.owner, "owner", None)
+                stobj.access = citem.access if stobj.access is None else stobj.access | citem.access
+                stobj.deny = citem.deny if stobj.deny is None else stobj.deny | citem.deny
+                pending.append(stobj)
+                delegation = item.delegation
+                if delegation.deleg_type in (const.OPEN_DELEGATE_READ, const.OPEN_DELEGATE_WRITE):
+                    dobj = self._new_state(DELEG, delegation.stateid, client, server, curfh, secs, index)
+                    dobj.deleg_type = delegation.deleg_type
+                    pending.append(dobj)
+            elif op in (const.OP_OPEN_CONFIRM, const.OP_OPEN_DOWNGRADE):
+                stobj = self._update(item.stateid, server)
+                if stobj is not None and op == const.OP_OPEN_DOWNGRADE:
+                    stobj.access = citem.access
+                    stobj.deny = citem.deny
+            elif op == const.OP_CLOSE:
+                self._release(self._update(citem.stateid, server), secs)
+            elif op == const.OP_LOCK:
+                stobj = self._new_state(LOCK, item.stateid, client, server, curfh, secs, index)
+                locker = citem.locker
+                if locker.new_lock_owner:
+                    self._set_parent(stobj, locker.open_owner.stateid.other)
+                    stobj.owner = getattr(locker.open_owner.lock_owner, "owner", None)
+                stobj.segments = _range_remove(stobj.segments, citem.offset, citem.length)
+                stobj.segments.append([citem.locktype, citem.offset, citem.length])
+            elif op == const.OP_LOCKU:
+                stobj = self._update(item.stateid, server)
+                if stobj is not None:
+                    stobj.segments = _range_remove(stobj.segments, citem.offset, citem.length)
+            elif op == const.OP_DELEGRETURN:
+                stobj = self._stmap.get((server, citem.stateid.other))
+                if stobj is not None:
+                    self._returned(stobj, secs)
+                    self._release(stobj, secs)
+            elif op == const.OP_LAYOUTGET:
+                stobj = self._new_state(LAYOUT, item.stateid, client, server, curfh, secs, index)
+                stobj.ltype = citem.type
+                for layout in item.layout:
+                    stobj.segments.append([layout.iomode, layout.offset, layout.length])
+            elif op == const.OP_LAYOUTRETURN:
+                self._layoutreturn(citem, item, client, server, curfh, secs)
+            elif op == const.OP_FREE_STATEID:
+                self._release(self._stmap.get((server, citem.stateid.other)), secs)
+        return True
+
+    def _layoutreturn(self, citem, item, client, server, curfh, secs):
+        """Process the LAYOUTRETURN"""
+        layoutreturn = citem.layoutreturn
+        iomode = citem.iomode
+        if iomode == const.LAYOUTIOMODE4_ANY:
+            match = None
+        else:
+            match = lambda x: x == iomode
+        if layoutreturn.returntype == const.LAYOUTRETURN4_FILE:
+            stobj = self._stmap.get((server, layoutreturn.stateid.other))
+            if stobj is None:
+                return
+            stobjs = [stobj]
+            self._returned(stobj, secs)
+            stobj.segments = _range_remove(stobj.segments, layoutreturn.offset, layoutreturn.length, match)
+            if getattr(item, "present", None) and len(stobj.segments):
+                stobj.seqid = item.stateid.stateid.seqid
+                return
+        else:
+            # All layouts of the client, the file system id is not known
+            # for each layout so all layouts are returned for FSID as well
+            stobjs = self.states(LAYOUT, client=client, server=server, active=True)
+            for stobj in stobjs:
+                self._returned(stobj, secs)
+                stobj.segments = _range_remove(stobj.segments, 0, const.NFS4_UINT64_MAX, match)
+        for stobj in stobjs:
+            if len(stobj.segments) == 0:
+                self._release(stobj, secs)
+
+    def _add_callback(self, pkt, secs):
+        """Process the callbacks sent by the server"""
+        client = pkt.ip.dst
+        server = pkt.ip.src
+        for item in pkt.nfs.array:
+            op = item.op
+            if op == const.OP_CB_RECALL:
+                stobj = self._stmap.get((server, item.stateid.other))
+                self._recall(stobj, secs)
+            elif op == const.OP_CB_LAYOUTRECALL:
+                recall = item.recall
+                if recall.recalltype == const.LAYOUTRECALL4_FILE:
+                    stobj = self._stmap.get((server, recall.stateid.other))
+                    if stobj is None:
+                        slist = self.states(LAYOUT, fh=recall.fh, client=client, server=server, active=True)
+                        stobj = slist[-1] if slist else None
+                    self._recall(stobj, secs)
+                else:
+                    for stobj in self.states(LAYOUT, client=client, server=server, active=True):
+                        self._recall(stobj, secs)
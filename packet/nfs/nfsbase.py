@@ -118,6 +118,82 @@ CBpriority = {
     const4.OP_CB_ILLEGAL              : 0,
 }
 
+# NFSv4 OPEN claims where the file is given by name
+OPEN_BYNAME = (const4.CLAIM_NULL, const4.CLAIM_DELEGATE_CUR, const4.CLAIM_DELEGATE_PREV)
+
+def is_callback(rpc):
+    """Return True if the RPC program is an NFSv4 callback program
+
+       rpc:
+           RPC object (packet.application.rpc.RPC)
+    """
+    return 0x40000000 <= rpc.program < 0x60000000
+
+def has_call(pkt, pkt_call):
+    """Return True if pkt_call is the NFS call of the reply pkt,
+       False if the call is not in the packet trace
+
+       pkt:
+           Packet reply object (packet.pkt.Pkt)
+       pkt_call:
+           Packet call object given by Pktt.pkt_call
+    """
+    return pkt_call is not None and pkt_call == "nfs" and pkt_call.rpc.xid == pkt.rpc.xid
+
+def compound_ops(pkt, pkt_call):
+    """Walk the operations of an NFSv4 COMPOUND keeping track of the
+       current and saved file handles. Yield the tuple
+       (op, citem, item, curfh, savedfh) for every operation where citem
+       is the call operation, item is the result of the operation and
+       curfh and savedfh are the current and saved file handles before
+       the operation is executed or None if not known. For GETFH, curfh
+       is the file handle returned by the operation.
+
+       The walk stops after the first operation failing so the caller
+       must check the status of the item if failed operations are not
+       wanted. It also stops if the call and reply operations do not match.
+
+       pkt:
+           Packet reply object (packet.pkt.Pkt), if this is None only
+           the call is walked and item is None for every operation
+       pkt_call:
+           Packet call object, if this is None the call is not in the
+           packet trace so citem is None for every operation and the file
+           handles given by the call (PUTFH) are not known
+    """
+    callops = [] if pkt_call is None else pkt_call.nfs.array
+    resops = callops if pkt is None else pkt.nfs.array
+    curfh = None
+    savedfh = None
+    for idx, item in enumerate(resops):
+        citem = callops[idx] if idx < len(callops) else None
+        if pkt is None:
+            item = None
+            op = citem.op
+        else:
+            op = item.op
+            if pkt_call is not None and (citem is None or citem.op != op):
+                break
+        status = getattr(item, "status", 0)
+        if op == const4.OP_GETFH and item is not None and status == 0:
+            curfh = item.fh
+        yield (op, citem, item, curfh, savedfh)
+        if status != 0:
+            break
+        if op == const4.OP_PUTFH:
+            curfh = getattr(citem, "fh", None)
+        elif op in (const4.OP_PUTROOTFH, const4.OP_PUTPUBFH, const4.OP_LOOKUP,
+                    const4.OP_LOOKUPP, const4.OP_CREATE):
+            curfh = None
+        elif op == const4.OP_OPEN:
+            if citem is None or citem.claim.claim in OPEN_BYNAME:
+                # Open by name, the file handle is given by GETFH
+                curfh = None
+        elif op == const4.OP_SAVEFH:
+            savedfh = curfh
+        elif op == const4.OP_RESTOREFH:
+            curfh = savedfh
+
 class NFSbase(utils.RPCload):
     """NFS Base object
 
@@ -130,7 +206,7 @@ class NFSbase(utils.RPCload):
         if rdebug == 1:
             # String format for verbose level 1
             out = self.rpc_str("NFS")
-            if rpc.program >= 0x40000000 and rpc.program < 0x60000000:
+            if is_callback(rpc):
                 cb_flag  = True
                 priority = CBpriority
             else:
@@ -175,6 +251,48 @@ class NFSbase(utils.RPCload):
         else:
             return BaseObj.__str__(self)
 
+    def main_op(self):
+        """Return the main operation of the NFSv4 COMPOUND or CB_COMPOUND,
+           this is the operation having the highest priority. None is
+           returned if this is not a COMPOUND
+        """
+        array = getattr(self, "array", None)
+        if not array:
+            return None
+        rpc = self._rpc
+        if is_callback(rpc):
+            priority = CBpriority
+        else:
+            priority = NFSpriority
+        return sorted(array, key=lambda x: priority.get(x.op, 0))[-1].op
+
+def nfs_opinfo(pkt):
+    """Return the tuple (version, opname, item) for the given NFS packet
+       where version is the NFS version string, e.g., "NFSv4.1", opname
+       is the operation name and item is the object having the operation
+       arguments or results: the main operation of the NFSv4 COMPOUND
+       or the NFS object itself for NFSv3 and below
+    """
+    nfs = pkt.nfs
+    rpc = pkt.rpc
+    version = "NFSv%d" % rpc.version
+    minorversion = getattr(nfs, "minorversion", None)
+    if minorversion is not None:
+        version += ".%d" % minorversion
+    if rpc.procedure == 0:
+        return (version, "NULL", None)
+    if hasattr(nfs, "array"):
+        # NFSv4 COMPOUND main operation
+        mainop = nfs.main_op()
+        for item in nfs.array:
+            if item.op == mainop:
+                return (version, str(mainop)[3:], item)
+        return (version, str(mainop)[3:], None)
+    opname = str(getattr(nfs, "op", rpc.procedure))
+    if opname.startswith("NFSPROC3_"):
+        opname = opname[9:]
+    return (version, opname, nfs)
+
 class NULL(NFSbase):
     """NFS NULL object"""
     pass
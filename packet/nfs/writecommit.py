@@ -0,0 +1,339 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+NFSv3 WRITE/COMMIT efficiency module
+
+Follow the NFSv3 WRITE and COMMIT replies matched to their calls in a single
+pass over the packet trace and for each file and for each client count:
+    - The WRITE operations and bytes for each stable_how requested by
+      the client (UNSTABLE, DATA_SYNC and FILE_SYNC)
+    - The COMMIT operations and the bytes committed by each COMMIT, these
+      are the bytes of the writes still uncommitted by the server which
+      are within the COMMIT range
+    - The time from the reply of each uncommitted WRITE to the reply of
+      the COMMIT which commits it
+    - The write verifier changes and the bytes the client must send again
+      because the verifier returned by the COMMIT is not the verifier
+      returned when the data was written
+
+Files are identified by the CRC32 of the file handle. The uncommitted
+writes are kept for each client and file until they are committed so the
+memory used depends on the amount of data written between COMMITs.
+"""
+import nfstest_config as c
+from baseobj import BaseObj
+from formatstr import crc32
+from packet.stats import Histogram
+import packet.nfs.nfs3_const as const3
+from packet.nfs.nfsbase import has_call
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Per file and per client counters, the first three entries are the
+# number of writes for each stable_how, followed by the bytes for each:
+# [unstable, data_sync, file_sync, ubytes, dbytes, fbytes, commits,
+#  cbytes, empty, w2ctime, w2ccount, vchanges, resent]
+_WRITES   = 0
+_WBYTES   = 3
+_COMMITS  = 6
+_CBYTES   = 7
+_EMPTY    = 8
+_W2CTIME  = 9
+_W2CCOUNT = 10
+_VCHANGES = 11
+_RESENT   = 12
+_NCOUNTS  = 13
+
+# Uncommitted write: [secs, offset, end, count, verifier]
+_SECS   = 0
+_OFFSET = 1
+_END    = 2
+_COUNT  = 3
+_VERF   = 4
+
+class WriteCommit(BaseObj):
+    """NFSv3 WRITE/COMMIT efficiency object
+
+       Usage:
+           from packet.pktt import Pktt
+           from packet.nfs.writecommit import WriteCommit
+
+           x = Pktt("/traces/tracefile.cap")
+           wc = WriteCommit()
+           for pkt in x:
+               wc.add(pkt, x.pkt_call)
+
+           # Summary for all files
+           info = wc.summary()
+
+           # Clients writing the most bytes
+           for key in wc.top(10, clients=True):
+               info = wc.summary(key, clients=True)
+
+       Object definition:
+
+       WriteCommit(
+           writes   = int, # Number of WRITE replies
+           commits  = int, # Number of COMMIT replies
+           vchanges = int, # Number of write verifier changes
+       )
+    """
+    # Class attributes
+    _attrlist = ("writes", "commits", "vchanges")
+
+    def __init__(self, precision=0.01):
+        """Constructor
+
+           precision:
+               Relative error of the write to commit time percentiles
+               [default: 0.01]
+        """
+        self.writes   = 0
+        self.commits  = 0
+        self.vchanges = 0
+        # Per file and per client counters
+        self._files   = {}
+        self._clients = {}
+        # Uncommitted writes: (client, file) => list of writes
+        self._pending = {}
+        # Last write verifier for each server
+        self._verf = {}
+        # Write to commit times for all files
+        self._hist = Histogram(precision)
+
+    def _get_stats(self, table, key):
+        """Return the counters for the given file or client"""
+        stats = table.get(key)
+        if stats is None:
+            stats = [0] * _NCOUNTS
+            stats[_W2CTIME] = 0.0
+            table[key] = stats
+        return stats
+
+    def _verifier(self, server, verifier, slist):
+        """Check if the write verifier has changed for the server"""
+        old = self._verf.get(server)
+        if old != verifier:
+            self._verf[server] = verifier
+            if old is not None:
+                self.vchanges += 1
+                for stats in slist:
+                    stats[_VCHANGES] += 1
+
+    def write(self, secs, client, server, fh, offset, count, stable, committed, verifier):
+        """Add a WRITE reply
+
+           secs:
+               Time of the WRITE reply
+           client, server:
+               Client and server IP addresses
+           fh:
+               File handle
+           offset:
+               WRITE offset
+           count:
+               Number of bytes written as returned by the server
+           stable:
+               The stable_how requested by the client
+           committed:
+               The stable_how returned by the server
+           verifier:
+               Write verifier returned by the server
+        """
+        fkey = crc32(fh)
+        slist = (self._get_stats(self._files, fkey), self._get_stats(self._clients, client))
+        self.writes += 1
+        for stats in slist:
+            stats[_WRITES + stable] += 1
+            stats[_WBYTES + stable] += count
+        self._verifier(server, verifier, slist)
+        if committed == const3.UNSTABLE and count > 0:
+            pending = self._pending.setdefault((client, fkey), [])
+            pending.append([secs, offset, offset + count, count, verifier])
+
+    def commit(self, secs, client, server, fh, offset, count, verifier):
+        """Add a COMMIT reply
+
+           secs:
+               Time of the COMMIT reply
+           client, server:
+               Client and server IP addresses
+           fh:
+               File handle
+           offset, count:
+               COMMIT range, count of zero is to the end of the file
+           verifier:
+               Write verifier returned by the server
+        """
+        fkey = crc32(fh)
+        slist = (self._get_stats(self._files, fkey), self._get_stats(self._clients, client))
+        self.commits += 1
+        self._verifier(server, verifier, slist)
+        end = offset + count if count else None
+        pkey = (client, fkey)
+        pending = self._pending.get(pkey, [])
+        remaining = []
+        cbytes = 0
+        resent = 0
+        w2ctime = 0.0
+        w2ccount = 0
+        for item in pending:
+            if item[_END] <= offset or (end is not None and item[_OFFSET] >= end):
+                # Write is outside the COMMIT range
+                remaining.append(item)
+            elif item[_VERF] != verifier:
+                # Server lost the data, the client must send it again
+                resent += item[_COUNT]
+            else:
+                delta = max(secs - item[_SECS], 0.0)
+                cbytes += item[_COUNT]
+                w2ctime += delta
+                w2ccount += 1
+                self._hist.add(delta)
+        if remaining:
+            self._pending[pkey] = remaining
+        else:
+            self._pending.pop(pkey, None)
+        for stats in slist:
+            stats[_COMMITS] += 1
+            stats[_CBYTES] += cbytes
+            stats[_RESENT] += resent
+            stats[_W2CTIME] += w2ctime
+            stats[_W2CCOUNT] += w2ccount
+            if cbytes == 0 and resent == 0:
+                stats[_EMPTY] += 1
+
+    def add(self, pkt, pkt_call=None):
+        """Add the NFSv3 WRITE or COMMIT reply
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Packet call object if pkt is a reply [default: None]
+        """
+        if pkt != "nfs" or pkt.rpc.type != 1 or pkt.nfs.status != const3.NFS3_OK:
+            return
+        if not has_call(pkt, pkt_call):
+            # Call is not in the packet trace
+            return
+        rpc = pkt_call.rpc
+        if rpc.program != 100003 or rpc.version != 3:
+            return
+        args = pkt_call.nfs
+        res = pkt.nfs
+        client = pkt_call.ip.src if pkt_call.ip is not None else None
+        server = pkt_call.ip.dst if pkt_call.ip is not None else None
+        if rpc.procedure == const3.NFSPROC3_WRITE:
+            self.write(pkt.record.secs, client, server, args.fh, args.offset,
+                       res.count, args.stable, res.committed, res.verifier)
+        elif rpc.procedure == const3.NFSPROC3_COMMIT:
+            self.commit(pkt.record.secs, client, server, args.fh, args.offset,
+                        args.count, res.verifier)
+
+    def keys(self, clients=False):
+        """Return the list of file keys (CRC32 of the file handle) or the
+           list of clients if clients is True
+        """
+        table = self._clients if clients else self._files
+        return table.keys()
+
+    def top(self, count, clients=False):
+        """Return the list of file keys or clients having the most bytes
+           written
+
+           count:
+               Number of keys to return
+           clients:
+               Return the clients instead of the file keys [default: False]
+        """
+        table = self._clients if clients else self._files
+        func = lambda x: sum(x[_WBYTES:_WBYTES+3])
+        items = sorted(table.iteritems(), key=lambda x: func(x[1]), reverse=True)
+        return [x[0] for x in items[:count]]
+
+    def summary(self, key=None, clients=False):
+        """Return a dictionary with the WRITE/COMMIT efficiency of the given
+           file or client or for all files if no key is given:
+               unstable, data_sync, file_sync:
+                   Number of WRITE operations for each stable_how requested
+               ubytes, dbytes, fbytes:
+                   Number of bytes written for each stable_how requested
+               writes, wbytes:
+                   Total number of WRITE operations and bytes
+               commits:
+                   Number of COMMIT operations
+               cbytes:
+                   Number of bytes committed by all COMMIT operations
+               bytes_per_commit:
+                   Average number of bytes committed by each COMMIT
+               empty:
+                   Number of COMMIT operations not committing any data
+                   written in the packet trace
+               w2ctime:
+                   Average time from the WRITE to the COMMIT
+               vchanges:
+                   Number of write verifier changes
+               resent:
+                   Number of bytes which must be written again because
+                   of a write verifier change
+               pending:
+                   Number of bytes still uncommitted at the end of the
+                   packet trace
+               hist:
+                   Histogram of the write to commit times (all files only)
+
+           key:
+               File key or client [default: None]
+           clients:
+               The key is a client [default: False]
+        """
+        table = self._clients if clients else self._files
+        if key is not None:
+            slist = [table[key]]
+        else:
+            slist = table.itervalues()
+        counts = [0] * _NCOUNTS
+        for stats in slist:
+            for idx, value in enumerate(stats):
+                counts[idx] += value
+        info = {
+            "unstable":  counts[_WRITES + const3.UNSTABLE],
+            "data_sync": counts[_WRITES + const3.DATA_SYNC],
+            "file_sync": counts[_WRITES + const3.FILE_SYNC],
+            "ubytes":    counts[_WBYTES + const3.UNSTABLE],
+            "dbytes":    counts[_WBYTES + const3.DATA_SYNC],
+            "fbytes":    counts[_WBYTES + const3.FILE_SYNC],
+            "writes":    sum(counts[_WRITES:_WRITES+3]),
+            "wbytes":    sum(counts[_WBYTES:_WBYTES+3]),
+            "commits":   counts[_COMMITS],
+            "cbytes":    counts[_CBYTES],
+            "empty":     counts[_EMPTY],
+            "vchanges":  counts[_VCHANGES],
+            "resent":    counts[_RESENT],
+        }
+        info["bytes_per_commit"] = float(info["cbytes"]) / info["commits"] if info["commits"] else None
+        info["w2ctime"] = counts[_W2CTIME] / counts[_W2CCOUNT] if counts[_W2CCOUNT] else None
+
+        pending = 0
+        for (client, fkey), plist in self._pending.iteritems():
+            if key is None or (clients and client == key) or (not clients and fkey == key):
+                pending += sum([x[_COUNT] for x in plist])
+        info["pending"] = pending
+        if key is None:
+            info["hist"] = self._hist
+        return info
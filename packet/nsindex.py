@@ -0,0 +1,515 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Namespace index module
+
+Build an index of the NFS namespace seen in a packet trace in a single pass
+so a path could be resolved to its file handle and all packets for a file
+could be found using dictionary lookups instead of matching the whole packet
+trace once for every path component, file handle and state id.
+
+The index records:
+    name => file handle edges given by LOOKUP, OPEN, CREATE, LINK and
+    READDIR (NFSv4 and NFSv3 READDIRPLUS) where the edge is keyed by the
+    directory file handle
+    file handle => state ids given by OPEN (including delegations), LOCK
+    and LAYOUTGET
+    file handle => layout file handles given by LAYOUTGET
+    RENAME edges mapping a directory file handle and name to the new
+    directory file handle and name
+    The list of packets for every file handle, state id and name
+
+File handles are saved as their crc32 and state ids as the crc16 of their
+"other" field, the same values displayed in the packet trace. Packets are
+referenced by their location in the packet trace so only the packets
+needed could be decoded again, see packet.pktdb.seek_packets().
+"""
+import bisect
+import nfstest_config as c
+from baseobj import BaseObj
+from formatstr import crc32, crc16
+import packet.nfs.nfs3_const as nfs3
+import packet.nfs.nfs4_const as nfs4
+from packet.nfs.nfsbase import has_call, compound_ops
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# NFSv3 procedures returning the file handle of the given name
+_NFS3_NAMEPROCS = (
+    nfs3.NFSPROC3_LOOKUP,
+    nfs3.NFSPROC3_CREATE,
+    nfs3.NFSPROC3_MKDIR,
+    nfs3.NFSPROC3_SYMLINK,
+    nfs3.NFSPROC3_MKNOD,
+)
+
+# NFSv4 operations changing the current file handle to the given name
+_NFS4_NAMEOPS = (nfs4.OP_LOOKUP, nfs4.OP_OPEN, nfs4.OP_CREATE)
+
+def _stid(stateid):
+    """Return the crc16 of the given state id"""
+    return crc16(getattr(stateid, "other", str(stateid)))
+
+def _fhkey(fh):
+    """Return the crc32 of the given file handle or None if not known"""
+    return crc32(fh) if fh is not None else None
+
+def _entries(item):
+    """Return the list of directory entries of a READDIR reply"""
+    entries = getattr(item, "entries", None)
+    if entries is None:
+        entries = getattr(getattr(item, "reply", None), "entries", None)
+    return entries if entries else []
+
+class NSIndex(BaseObj):
+    """Namespace index object
+
+       Usage:
+           from packet.pktt import Pktt
+           from packet.nsindex import NSIndex
+           from packet.pktdb import seek_packets
+
+           x = Pktt("/traces/tracefile.cap")
+           ns = NSIndex()
+           for pkt in x:
+               ns.add(pkt, x.pkt_call, x.tfile)
+
+           # Get the file handle of "dir1/file1"
+           pktlist, dirfh, start = ns.lookup("dir1")
+           pktlist, fh, start = ns.lookup("file1", dirfh, start)
+
+           # Display all packets for the file
+           fhs, stids = ns.file_keys([fh])
+           for pkttobj in seek_packets(ns.packets(fhs, stids, start=start)):
+               print pkttobj.pkt
+
+       Object definition:
+
+       NSIndex(
+           count = int, # Number of RPC packets indexed
+       )
+    """
+    # Class attributes
+    _attrlist = ("count",)
+
+    def __init__(self):
+        """Constructor"""
+        self.count = 0
+        # Packet locations (pindex, tfile, frame, sframe, xid, type)
+        self._locs = []
+        # Call position => reply position and vice versa
+        self._reply = {}
+        self._call  = {}
+        # Outstanding calls: (tfile, xid) => call position
+        self._xids = {}
+        # Packet positions for every file handle, state id and
+        # name: {name: {dirfh: [position, ...]}}
+        self._fhpkts = {}
+        self._stidpkts = {}
+        self._namepkts = {}
+        # Edges: (call position, name) => fh
+        self._edges = {}
+        # READDIR entries: {name: {dirfh: [(reply position, fh), ...]}}
+        self._dirents = {}
+        # RENAME edges: (dirfh, name) => [(reply position, dirfh, newname), ...]
+        self._renames = {}
+        # File handle => set of state ids and set of layout file handles
+        self._stids = {}
+        self._layouts = {}
+
+    def __len__(self):
+        """Number of RPC packets indexed"""
+        return self.count
+
+    def location(self, pos):
+        """Return the location of the packet at the given position
+           (pindex, tfile, frame, sframe, xid, type)
+        """
+        return self._locs[pos]
+
+    def add(self, pkt, pkt_call=None, tfile=None):
+        """Add the given packet to the index, returns True if the packet
+           is an RPC packet
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Packet call object if pkt is a reply [default: None]
+           tfile:
+               Trace file where the packet is located [default: None]
+        """
+        rpc = pkt.rpc
+        if rpc is None:
+            return False
+        record = pkt.record
+        frame = record.frame
+        # Frame where decoding must start to get this packet
+        sframe = getattr(pkt.tcp, "rpc_frame", frame)
+        pos = len(self._locs)
+        self._locs.append((record.index, tfile, frame, sframe, int(rpc.xid), rpc.type))
+        self.count += 1
+
+        xkey = (tfile, int(rpc.xid))
+        if rpc.type == 0:
+            # RPC call
+            self._xids[xkey] = pos
+            if pkt == "nfs":
+                self._add_call(pos, pkt)
+            elif pkt == "nlm":
+                fh = getattr(pkt.nlm, "fh", None)
+                if fh is not None:
+                    self._add_key(self._fhpkts, crc32(fh), pos)
+            return True
+
+        # RPC reply
+        cpos = self._xids.pop(xkey, None)
+        if cpos is not None:
+            self._reply[cpos] = pos
+            self._call[pos] = cpos
+        if pkt == "nfs":
+            if not has_call(pkt, pkt_call):
+                # Call is not in the packet trace
+                pkt_call = None
+            self._add_reply(pos, cpos, pkt, pkt_call)
+        return True
+
+    @staticmethod
+    def _add_key(keymap, key, pos):
+        """Add packet position to the list of the given key"""
+        plist = keymap.setdefault(key, [])
+        if not plist or plist[-1] != pos:
+            plist.append(pos)
+
+    def _add_name(self, dirfh, name, pos):
+        """Add name packet"""
+        self._add_key(self._namepkts.setdefault(str(name), {}), dirfh, pos)
+
+    def _add_op(self, item, pos):
+        """Add the file handle and state ids of the given operation"""
+        fh = getattr(item, "fh", None)
+        if fh is not None:
+            self._add_key(self._fhpkts, crc32(fh), pos)
+        stateid = getattr(item, "stateid", None)
+        if stateid is not None:
+            self._add_key(self._stidpkts, _stid(stateid), pos)
+        for stateid in getattr(item, "stateids", None) or []:
+            # TEST_STATEID
+            self._add_key(self._stidpkts, _stid(stateid), pos)
+
+    def _add_call(self, pos, pkt):
+        """Add the file handles, state ids and names of an NFS call"""
+        nfs = pkt.nfs
+        oplist = getattr(nfs, "array", None)
+        if oplist is None:
+            # NFSv3 and below
+            self._add_op(nfs, pos)
+            name = getattr(nfs, "name", None)
+            if name is not None:
+                dirfh = getattr(getattr(nfs, "link", None), "fh", getattr(nfs, "fh", None))
+                self._add_name(crc32(dirfh) if dirfh is not None else None, name, pos)
+            return
+
+        # NFSv4 COMPOUND: keep track of the current and saved file handles
+        for op, item, res, curfh, savedfh in compound_ops(None, pkt):
+            self._add_op(item, pos)
+            if op == nfs4.OP_RENAME:
+                self._add_name(_fhkey(savedfh), item.name, pos)
+            elif getattr(item, "name", None) is not None:
+                self._add_name(_fhkey(curfh), item.name, pos)
+
+    def _add_reply(self, pos, cpos, pkt, pkt_call):
+        """Add the file handles, state ids and edges of an NFS reply"""
+        nfs = pkt.nfs
+        resops = getattr(nfs, "array", None)
+        if resops is None:
+            # NFSv3 and below
+            self._add_op(nfs, pos)
+            if pkt_call is None or getattr(nfs, "status", None) != 0:
+                return
+            cnfs = pkt_call.nfs
+            proc = pkt.rpc.procedure
+            cfh = getattr(cnfs, "fh", None)
+            if proc in _NFS3_NAMEPROCS:
+                fh = getattr(nfs, "fh", None)
+                if fh is not None:
+                    self._edges[(cpos, str(cnfs.name))] = crc32(fh)
+            elif proc == nfs3.NFSPROC3_LINK:
+                self._edges[(cpos, str(cnfs.name))] = crc32(cfh)
+            elif proc == nfs3.NFSPROC3_RENAME:
+                key = (crc32(cfh), str(cnfs.name))
+                self._renames.setdefault(key, []).append((pos, crc32(cnfs.nto.fh), str(cnfs.newname)))
+            elif proc == nfs3.NFSPROC3_READDIRPLUS and cfh is not None:
+                for entry in _entries(nfs):
+                    fh = getattr(entry, "fh", None)
+                    if fh is not None:
+                        self._add_dirent(crc32(cfh), entry.name, crc32(fh), pos)
+            return
+
+        # NFSv4 COMPOUND: walk the call and reply operations together
+        for item in resops:
+            self._add_op(item, pos)
+        if pkt_call is not None and not hasattr(pkt_call.nfs, "array"):
+            pkt_call = None
+        pending = None  # Edge (call position, name) waiting for GETFH
+        stids = []      # State ids waiting for GETFH
+        for op, citem, item, curfh, savedfh in compound_ops(pkt, pkt_call):
+            if getattr(item, "status", 0) != 0:
+                break
+            if op == nfs4.OP_GETFH:
+                fhkey = crc32(curfh)
+                if pending is not None:
+                    self._edges[pending] = fhkey
+                    pending = None
+                for stid in stids:
+                    self._stids.setdefault(fhkey, set()).add(stid)
+                stids = []
+            elif op in _NFS4_NAMEOPS:
+                name = getattr(citem, "name", None)
+                pending = (cpos, str(name)) if name is not None else None
+                if op == nfs4.OP_OPEN:
+                    stids.append(_stid(item.stateid))
+                    delegation = getattr(item, "delegation", None)
+                    if getattr(delegation, "deleg_type", None) in (nfs4.OPEN_DELEGATE_READ, nfs4.OPEN_DELEGATE_WRITE):
+                        stids.append(_stid(delegation.stateid))
+                        self._add_key(self._stidpkts, stids[-1], pos)
+                    if name is None and curfh is not None:
+                        # Open by file handle
+                        for stid in stids:
+                            self._stids.setdefault(crc32(curfh), set()).add(stid)
+                        stids = []
+            elif op == nfs4.OP_LINK and citem is not None and savedfh is not None:
+                self._edges[(cpos, str(citem.name))] = crc32(savedfh)
+            elif op == nfs4.OP_RENAME and citem is not None:
+                key = (_fhkey(savedfh), str(citem.name))
+                self._renames.setdefault(key, []).append((pos, _fhkey(curfh), str(citem.newname)))
+            elif curfh is None:
+                continue
+            elif op == nfs4.OP_READDIR:
+                for entry in _entries(item):
+                    fh = getattr(entry, "attrs", {}).get(nfs4.FATTR4_FILEHANDLE)
+                    if fh is not None:
+                        self._add_dirent(crc32(curfh), entry.name, crc32(fh), pos)
+            elif op == nfs4.OP_LOCK:
+                self._stids.setdefault(crc32(curfh), set()).add(_stid(item.stateid))
+            elif op == nfs4.OP_LAYOUTGET:
+                fhkey = crc32(curfh)
+                self._stids.setdefault(fhkey, set()).add(_stid(item.stateid))
+                for layout in getattr(item, "layout", []):
+                    body = getattr(getattr(layout, "content", None), "body", None)
+                    for fh in getattr(body, "fh_list", []):
+                        self._layouts.setdefault(fhkey, set()).add(crc32(fh))
+
+    def _add_dirent(self, dirfh, name, fh, pos):
+        """Add READDIR entry"""
+        dmap = self._dirents.setdefault(str(name), {})
+        dmap.setdefault(dirfh, []).append((pos, fh))
+
+    def _name_positions(self, name, dirfh=None):
+        """Return the sorted list of call positions for the given name,
+           if dirfh is None the name is searched in all directories
+        """
+        dmap = self._namepkts.get(name, {})
+        if dirfh is not None:
+            return dmap.get(dirfh, [])
+        return sorted(set(pos for plist in dmap.values() for pos in plist))
+
+    def lookup(self, name, dirfh=None, start=-1, end=None):
+        """Resolve the name to its file handle, returns a tuple
+           (pktlist, fh, position) where pktlist is the list of packet
+           positions (calls and their replies) for the name up to the
+           first successful reply, fh is the file handle given by the
+           successful reply or None if the name is not resolved and
+           position is the position of the last packet in pktlist.
+           If there is no packet resolving the name, the first READDIR
+           reply having the name is used instead.
+
+           name:
+               Name to resolve
+           dirfh:
+               File handle (crc32) of the directory where the name is
+               searched, search in all directories if None [default: None]
+           start:
+               Search packets after this position [default: -1]
+           end:
+               Search packets before this position [default: None]
+        """
+        name = str(name)
+        pktlist = []
+        last = start
+        for pos in self._name_positions(name, dirfh):
+            if pos <= start:
+                continue
+            if end is not None and pos >= end:
+                break
+            pktlist.append(pos)
+            last = pos
+            rpos = self._reply.get(pos)
+            if rpos is not None and (end is None or rpos < end):
+                pktlist.append(rpos)
+                last = rpos
+                fh = self._edges.get((pos, name))
+                if fh is not None:
+                    return (pktlist, fh, rpos)
+
+        # Name was not resolved, use the directory entries
+        dmap = self._dirents.get(name, {})
+        if dirfh is not None:
+            entries = dmap.get(dirfh, [])
+        else:
+            entries = sorted(x for elist in dmap.values() for x in elist)
+        for rpos, fh in entries:
+            if rpos > start and (end is None or rpos < end):
+                cpos = self._call.get(rpos)
+                return ([x for x in (cpos, rpos) if x is not None], fh, rpos)
+        return (pktlist, None, last)
+
+    def dirfh(self, name, pos):
+        """Return the file handle (crc32) of the directory where the name
+           is located for the packet at the given position, as returned
+           by lookup(), or None if the directory is not known
+
+           name:
+               Name of file
+           pos:
+               Position of the call or reply having the name, or the
+               position of the READDIR reply having the name
+        """
+        name = str(name)
+        cpos = self._call.get(pos, pos)
+        for dirfh, plist in self._namepkts.get(name, {}).items():
+            idx = bisect.bisect_left(plist, cpos)
+            if idx < len(plist) and plist[idx] == cpos:
+                return dirfh
+        for dirfh, elist in self._dirents.get(name, {}).items():
+            if pos in (x[0] for x in elist):
+                return dirfh
+        return None
+
+    def renames(self, dirfh, name, start=-1):
+        """Return the list of (dirfh, name) the given name is renamed to,
+           including the given name as the first item
+
+           dirfh:
+               File handle (crc32) of the directory where the name is
+               located, search in all directories if None
+           name:
+               Name of file
+           start:
+               Only include renames after this position [default: -1]
+        """
+        ret = [(dirfh, str(name))]
+        seen = set(ret)
+        idx = 0
+        while idx < len(ret):
+            key = ret[idx]
+            idx += 1
+            if key[0] is None:
+                items = [x for k, v in self._renames.items() if k[1] == key[1] for x in v]
+            else:
+                items = self._renames.get(key, [])
+            for pos, ndirfh, newname in items:
+                item = (ndirfh, newname)
+                if pos > start and item not in seen:
+                    seen.add(item)
+                    ret.append(item)
+        return ret
+
+    def file_keys(self, fhs, stids=()):
+        """Return a tuple (fhs, stids) having all the file handles and
+           state ids for the given file handles: the state ids of every
+           file handle and the file handles of their layouts
+
+           fhs:
+               List of file handles (crc32)
+           stids:
+               List of state ids (crc16) [default: ()]
+        """
+        fhset = set()
+        todo = list(fhs)
+        while todo:
+            fh = todo.pop()
+            if fh in fhset:
+                continue
+            fhset.add(fh)
+            todo.extend(self._layouts.get(fh, []))
+        stidset = set(stids)
+        for fh in fhset:
+            stidset.update(self._stids.get(fh, []))
+        return (fhset, stidset)
+
+    def packets(self, fhs=(), stids=(), names=(), start=-1, end=None, pktlist=None):
+        """Return the list of packet locations for all packets having any
+           of the given file handles, state ids or names. The replies of
+           all matched calls are included and the call is included right
+           before a matched reply if the call was not matched. Each item
+           in the list is a tuple (pindex, isreply, tfile, frame, sframe,
+           xid, type) as expected by packet.pktdb.seek_packets() where
+           isreply is True if the packet is not matched by itself.
+
+           fhs:
+               List of file handles (crc32) [default: ()]
+           stids:
+               List of state ids (crc16) [default: ()]
+           names:
+               List of (dirfh, name) where dirfh could be None to match
+               the name in all directories [default: ()]
+           start:
+               Include packets after this position [default: -1]
+           end:
+               Include packets before this position [default: None]
+           pktlist:
+               Return the locations of the given packet positions instead,
+               all other arguments are ignored [default: None]
+        """
+        if pktlist is None:
+            matched = set()
+            for fh in fhs:
+                matched.update(self._fhpkts.get(fh, []))
+            for stid in stids:
+                matched.update(self._stidpkts.get(stid, []))
+            for dirfh, name in names:
+                matched.update(self._name_positions(name, dirfh))
+            matched = set(x for x in matched if x > start and (end is None or x < end))
+            pktlist = set(matched)
+            for pos in matched:
+                rpos = self._reply.get(pos)
+                if rpos is not None and (end is None or rpos < end):
+                    pktlist.add(rpos)
+            pktlist = sorted(pktlist)
+        else:
+            matched = set(pktlist)
+
+        ret = []
+        for pos in pktlist:
+            cpos = self._call.get(pos)
+            if cpos is not None and cpos not in matched and pos in matched:
+                # Display the call right before the matched reply
+                ret.append(self._entry(cpos, True))
+            ret.append(self._entry(pos, pos not in matched))
+        return ret
+
+    def _entry(self, pos, isreply):
+        """Return the location of the packet at the given position"""
+        pindex, tfile, frame, sframe, xid, rtype = self._locs[pos]
+        cpos = self._call.get(pos)
+        if cpos is not None:
+            # The reply is decoded using its call so start at the call
+            cloc = self._locs[cpos]
+            if cloc[1] == tfile:
+                sframe = min(sframe, cloc[3])
+        return (pindex, isreply, tfile, frame, sframe, xid, rtype)
@@ -0,0 +1,326 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Pcap record header scanner module
+
+Walk the record headers of a tcpdump trace file without decoding any of
+the packets. The file offset, timestamp and lengths of every record are
+returned as NumPy arrays so header level statistics like the total number
+of packets, bytes over time, capture gaps and truncation rate can be
+computed in a fraction of the time it takes to decode the trace file.
+If NumPy is not available the arrays are returned as array.array objects
+and the statistics are computed in pure python.
+"""
+import gzip
+import mmap
+import time
+import array
+import struct
+from formatstr import *
+import nfstest_config as c
+from baseobj import BaseObj
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Read size used when the file cannot be mapped into memory
+READ_SIZE = 1024*1024
+
+def open_trace(tfile):
+    """Open the tcpdump trace file and return a tuple (fh, header_rec, iszip)
+       where fh is the open file handle positioned at the first record,
+       header_rec is the struct format of the record header and iszip
+       is True if the file is gzip compressed.
+    """
+    iszip = False
+    fh = open(tfile, 'rb')
+    ident = fh.read(4)
+    if ident not in ('\324\303\262\241', '\241\262\303\324'):
+        # Try if this is a gzip compress file
+        fh.close()
+        iszip = True
+        fh = gzip.open(tfile, 'rb')
+        try:
+            ident = fh.read(4)
+        except IOError:
+            ident = ""
+    if ident == '\324\303\262\241':
+        # Little endian
+        header_rec = '<IIII'
+    elif ident == '\241\262\303\324':
+        # Big endian
+        header_rec = '>IIII'
+    else:
+        fh.close()
+        raise Exception('Not a tcpdump file')
+    # Skip rest of global header
+    fh.read(20)
+    return (fh, header_rec, iszip)
+
+def walk_records(fh, offset, header_rec, use_mmap=False):
+    """Generator to walk the record headers of the trace file starting at
+       the given offset, it yields a tuple for every record:
+           (offset, ts_sec, ts_usec, incl_len, orig_len)
+
+       A truncated record at the end of the file is not included.
+
+       fh:
+           Open file handle of trace file
+       offset:
+           File offset of first record
+       header_rec:
+           Struct format of the record header, e.g., '<IIII'
+       use_mmap:
+           Map the file into memory instead of reading it, this is not
+           possible for compressed files [default: False]
+    """
+    unpack_from = struct.Struct(header_rec).unpack_from
+    mm = None
+    if use_mmap and not isinstance(fh, gzip.GzipFile):
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Unable to map file, e.g., file is empty
+            mm = None
+
+    if mm is not None:
+        try:
+            size = len(mm)
+            while offset + 16 <= size:
+                ulist = unpack_from(mm, offset)
+                nextoff = offset + 16 + ulist[2]
+                if nextoff > size:
+                    break
+                yield (offset,) + ulist
+                offset = nextoff
+        finally:
+            mm.close()
+        return
+
+    fh.seek(offset)
+    data = ""
+    pos  = 0
+    while True:
+        if len(data) - pos < 16:
+            data = data[pos:] + fh.read(READ_SIZE)
+            pos  = 0
+            if len(data) < 16:
+                break
+        ulist = unpack_from(data, pos)
+        size = 16 + ulist[2]
+        pos += size
+        if pos > len(data):
+            # Skip the rest of the record data not in the buffer
+            skip = pos - len(data)
+            if len(fh.read(skip)) < skip:
+                break
+            data = ""
+            pos  = 0
+        yield (offset,) + ulist
+        offset += size
+
+class PcapScan(BaseObj):
+    """Pcap record header scan object
+
+       Usage:
+           from packet.pcapscan import PcapScan
+
+           x = PcapScan("/traces/tracefile.cap")
+
+           # Number of packets in trace file
+           npkts = x.count
+
+           # Timestamp of all packets
+           secs = x.secs()
+
+           # Display header level summary
+           print x.summary()
+
+       Object definition:
+
+       PcapScan(
+           tfile    = string, # Trace file name
+           count    = int,    # Number of records
+           offset   = array,  # File offset of each record
+           ts_sec   = array,  # Seconds of each record
+           ts_usec  = array,  # Microseconds of each record
+           incl_len = array,  # Number of bytes included in trace
+           orig_len = array,  # Number of bytes in packet
+       )
+    """
+    # Class attributes
+    _attrlist = ("tfile", "count", "offset", "ts_sec", "ts_usec",
+                 "incl_len", "orig_len")
+
+    def __init__(self, tfile, use_mmap=True):
+        """Constructor
+
+           Walk all record headers on the trace file and save the offset,
+           timestamps and lengths of each record.
+
+           tfile:
+               Name of tcpdump trace file (little or big endian format),
+               the file could be gzip compressed
+           use_mmap:
+               Map the file into memory instead of reading it, compressed
+               files are always read [default: True]
+        """
+        self.tfile = tfile
+        offset   = array.array('L')
+        ts_sec   = array.array('I')
+        ts_usec  = array.array('I')
+        incl_len = array.array('I')
+        orig_len = array.array('I')
+
+        fh, header_rec, iszip = open_trace(tfile)
+        try:
+            for item in walk_records(fh, fh.tell(), header_rec, use_mmap):
+                offset.append(item[0])
+                ts_sec.append(item[1])
+                ts_usec.append(item[2])
+                incl_len.append(item[3])
+                orig_len.append(item[4])
+        finally:
+            fh.close()
+
+        self.count    = len(offset)
+        self.offset   = self._ndarray(offset)
+        self.ts_sec   = self._ndarray(ts_sec)
+        self.ts_usec  = self._ndarray(ts_usec)
+        self.incl_len = self._ndarray(incl_len)
+        self.orig_len = self._ndarray(orig_len)
+
+    @staticmethod
+    def _ndarray(data):
+        """Convert array.array to a NumPy array without copying the data,
+           the array is returned as is if NumPy is not available
+        """
+        if numpy is None:
+            return data
+        dtype = "u%d" % data.itemsize
+        if len(data) == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.frombuffer(data, dtype=dtype)
+
+    def secs(self):
+        """Return the timestamp of every record as a float array"""
+        if numpy is not None:
+            return self.ts_sec + self.ts_usec / 1000000.0
+        return array.array('d', [float(s) + float(u)/1000000.0 for s, u in zip(self.ts_sec, self.ts_usec)])
+
+    def total_bytes(self):
+        """Return a tuple (incl_bytes, orig_bytes) where incl_bytes is the
+           total number of bytes included in the trace and orig_bytes is
+           the total number of bytes on the wire
+        """
+        if numpy is not None:
+            return (int(self.incl_len.sum(dtype=numpy.uint64)), int(self.orig_len.sum(dtype=numpy.uint64)))
+        return (sum(self.incl_len), sum(self.orig_len))
+
+    def truncated(self):
+        """Return the number of records truncated by the snap length"""
+        if numpy is not None:
+            return int(numpy.count_nonzero(self.incl_len < self.orig_len))
+        return len([1 for i, o in zip(self.incl_len, self.orig_len) if i < o])
+
+    def gaps(self, mingap=1.0):
+        """Return the list of capture gaps, where a gap is the time between
+           consecutive records which is greater than or equal to the given
+           minimum. Each gap is given as a tuple (index, secs) where index
+           is the index of the record after the gap.
+
+           mingap:
+               Minimum gap in seconds [default: 1.0]
+        """
+        secs = self.secs()
+        if numpy is not None:
+            delta = numpy.diff(secs)
+            idxlist = numpy.nonzero(delta >= mingap)[0]
+            return [(int(i)+1, float(delta[i])) for i in idxlist]
+        ret = []
+        for i in xrange(1, len(secs)):
+            delta = secs[i] - secs[i-1]
+            if delta >= mingap:
+                ret.append((i, delta))
+        return ret
+
+    def timeline(self, interval=1.0):
+        """Return a tuple (tstart, packets, nbytes) where tstart is the time
+           of the first record, packets is the list of number of packets
+           for each time interval and nbytes is the list of bytes on the wire
+           for each time interval.
+
+           interval:
+               Time interval in seconds [default: 1.0]
+        """
+        if self.count == 0:
+            return (0.0, [], [])
+        secs = self.secs()
+        if numpy is not None:
+            tstart = float(secs.min())
+            bins = ((secs - tstart) / interval).astype(numpy.int64)
+            packets = numpy.bincount(bins)
+            nbytes  = numpy.bincount(bins, weights=self.orig_len)
+            return (tstart, packets.tolist(), [int(x) for x in nbytes])
+        tstart = min(secs)
+        packets = []
+        nbytes  = []
+        for t, size in zip(secs, self.orig_len):
+            idx = int((t - tstart) / interval)
+            if idx >= len(packets):
+                packets.extend([0] * (idx + 1 - len(packets)))
+                nbytes.extend([0] * (idx + 1 - len(nbytes)))
+            packets[idx] += 1
+            nbytes[idx]  += size
+        return (tstart, packets, nbytes)
+
+    def summary(self, mingap=1.0):
+        """Return a string with the header level summary of the trace file
+
+           mingap:
+               Minimum capture gap to report in seconds [default: 1.0]
+        """
+        out = "%s\n" % self.tfile
+        out += "    Packets:       %d\n" % self.count
+        if self.count == 0:
+            return out
+        secs = self.secs()
+        if numpy is not None:
+            tmin = float(secs.min())
+            tmax = float(secs.max())
+        else:
+            tmin = min(secs)
+            tmax = max(secs)
+        incl_bytes, orig_bytes = self.total_bytes()
+        ntrunc = self.truncated()
+        gaps = self.gaps(mingap)
+        tfmt = "%Y-%m-%d %H:%M:%S"
+        out += "    Start time:    %s.%06d\n" % (time.strftime(tfmt, time.localtime(int(tmin))), int(round((tmin % 1)*1000000)) % 1000000)
+        out += "    End time:      %s.%06d\n" % (time.strftime(tfmt, time.localtime(int(tmax))), int(round((tmax % 1)*1000000)) % 1000000)
+        out += "    Duration:      %s\n" % str_time(tmax - tmin)
+        out += "    Bytes on wire: %s\n" % str_units(orig_bytes)
+        out += "    Bytes in file: %s\n" % str_units(incl_bytes)
+        out += "    Truncated:     %d (%.2f%%)\n" % (ntrunc, 100.0*ntrunc/self.count)
+        out += "    Capture gaps:  %d (>= %ss)\n" % (len(gaps), mingap)
+        for idx, delta in gaps:
+            out += "        %.6f secs before packet %d\n" % (delta, idx)
+        return out
@@ -0,0 +1,153 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Decoded packet cache module
+
+Keep the most recently used decoded packets, together with their matching
+calls, keyed by packet index so a packet could be fetched again without
+decoding it. Going back to a packet which is no longer in memory requires
+decoding the trace file from the start, or from the last seek, in order to
+rebuild the TCP stream and RPC state.
+
+The cache is bounded by the number of packets, by the approximate memory
+used by the packets or by both. The memory used by a decoded packet is
+estimated as the captured length of its record plus a fixed overhead for
+all the objects created when decoding the packet.
+"""
+from collections import OrderedDict
+import nfstest_config as c
+from baseobj import BaseObj
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Approximate memory used by the objects of a decoded packet, not
+# including the record data
+PKT_OVERHEAD = 16384
+
+class PktCache(BaseObj):
+    """Decoded packet LRU cache
+
+       Usage:
+           from packet.pktcache import PktCache
+
+           # Keep up to 10000 packets
+           x = PktCache(maxcount=10000)
+
+           # Keep up to 64MB of decoded packets
+           x = PktCache(maxcount=None, maxbytes=64*1024*1024)
+
+           # Add the packet given by the index
+           x.add(index, pkt, pkt_call)
+
+           # Get the packet and its call given by the index
+           item = x.get(index)
+           if item is not None:
+               pkt, pkt_call = item
+
+       Object definition:
+
+       PktCache(
+           maxcount = int, # Maximum number of packets
+           maxbytes = int, # Maximum approximate memory used by the packets
+           size     = int, # Approximate memory used by the packets
+           hits     = int, # Number of packets found in the cache
+           misses   = int, # Number of packets not found in the cache
+           evicted  = int, # Number of packets removed to make room
+       )
+    """
+    # Class attributes
+    _attrlist = ("maxcount", "maxbytes", "size", "hits", "misses", "evicted")
+
+    def __init__(self, maxcount=10000, maxbytes=None):
+        """Constructor
+
+           maxcount:
+               Maximum number of packets kept, no limit if this is None
+               [default: 10000]
+           maxbytes:
+               Maximum approximate memory in bytes used by the packets kept,
+               no limit if this is None [default: None]
+        """
+        if maxcount is None and maxbytes is None:
+            raise ValueError("Packet cache must be bounded by count or memory")
+        if (maxcount is not None and maxcount <= 0) or (maxbytes is not None and maxbytes <= 0):
+            raise ValueError("Invalid packet cache limits: %s, %s" % (maxcount, maxbytes))
+        self.maxcount = maxcount
+        self.maxbytes = maxbytes
+        self.size     = 0
+        self.hits     = 0
+        self.misses   = 0
+        self.evicted  = 0
+        # Packet index => (pkt, pkt_call, size), least recently used first
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        """Return the number of packets in the cache"""
+        return len(self._cache)
+
+    def __contains__(self, index):
+        """Return True if the packet given by the index is in the cache,
+           this does not change the order of the packets
+        """
+        return index in self._cache
+
+    def clear(self):
+        """Remove all packets from the cache, the hit and miss counts
+           are not cleared
+        """
+        self._cache.clear()
+        self.size = 0
+
+    def get(self, index):
+        """Return the tuple (pkt, pkt_call) for the packet given by the
+           index and make it the most recently used packet, None is
+           returned if the packet is not in the cache
+        """
+        item = self._cache.pop(index, None)
+        if item is None:
+            self.misses += 1
+            return None
+        self._cache[index] = item
+        self.hits += 1
+        return item[:2]
+
+    def add(self, index, pkt, pkt_call=None):
+        """Add the packet given by the index
+
+           index:
+               Packet index
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           pkt_call:
+               Packet call object if pkt is a reply [default: None]
+        """
+        record = getattr(pkt, "record", None)
+        size = PKT_OVERHEAD + getattr(record, "length_inc", 0)
+        old = self._cache.pop(index, None)
+        if old is not None:
+            self.size -= old[2]
+        self._cache[index] = (pkt, pkt_call, size)
+        self.size += size
+        # Remove the least recently used packets, always keeping the
+        # packet just added
+        while len(self._cache) > 1 and \
+              ((self.maxcount is not None and len(self._cache) > self.maxcount) or \
+               (self.maxbytes is not None and self.size > self.maxbytes)):
+            item = self._cache.popitem(last=False)[1]
+            self.size -= item[2]
+            self.evicted += 1
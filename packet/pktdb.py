@@ -0,0 +1,424 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Packet database module
+
+Decode a packet trace once and save a row for every RPC packet and a row
+for every NFS operation into an SQLite database. The database can then be
+queried many times using SQL expressions and the matched packets can be
+displayed by seeking directly to their frames in the trace file instead of
+decoding the whole trace file again.
+
+Tables:
+    files(id, name)
+        One row for every trace file
+    rpc(pindex, file, frame, sframe, time, src, sport, dst, dport, xid,
+        type, program, version, procedure, status, latency, call, reply)
+        One row for every RPC packet where pindex is the packet index,
+        sframe is the frame where decoding must start in order to decode
+        the packet (an RPC could span multiple TCP segments), status is
+        the NFS status of a reply, latency is the time from the call to
+        the reply, call is the packet index of the call for a reply and
+        reply is the packet index of the reply for a call
+    nfsop(pindex, idx, op, opstatus, fh, stateid, offset, count, name)
+        One row for every operation in an NFSv4 COMPOUND or a single row
+        for NFSv3 and below where op is the procedure number. The file
+        handle is saved as its crc32 and the state id as the crc16 of its
+        "other" field. For a reply, the file handle, offset and name are
+        taken from the operation in the call if not given in the reply
+
+Views:
+    pkts
+        Join of tables rpc and nfsop, every RPC packet is included even
+        if it has no NFS operations
+"""
+import os
+import sqlite3
+import formatstr
+import nfstest_config as c
+from baseobj import BaseObj
+from packet.pktt import Pktt
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Number of rows to insert at a time
+BATCH_SIZE = 10000
+
+# Maximum number of frames to decode going forward from the current
+# packet before seeking directly to the frame of the next packet
+SEEK_FRAMES = 1000
+
+_SCHEMA = """
+CREATE TABLE files (
+    id       INTEGER PRIMARY KEY,
+    name     TEXT
+);
+CREATE TABLE rpc (
+    pindex    INTEGER PRIMARY KEY,
+    file      INTEGER,
+    frame     INTEGER,
+    sframe    INTEGER,
+    time      REAL,
+    src       TEXT,
+    sport     INTEGER,
+    dst       TEXT,
+    dport     INTEGER,
+    xid       INTEGER,
+    type      INTEGER,
+    program   INTEGER,
+    version   INTEGER,
+    procedure INTEGER,
+    status    INTEGER,
+    latency   REAL,
+    call      INTEGER,
+    reply     INTEGER
+);
+CREATE TABLE nfsop (
+    pindex    INTEGER,
+    idx       INTEGER,
+    op        INTEGER,
+    opstatus  INTEGER,
+    fh        INTEGER,
+    stateid   INTEGER,
+    offset    INTEGER,
+    count     INTEGER,
+    name      TEXT
+);
+CREATE VIEW pkts AS
+    SELECT rpc.*, nfsop.idx, nfsop.op, nfsop.opstatus, nfsop.fh,
+           nfsop.stateid, nfsop.offset, nfsop.count, nfsop.name
+    FROM rpc LEFT JOIN nfsop ON rpc.pindex = nfsop.pindex;
+"""
+
+_INDEXES = """
+CREATE INDEX rpc_xid  ON rpc(xid);
+CREATE INDEX rpc_time ON rpc(time);
+CREATE INDEX rpc_call ON rpc(call);
+CREATE INDEX nfsop_pindex  ON nfsop(pindex);
+CREATE INDEX nfsop_op      ON nfsop(op);
+CREATE INDEX nfsop_fh      ON nfsop(fh);
+CREATE INDEX nfsop_stateid ON nfsop(stateid);
+CREATE INDEX nfsop_name    ON nfsop(name);
+"""
+
+def _opvalues(item, citem):
+    """Return the list of values (fh, stateid, offset, count, name) for the
+       given operation, missing values are taken from the call operation
+    """
+    ret = []
+    for name in ("fh", "stateid", "offset", "count", "name"):
+        value = getattr(item, name, None)
+        if value is None and citem is not None:
+            value = getattr(citem, name, None)
+        if value is not None:
+            if name == "fh":
+                value = formatstr.crc32(value)
+            elif name == "stateid":
+                value = formatstr.crc16(getattr(value, "other", str(value)))
+            elif name == "name":
+                value = str(value).decode("utf-8", "replace")
+            else:
+                value = int(value)
+        ret.append(value)
+    return ret
+
+def seek_packets(pktlist, dprint=None):
+    """Generator yielding the Pktt object for every packet in the given
+       list, the Pktt object has the packet as its current packet so it
+       could be accessed as pkttobj.pkt. Only the frames needed to decode
+       each packet are processed, if the next packet is close enough to
+       the current packet the trace file is processed going forward,
+       otherwise the trace file is positioned directly at the frame where
+       the packet starts. The packet index of the returned packet is set
+       to the index given in the list.
+
+       pktlist:
+           List of packet locations ordered by packet index, where each
+           item is a tuple (pindex, isreply, tfile, frame, sframe, xid, type):
+           pindex is the packet index, isreply is True if the packet is
+           a reply included only because its call was matched, tfile is
+           the trace file name, frame is the frame number of the packet
+           and sframe is the frame where decoding must start
+       dprint:
+           Function used to display debug messages [default: None]
+    """
+    # Pktt object for each trace file: [pkttobj, seek frame]
+    pktt_map = {}
+    for pindex, isreply, tfile, frame, sframe, xid, rtype in pktlist:
+        item = pktt_map.get(tfile)
+        if item is None:
+            item = [Pktt(tfile), None]
+            item[0].showprog = False
+            pktt_map[tfile] = item
+        pkttobj = item[0]
+
+        pkt = pkttobj.pkt
+        lframe = pkt.record.frame if pkt is not None else 0
+        if item[1] is None or item[1] > sframe or lframe > frame or frame - lframe > SEEK_FRAMES:
+            # Position the trace file at the frame where the packet starts
+            pkttobj.seek_frame(sframe)
+            item[1] = sframe
+
+        # Search for the packet
+        found = False
+        while True:
+            try:
+                pkt = pkttobj.next()
+            except StopIteration:
+                break
+            record = pkt.record
+            if record.frame > frame:
+                # Packet was not found, the current packet is past the
+                # packet searched so a seek is needed for the next one
+                item[1] = None
+                break
+            rpc = pkt.rpc
+            if record.frame == frame and rpc is not None and rpc.xid == xid and rpc.type == rtype:
+                found = True
+                break
+        if found:
+            record.index = pindex
+            pkttobj.reply_matched = bool(isreply)
+            yield pkttobj
+        elif dprint is not None:
+            dprint('DBG1', "Packet %d not found in frame %d" % (pindex, frame))
+
+class PktDB(BaseObj):
+    """Packet database object
+
+       Usage:
+           from packet.pktdb import PktDB
+
+           # Decode trace file and create the database
+           x = PktDB("/traces/tracefile.db", create=True)
+           x.add_trace(["/traces/tracefile.cap"])
+           x.close()
+
+           # Display all NFSv4 WRITE packets having a non-zero status
+           x = PktDB("/traces/tracefile.db")
+           for pkttobj in x.match("version = 4 and op = 38 and opstatus != 0"):
+               print pkttobj.pkt
+
+       Object definition:
+
+       PktDB(
+           dbfile = string, # Database file name
+           conn   = object, # SQLite connection
+       )
+    """
+    # Class attributes
+    _attrlist = ("dbfile",)
+
+    def __init__(self, dbfile, create=False):
+        """Constructor
+
+           Open the database file given.
+
+           dbfile:
+               Name of SQLite database file
+           create:
+               Create the database, the file is removed if it already
+               exists [default: False]
+        """
+        self.dbfile = dbfile
+        if create:
+            if os.path.exists(dbfile):
+                os.unlink(dbfile)
+        elif not os.path.exists(dbfile):
+            raise Exception("Database file does not exist: %s" % dbfile)
+        self.conn = sqlite3.connect(dbfile)
+        if create:
+            self.conn.executescript(_SCHEMA)
+
+    def __del__(self):
+        """Destructor
+
+           Gracefully close the database.
+        """
+        self.close()
+
+    def close(self):
+        """Close the database"""
+        conn = getattr(self, "conn", None)
+        if conn is not None:
+            conn.commit()
+            conn.close()
+            self.conn = None
+
+    def files(self):
+        """Return the list of trace files in the database"""
+        return [x[0] for x in self.conn.execute("SELECT name FROM files ORDER BY id")]
+
+    def add_trace(self, tfiles, showprog=False):
+        """Decode the given trace files and save all RPC packets and NFS
+           operations to the database. The trace files are processed as a
+           single trace the same way as Pktt does so the packet indexes
+           are the same as the ones displayed by nfstest_pkt.
+
+           tfiles:
+               Name of trace file or list of trace files
+           showprog:
+               Display progress bar [default: False]
+        """
+        if isinstance(tfiles, str):
+            tfiles = [tfiles]
+        conn = self.conn
+        fileids = {}
+        for tfile in tfiles:
+            cursor = conn.execute("INSERT INTO files(name) VALUES (?)", (os.path.abspath(tfile),))
+            fileids[tfile] = cursor.lastrowid
+
+        pkttobj = Pktt(tfiles)
+        pkttobj.showprog = showprog
+
+        rpcrows = []
+        oprows  = []
+        replies = []
+        def flush():
+            conn.executemany("INSERT INTO rpc VALUES (%s)" % ",".join(["?"]*18), rpcrows)
+            conn.executemany("INSERT INTO nfsop VALUES (%s)" % ",".join(["?"]*9), oprows)
+            conn.executemany("UPDATE rpc SET reply = ? WHERE pindex = ?", replies)
+            del rpcrows[:]
+            del oprows[:]
+            del replies[:]
+
+        for pkt in pkttobj:
+            record = pkt.record
+            frame = record.frame
+            fileid = fileids.get(pkttobj.tfile)
+            # Frame where decoding must start to get this packet
+            sframe = getattr(pkt.tcp, "rpc_frame", frame)
+
+            rpc = pkt.rpc
+            if rpc is None:
+                continue
+
+            pindex = record.index
+            nfs = pkt.nfs
+            status = None
+            latency = None
+            call = None
+            callops = []
+            if rpc.type:
+                # RPC reply
+                pkt_call = pkttobj.pkt_call
+                if pkt_call is not None and pkt_call.rpc.xid == rpc.xid:
+                    call = pkt_call.record.index
+                    latency = record.secs - pkt_call.record.secs
+                    replies.append((pindex, call))
+                    if pkt_call.nfs is not None:
+                        callops = getattr(pkt_call.nfs, "array", [pkt_call.nfs])
+                if nfs is not None:
+                    status = getattr(nfs, "status", None)
+                elif getattr(rpc, "accepted_status", 0):
+                    status = rpc.accepted_status
+                if status is not None:
+                    status = int(status)
+
+            if pkt.ip is not None:
+                src, dst = pkt.ip.src, pkt.ip.dst
+            else:
+                src, dst = None, None
+            layer = pkt.tcp if pkt.tcp is not None else pkt.udp
+            if layer is not None:
+                sport, dport = layer.src_port, layer.dst_port
+            else:
+                sport, dport = None, None
+
+            rpcrows.append((pindex, fileid, frame, sframe, record.secs,
+                src, sport, dst, dport, int(rpc.xid), rpc.type,
+                getattr(rpc, "program", None), getattr(rpc, "version", None),
+                getattr(rpc, "procedure", None), status, latency, call, None))
+
+            if nfs is not None:
+                if hasattr(nfs, "array"):
+                    # NFSv4 COMPOUND
+                    oplist = nfs.array
+                else:
+                    # NFSv3 and below
+                    oplist = [nfs]
+                idx = 0
+                for item in oplist:
+                    if hasattr(nfs, "array"):
+                        op = int(item.op)
+                    else:
+                        op = getattr(rpc, "procedure", None)
+                    citem = callops[idx] if idx < len(callops) else None
+                    opstatus = getattr(item, "status", None)
+                    if opstatus is not None:
+                        opstatus = int(opstatus)
+                    oprows.append([pindex, idx, op, opstatus] + _opvalues(item, citem))
+                    idx += 1
+
+            if len(rpcrows) >= BATCH_SIZE:
+                flush()
+        flush()
+        pkttobj.show_progress(True)
+        conn.executescript(_INDEXES)
+        conn.commit()
+
+    def query(self, where, reply=False):
+        """Return a list of tuples for all RPC packets matching the given
+           SQL expression:
+               (pindex, isreply, file, frame, sframe, xid, type, call_sframe)
+           where isreply is True if the packet is included only because
+           its call was matched and call_sframe is the start frame of
+           the call for a reply
+
+           where:
+               SQL expression used in the WHERE clause on the pkts view
+           reply:
+               Include the replies of all matched calls [default: False]
+        """
+        conn = self.conn
+        conn.execute("DROP TABLE IF EXISTS temp.matched")
+        conn.execute("CREATE TEMP TABLE matched (pindex INTEGER PRIMARY KEY, isreply INTEGER)")
+        conn.execute("INSERT INTO matched SELECT DISTINCT pindex, 0 FROM pkts WHERE %s" % where)
+        if reply:
+            conn.execute("INSERT OR IGNORE INTO matched SELECT rpc.reply, 1 FROM rpc, matched WHERE rpc.pindex = matched.pindex AND rpc.reply IS NOT NULL")
+        sql  = "SELECT m.pindex, m.isreply, r.file, r.frame, r.sframe, r.xid, r.type, c.sframe "
+        sql += "FROM matched m JOIN rpc r ON r.pindex = m.pindex "
+        sql += "LEFT JOIN rpc c ON c.pindex = r.call AND c.file = r.file ORDER BY m.pindex"
+        return conn.execute(sql).fetchall()
+
+    def match(self, where, reply=False):
+        """Generator yielding the Pktt object for every packet matching
+           the given SQL expression. The Pktt object has the matched packet
+           as its current packet so it could be accessed as pkttobj.pkt.
+           Only the frames needed to decode each packet are processed, if
+           the next packet is close enough to the current packet the trace
+           file is processed going forward, otherwise the trace file is
+           positioned directly at the frame where the packet starts.
+           The packet index of the returned packet is set to the index
+           given in the database. Decoding of a reply starts at its call,
+           if the call is in the trace file, since the call is needed to
+           decode the reply, so pkttobj.pkt_call is set for every reply.
+
+           where:
+               SQL expression used in the WHERE clause on the pkts view
+           reply:
+               Include the replies of all matched calls [default: False]
+        """
+        files = dict(self.conn.execute("SELECT id, name FROM files").fetchall())
+        pktlist = []
+        for pindex, isreply, fileid, frame, sframe, xid, rtype, csframe in self.query(where, reply):
+            if rtype and csframe is not None:
+                sframe = min(sframe, csframe)
+            pktlist.append((pindex, isreply, files[fileid], frame, sframe, xid, rtype))
+        for pkttobj in seek_packets(pktlist, self.dprint):
+            yield pkttobj
@@ -48,11 +48,17 @@ import token
 import struct
 import parser
 import symbol
+import bisect
 import termios
 from formatstr import *
 import nfstest_config as c
 from baseobj import BaseObj
 from packet.unpack import Unpack
+import packet.pcapscan as pcapscan
+from packet.stats import QueueDepth, TCPStats, clock_offset
+from packet.dedup import DupFilter
+from packet.sample import Sampler
+from packet.pktcache import PktCache
 from packet.record import Record
 from packet.pkt import Pkt, PKT_layers
 from packet.link.ethernet import ETHERNET
@@ -83,6 +89,9 @@ READ_SIZE = 64*1024
 # Show progress if stderr is a tty and stdout is not
 SHOWPROG = os.isatty(2) and not os.isatty(1)
 
+# Number of records between entries in the sparse time index
+TIME_INDEX_STEP = 1000
+
 class Header(BaseObj):
     # Class attributes
     _attrlist = ("major", "minor", "zone_offset", "accuracy",
@@ -108,8 +117,13 @@ class Pktt(BaseObj, Unpack):
            # Iterate over all packets found in the trace file
            for pkt in x:
                print pkt
+
+           # Iterate over all packets found within a time window
+           x = Pktt("/traces/tracefile.cap", start_time=tstart, end_time=tend)
+           for pkt in x:
+               print pkt
     """
-    def __init__(self, tfile, live=False, state=True):
+    def __init__(self, tfile, live=False, state=True, start_time=None, end_time=None):
         """Constructor
 
            Initialize object's private data, note that this will not check the
@@ -128,6 +142,13 @@ class Pktt(BaseObj, Unpack):
                case when <EOF> is encountered the next trace file created by
                tcpdump will be opened and the object will be re-initialized,
                all private data referencing the previous file is lost.
+           start_time:
+               Skip all packets before this time, given in seconds since
+               the epoch. The trace file is positioned using the time index
+               so the packets before this time are never decoded [default: None]
+           end_time:
+               Stop at the first packet after this time, given in seconds
+               since the epoch [default: None]
         """
         self.tfile   = tfile  # Current trace file name
         self.bfile   = tfile  # Base trace file name
@@ -157,6 +178,28 @@ class Pktt(BaseObj, Unpack):
         self.progdone  = 0    # Display last progress only once
         self.timestart = time.time() # Time reference base
         self.reply_matched = False   # Matching a reply
+        self.start_time = start_time # Start of time window
+        self.end_time   = end_time   # End of time window
+        self.rpc_queue  = None       # RPC queue depth tracker
+        self.tcp_stats  = None       # TCP stream analytics
+        self.clock_offset = 0.0      # Clock offset subtracted from timestamps
+        self.dedup      = None       # Duplicate packet filter
+        self._dedup_src = None       # Trace file index given to the filter
+        self._dedup_offset = None    # File offset of last record not dropped
+        self.sampler    = None       # Packet sampler
+        self._sample_offset = -1     # File offset of last record sampled
+        self.pkt_cache  = None       # Decoded packet cache
+        # Index of the next packet to be decoded when the current packet
+        # has been taken from the packet cache, None if it is self.index
+        self._cache_index = None
+
+        # Sparse time index: list of maximum timestamps of all records
+        # before each entry and the list of (offset, frame) for each entry
+        self._tindex_secs  = None
+        self._tindex_pos   = None
+        self._tindex_first = None # Timestamp of first record
+        # Seek method, its argument and packet index of last seek
+        self._seek_base = None
 
         # TCP stream map: to keep track of the different TCP streams within
         # the trace file -- used to deal with RPC packets spanning multiple
@@ -167,6 +210,11 @@ class Pktt(BaseObj, Unpack):
         self._rpc_xid_map = {}
         # List of outstanding xids to match
         self._match_xid_list = []
+        # Reply index: map of the packet index of every call to the packet
+        # index of its reply, it is complete once all packets in the trace
+        # have been processed in order
+        self._reply_map  = {}
+        self._reply_done = False
 
         # Process tfile argument
         if isinstance(tfile, list):
@@ -178,7 +226,10 @@ class Pktt(BaseObj, Unpack):
             else:
                 # Create all packet trace objects
                 for tfile in self.tfiles:
-                    self.pktt_list.append(Pktt(tfile))
+                    pktt = Pktt(tfile)
+                    # The reply index is kept using the cumulative index
+                    pktt._reply_map = None
+                    self.pktt_list.append(pktt)
 
     def __del__(self):
         """Destructor
@@ -230,6 +281,15 @@ class Pktt(BaseObj, Unpack):
         except:
             pass
 
+        if self.pkt_cache is not None:
+            item = self.pkt_cache.get(index)
+            if item is not None:
+                # The requested packet is in the cache, leave the
+                # trace file as it is until a packet must be decoded
+                self._cache_move(index + 1)
+                self.pkt, self.pkt_call = item
+                return self.pkt
+
         if index < self.index:
             # Reset the current packet index and offset
             # The index is less than the current packet offset so position
@@ -280,11 +340,35 @@ class Pktt(BaseObj, Unpack):
            NOTE:
                Supports only single active iteration
         """
+        if self.pkt_cache is None:
+            return self._next_packet()
+        if self._cache_index is not None:
+            # The trace file is not positioned at the current packet index,
+            # use the packet cache before decoding any packets
+            item = self.pkt_cache.get(self.index)
+            if item is not None:
+                self.pkt, self.pkt_call = item
+                self.index += 1
+                return self.pkt
+            self._cache_sync()
+        pkt = self._next_packet()
+        self.pkt_cache.add(self.index - 1, pkt, self.pkt_call)
+        return pkt
+
+    def _next_packet(self):
+        """Decode the next packet from the trace file or raise StopIteration"""
         self.dprint('PKT4', ">>> %d: next()" % self.index)
+        if self.index == 0 and self.start_time is not None:
+            # Skip all packets before the start of the time window
+            self.seek_time(self.start_time)
+
         # Initialize next packet
         self.pkt = Pkt()
 
-        if len(self.pktt_list) > 1:
+        if len(self.pktt_list) > 1 and self.dedup is not None:
+            # Dealing with multiple trace files dropping duplicate packets
+            return self._next_dedup()
+        elif len(self.pktt_list) > 1:
             # Dealing with multiple trace files
             minsecs  = None
             pktt_obj = None
@@ -308,6 +392,10 @@ class Pktt(BaseObj, Unpack):
                 # All packet trace files have been processed
                 self.offset = self.filesize
                 self.show_progress(True)
+                self._set_reply_done()
+                raise StopIteration
+            elif self.end_time is not None and minsecs > self.end_time:
+                # All packets left are after the end of the time window
                 raise StopIteration
             elif len(self._tcp_stream_map):
                 # This packet trace file should be processed serially
@@ -326,6 +414,7 @@ class Pktt(BaseObj, Unpack):
             self.tfile = pktt_obj.tfile
             self.pkt.record.index = self.index  # Use a cumulative index
             self.offset += pktt_obj.offset - pktt_obj.boffset
+            self._save_reply_index()
 
             try:
                 # Get next packet for this packet trace object
@@ -354,28 +443,47 @@ class Pktt(BaseObj, Unpack):
             self.index += 1
             return self.pkt
 
-        if self.boffset != self.offset:
-            # Frame number is one for every record header on the pcap trace
-            # On the other hand self.index is the packet number. Since there
-            # could be multiple packets on a single frame self.index could
-            # be larger the self.frame except that self.index start at 0
-            # while self.frame starts at 1.
-            # The frame number can be used to match packets with other tools
-            # like wireshark
-            self.frame += 1
-
-        # Save file offset for this packet
-        self.boffset = self.offset
+        if self.fh is None:
+            # Open the packet trace so the offset of the first packet
+            # is the offset right after the file header
+            self._getfh()
+            self.boffset = self.offset
 
-        # Get record header
-        data = self._read(16)
-        if len(data) < 16:
-            self.eof = True
-            self.offset = self.filesize
-            self.show_progress(True)
-            raise StopIteration
-        # Decode record header
-        record = Record(self, data)
+        while True:
+            if self.boffset != self.offset:
+                # Frame number is one for every record header on the pcap
+                # trace. On the other hand self.index is the packet number.
+                # Since there could be multiple packets on a single frame
+                # self.index could be larger the self.frame except that
+                # self.index start at 0 while self.frame starts at 1.
+                # The frame number can be used to match packets with other
+                # tools like wireshark
+                self.frame += 1
+
+            # Save file offset for this packet
+            self.boffset = self.offset
+
+            # Get record header
+            data = self._read(16)
+            if len(data) < 16:
+                self.eof = True
+                self.offset = self.filesize
+                self.show_progress(True)
+                self._set_reply_done()
+                raise StopIteration
+            # Decode record header
+            record = Record(self, data)
+            if self.end_time is not None and record.secs > self.end_time:
+                # Packet is after the end of the time window, leave the file
+                # pointer at the start of this packet
+                self.seek(self.boffset)
+                raise StopIteration
+            if self.sampler is None or self._sample_record(record):
+                break
+            # Record not selected by the sampler, skip it without reading
+            # the rest of the record data
+            self.seek(self.offset + record.length_inc)
+            self.show_progress()
 
         # Get record data and create Unpack object
         self.unpack = Unpack(self._read(record.length_inc))
@@ -384,6 +492,7 @@ class Pktt(BaseObj, Unpack):
             self.eof = True
             self.offset = self.filesize
             self.show_progress(True)
+            self._set_reply_done()
             raise StopIteration
 
         if self.header.link_type == 1:
@@ -393,6 +502,11 @@ class Pktt(BaseObj, Unpack):
             # Unknown link layer
             record.data = self.unpack.getbytes()
 
+        self._save_reply_index()
+        if self.rpc_queue is not None:
+            self._update_rpc_queue()
+        if self.tcp_stats is not None:
+            self._update_tcp_stats()
         self.show_progress()
 
         # Increment packet index
@@ -400,6 +514,118 @@ class Pktt(BaseObj, Unpack):
 
         return self.pkt
 
+    def _next_dedup(self):
+        """Get the next packet from multiple trace files dropping the
+           packets seen on more than one trace file. The record of the next
+           packet on each trace file is peeked at without decoding it, the
+           packet having the lowest timestamp is dropped if it is a duplicate
+           or it is decoded otherwise. Therefore, packets are decoded in
+           timestamp order regardless of the trace file they come from.
+        """
+        while True:
+            minsecs  = None
+            pktt_obj = None
+            for obj in self.pktt_list:
+                if obj.eof:
+                    continue
+                item = obj._peek_record()
+                if item is None:
+                    obj.eof = True
+                elif minsecs is None or item[0] < minsecs:
+                    minsecs, data = item
+                    pktt_obj = obj
+            if self.filesize == 0:
+                # Calculate total bytes to process
+                for obj in self.pktt_list:
+                    self.filesize += obj.filesize
+            if pktt_obj is None:
+                # All packet trace files have been processed
+                self.offset = self.filesize
+                self.show_progress(True)
+                self._set_reply_done()
+                raise StopIteration
+            elif self.end_time is not None and minsecs > self.end_time:
+                # All packets left are after the end of the time window
+                raise StopIteration
+
+            if pktt_obj.offset != pktt_obj._dedup_offset:
+                # The record is not being processed again because of
+                # multiple RPC messages on the same frame
+                if self.dedup.duplicate(minsecs, pktt_obj._dedup_src, pktt_obj.header.link_type, data):
+                    # Drop the packet before it is decoded
+                    self.offset += pktt_obj._skip_record()
+                    self.show_progress()
+                    continue
+                pktt_obj._dedup_offset = pktt_obj.offset
+            try:
+                pktt_obj.next()
+            except StopIteration:
+                continue
+            break
+
+        # Overwrite attributes seen by the caller with the attributes
+        # from the current packet trace object
+        self.pkt = pktt_obj.pkt
+        self.pkt_call = pktt_obj.pkt_call
+        self.tfile = pktt_obj.tfile
+        self.pkt.record.index = self.index  # Use a cumulative index
+        self.offset += pktt_obj.offset - pktt_obj.boffset
+        self._save_reply_index()
+        self.show_progress()
+
+        # Increment cumulative packet index
+        self.index += 1
+        return self.pkt
+
+    def _sample_record(self, record):
+        """Return True if the record, whose header has just been read, is
+           selected by the sampler. For stream sampling only the packet
+           headers are read and the file pointer is left at the start of
+           the record data
+        """
+        # Do not count the records sampled before, e.g., after a rewind
+        # or when processing multiple RPC messages on the same frame
+        count = self.boffset > self._sample_offset
+        if count:
+            self._sample_offset = self.boffset
+        if self.sampler.period is not None:
+            return self.sampler.select(record.secs, count=count)
+        offset = self.offset
+        data = self._read(min(record.length_inc, 128))
+        self.seek(offset)
+        return self.sampler.select(record.secs, self.header.link_type, data, count)
+
+    def _peek_record(self):
+        """Return the tuple (secs, data) for the next record without
+           moving the file pointer where secs is the timestamp and data
+           is the raw record data, None is returned at <EOF>
+        """
+        if self.fh is None:
+            self._getfh()
+            self.boffset = self.offset
+        offset = self.offset
+        data = self._read(16)
+        ret = None
+        if len(data) == 16:
+            ulist = struct.unpack(self.header_rec, data)
+            data = self._read(ulist[2])
+            if len(data) == ulist[2]:
+                secs = float(ulist[0]) + float(ulist[1])/1000000.0 - self.clock_offset
+                ret = (secs, data)
+        self.seek(offset)
+        return ret
+
+    def _skip_record(self):
+        """Skip the next record without decoding it, returns the number
+           of bytes skipped
+        """
+        if self.boffset != self.offset:
+            self.frame += 1
+        self.boffset = self.offset
+        ulist = struct.unpack(self.header_rec, self._read(16))
+        self._read(ulist[2])
+        return self.offset - self.boffset
+
     def rewind(self, index=0):
         """Rewind the trace file by setting the file pointer to the start of
            the given packet index. Returns False if unable to rewind the file,
@@ -408,8 +634,30 @@ class Pktt(BaseObj, Unpack):
         """
         self.dprint('PKT1', ">>> rewind(%d)" % index)
         if index >= 0 and index < self.index:
-            if len(self.pktt_list) > 1:
+            if self.pkt_cache is not None and index in self.pkt_cache:
+                # The packet is in the cache, leave the trace file as it
+                # is until a packet must be decoded
+                self._cache_move(index)
+                return True
+            # The trace file is positioned by the rewind
+            self._cache_index = None
+            if self._seek_base is not None and index >= self._seek_base[2]:
+                # The packet is after the last seek, use the time index
+                # instead of going back to the first packet
+                getattr(self, self._seek_base[0])(self._seek_base[1])
+            elif len(self.pktt_list) > 1 and self.dedup is not None:
+                # Dealing with multiple trace files dropping duplicate packets
+                # Packets are read as they are merged, just go back to the
+                # first packet on all trace files
+                self._clear_seek_base()
+                self.index = 0
+                shared = self._share_state()
+                for obj in self.pktt_list:
+                    obj._rewind_start()
+                    obj._tcp_stream_map, obj._rpc_xid_map = shared
+            elif len(self.pktt_list) > 1:
                 # Dealing with multiple trace files
+                self._clear_seek_base()
                 self.index = 0
                 for obj in self.pktt_list:
                     if not obj.eof or index <= obj.mindex:
@@ -421,17 +669,7 @@ class Pktt(BaseObj, Unpack):
                     elif obj.serial and index > obj.mindex:
                         self.index = obj.mindex + 1
             else:
-                # Reset the current packet index and offset to the first packet
-                self.offset = self.ioffset
-                self.index  = 0
-                self.eof    = False
-
-                # Position the file pointer to the offset of the first packet
-                self.seek(self.ioffset)
-
-                # Clear state
-                self._tcp_stream_map = {}
-                self._rpc_xid_map    = {}
+                self._rewind_start()
 
             # Move to the packet before the specified by the index so the
             # next packet fetched will be the one given by index
@@ -445,23 +683,650 @@ class Pktt(BaseObj, Unpack):
             return True
         return False
 
+    def _cache_move(self, index):
+        """Set the current packet index without moving the trace file,
+           the next packet is taken from the packet cache if possible
+        """
+        if self._cache_index is None:
+            # Save the index of the next packet to be decoded
+            self._cache_index = self.index
+        self.index = index
+
+    def _cache_sync(self):
+        """Position the trace file at the current packet index after
+           packets have been taken from the packet cache
+        """
+        index = self.index
+        self.index = self._cache_index
+        self._cache_index = None
+        if index < self.index:
+            self.rewind(index)
+        else:
+            # Decode the packets in between to keep the TCP stream
+            # and RPC state, these packets are added to the cache
+            while self.index < index:
+                pkt = self._next_packet()
+                self.pkt_cache.add(self.index - 1, pkt, self.pkt_call)
+
+    def _rewind_start(self):
+        """Reset the current packet index and offset to the first packet"""
+        if self.fh is None:
+            # Trace file has not been opened yet
+            return
+        self.offset  = self.ioffset
+        self.boffset = self.ioffset
+        self.index   = 0
+        self.frame   = 1
+        self.eof     = False
+        self._clear_seek_base()
+
+        # Position the file pointer to the offset of the first packet
+        self.seek(self.ioffset)
+
+        # Clear state
+        self._tcp_stream_map = {}
+        self._rpc_xid_map    = {}
+
+    def _save_reply_index(self):
+        """Save the packet index of the current packet if it is a reply"""
+        if self._reply_map is not None and self.pkt_call is not None and \
+           self.pkt == "rpc" and self.pkt.rpc.type == 1:
+            self._reply_map[self.pkt_call.record.index] = self.pkt.record.index
+
+    def track_queue_depth(self, interval=1.0, timeout=None):
+        """Keep track of the number of RPC calls in flight for each
+           transport stream as the packets are processed. Returns the
+           QueueDepth object which has the time series and the summary
+           statistics for each stream, see packet.stats.QueueDepth.
+
+           interval:
+               Time interval in seconds for the time series [default: 1.0]
+           timeout:
+               Calls without a reply for this many seconds are no longer
+               considered in flight [default: None]
+
+           Examples:
+               qdepth = x.track_queue_depth()
+               for pkt in x:
+                   pass
+               for key in qdepth.keys():
+                   print key, qdepth.summary(key)
+        """
+        self.rpc_queue = QueueDepth(interval, timeout)
+        for obj in self.pktt_list:
+            obj.rpc_queue = self.rpc_queue
+        return self.rpc_queue
+
+    def _update_rpc_queue(self):
+        """Update the RPC queue depth tracker with the current packet"""
+        pkt = self.pkt
+        if pkt != "rpc" or pkt.ip is None:
+            return
+        layer = pkt.tcp if pkt.tcp is not None else pkt.udp
+        if layer is None:
+            return
+        rpc = pkt.rpc
+        ip = pkt.ip
+        if rpc.type == 0:
+            key = (ip.src, layer.src_port, ip.dst, layer.dst_port)
+            self.rpc_queue.call(pkt.record.secs, key, rpc.xid)
+        else:
+            key = (ip.dst, layer.dst_port, ip.src, layer.src_port)
+            self.rpc_queue.reply(pkt.record.secs, key, rpc.xid)
+
+    def track_tcp(self, interval=1.0):
+        """Keep track of the round trip time, re-transmissions, duplicate
+           ACKs, advertised window and bytes in flight for each direction
+           of every TCP stream as the packets are processed. Returns the
+           TCPStats object which has the time series and the summary
+           statistics for each direction, see packet.stats.TCPStats.
+
+           interval:
+               Time interval in seconds for the time series [default: 1.0]
+
+           Examples:
+               tcpstats = x.track_tcp()
+               for pkt in x:
+                   pass
+               for key in tcpstats.keys():
+                   print key, tcpstats.summary(key)
+        """
+        self.tcp_stats = TCPStats(interval)
+        for obj in self.pktt_list:
+            obj.tcp_stats = self.tcp_stats
+        return self.tcp_stats
+
+    def _update_tcp_stats(self):
+        """Update the TCP stream analytics with the current packet"""
+        pkt = self.pkt
+        tcp = pkt.tcp
+        if tcp is None or pkt.ip is None:
+            return
+        wscale = None
+        if tcp.flags.SYN:
+            for option in tcp.options or []:
+                if option.kind == 3 and option.wsopt is not None:
+                    wscale = option.wsopt
+        key = (pkt.ip.src, tcp.src_port, pkt.ip.dst, tcp.dst_port)
+        self.tcp_stats.segment(pkt.record.secs, key, tcp.seq_number, tcp.ack_number,
+                               tcp.window_size, tcp.length, tcp.flags.rawflags, wscale)
+
+    def align_clocks(self, maxcalls=10000):
+        """Align the clocks of multiple trace files captured on different
+           hosts, e.g., on the client and on the server, so the packets
+           are merged in the order they were actually seen. The clock offset
+           of each trace file relative to the first trace file is estimated
+           from the RPC calls and replies seen on both (see
+           packet.stats.clock_offset) and it is then subtracted from the
+           timestamps of all its packets. Returns the list of tuples
+           (offset, count) for every trace file where count is the number
+           of RPC calls used to estimate the offset. The offset is None
+           if the trace file has no RPC calls in common with the first
+           trace file, in which case its timestamps are not changed.
+
+           This must be called before processing any packets.
+
+           maxcalls:
+               Maximum number of RPC calls used from each trace file,
+               the calls are taken from the start of each trace file
+               [default: 10000]
+
+           Examples:
+               x = Pktt(["client.cap", "server.cap"])
+               for offset, count in x.align_clocks():
+                   print offset, count
+               for pkt in x:
+                   print pkt
+        """
+        if len(self.pktt_list) < 2:
+            return [(0.0, 0)]
+        if self.index > 0:
+            raise Exception("Clocks must be aligned before processing any packets")
+        samples = self._clock_samples(self.pktt_list[0].tfile, maxcalls)
+        ret = [(0.0, len(samples))]
+        for obj in self.pktt_list[1:]:
+            offset, count = clock_offset(samples, self._clock_samples(obj.tfile, maxcalls))
+            ret.append((offset, count))
+            obj.clock_offset = offset if offset is not None else 0.0
+        return ret
+
+    def drop_duplicates(self, window=1.0, maxsize=100000):
+        """Drop the packets seen on more than one trace file, e.g., when
+           capturing on both interfaces of a bonded link or when merging
+           the client and server packet traces. The duplicate packets are
+           dropped before they are decoded (see packet.dedup.DupFilter) and
+           the first copy of every packet is kept. Since consecutive packets
+           could be kept from different trace files, the packets are decoded
+           in timestamp order and the TCP stream and RPC xid state is shared
+           by all trace files. Returns the DupFilter object which has the
+           number of packets dropped.
+
+           This must be called before processing any packets.
+
+           window:
+               Time window in seconds, a packet is compared to all packets
+               seen within this time [default: 1.0]
+           maxsize:
+               Maximum number of packets kept in the window [default: 100000]
+
+           Examples:
+               x = Pktt(["eth0.cap", "eth1.cap"])
+               dedup = x.drop_duplicates()
+               for pkt in x:
+                   print pkt
+               print "Duplicate packets: %d" % dedup.dropped
+        """
+        if self.index > 0:
+            raise Exception("Duplicate packets must be dropped before processing any packets")
+        self.dedup = DupFilter(window, maxsize)
+        for idx in range(len(self.pktt_list)):
+            self.pktt_list[idx]._dedup_src = idx
+        self._share_state()
+        return self.dedup
+
+    def sample(self, rate, period=None, seed=0):
+        """Decode only a sample of the packets, either all the packets of
+           a fraction of the TCP and UDP streams or all the packets within
+           a fraction of every time period (see packet.sample.Sampler).
+           The records not selected are skipped using the record header
+           and the packet headers only so they are never decoded. Stream
+           sampling keeps both directions of every stream selected so the
+           TCP reassembly and the matching of calls and replies are not
+           affected. Returns the Sampler object which has the number of
+           records sampled and selected and the scale factor for the counts
+           given by the selected packets.
+
+           This must be called before processing any packets.
+
+           rate:
+               Fraction of the TCP and UDP streams selected or fraction
+               of every period selected when using time sampling
+           period:
+               Use time sampling with this period in seconds instead of
+               stream sampling [default: None]
+           seed:
+               Hash seed for stream sampling [default: 0]
+
+           Examples:
+               # Decode 10% of the TCP and UDP streams
+               sampler = x.sample(0.1)
+               for pkt in x:
+                   if pkt == "nfs":
+                       count += 1
+               print "Estimated NFS packets: %d" % (count * sampler.scale())
+
+               # Decode the first second of every minute
+               sampler = x.sample(1.0/60, period=60)
+        """
+        if self.index > 0:
+            raise Exception("Sampling must be enabled before processing any packets")
+        self.sampler = Sampler(rate, period, seed)
+        for obj in self.pktt_list:
+            obj.sampler = self.sampler
+        return self.sampler
+
+    def cache_packets(self, maxcount=10000, maxbytes=None):
+        """Keep the most recently used decoded packets in memory so going
+           back to a packet, using either x[index], rewind() or match()
+           with rewind set, does not decode the trace file again from the
+           start or from the last seek in order to rebuild the TCP stream
+           and RPC state (see packet.pktcache.PktCache). A packet is taken
+           from the cache without moving the trace file and the trace file
+           is positioned only when a packet not in the cache is needed.
+           Returns the PktCache object which has the number of packets
+           found and not found in the cache.
+
+           The cache is cleared when seeking to a time or frame since
+           the packet indexes are not the same after a seek.
+
+           maxcount:
+               Maximum number of packets kept, no limit if this is None
+               [default: 10000]
+           maxbytes:
+               Maximum approximate memory in bytes used by the packets
+               kept, no limit if this is None [default: None]
+
+           Examples:
+               cache = x.cache_packets(maxbytes=256*1024*1024)
+               pkt = x.match("NFS.argop == 25")
+               # Look at the packets before the READ request
+               for index in range(max(pkt.record.index - 10, 0), pkt.record.index):
+                   print x[index]
+               print "Cache hits: %d" % cache.hits
+        """
+        self.pkt_cache = PktCache(maxcount, maxbytes)
+        self._cache_index = None
+        return self.pkt_cache
+
+    def _share_state(self):
+        """Clear the duplicate packet filter and have the TCP stream and
+           RPC xid state shared by all trace files, returns the tuple
+           (TCP stream map, RPC xid map) shared
+        """
+        self.dedup.reset()
+        tcp_stream_map = {}
+        rpc_xid_map    = {}
+        for obj in self.pktt_list:
+            obj._tcp_stream_map = tcp_stream_map
+            obj._rpc_xid_map    = rpc_xid_map
+            obj._dedup_offset   = None
+        return (tcp_stream_map, rpc_xid_map)
+
+    def _clock_samples(self, tfile, maxcalls):
+        """Return the call and reply times for the first RPC calls on
+           the given trace file: (client, xid) => (call time, reply time)
+        """
+        pktt = Pktt(tfile)
+        calls = {}
+        samples = {}
+        for pkt in pktt:
+            if pkt != "rpc" or pkt.ip is None:
+                continue
+            rpc = pkt.rpc
+            if rpc.type == 0:
+                calls.setdefault((pkt.ip.src, rpc.xid), pkt.record.secs)
+            else:
+                key = (pkt.ip.dst, rpc.xid)
+                if key in calls and key not in samples:
+                    samples[key] = (calls[key], pkt.record.secs)
+                    if len(samples) >= maxcalls:
+                        break
+        return samples
+
+    def _set_reply_done(self):
+        """All packets have been processed, the reply index is complete
+           unless the packets have been processed after a time seek, or
+           only part of the packets have been processed because of the
+           sampler or the time window
+        """
+        if self._reply_map is None or self._seek_base is not None or self.live:
+            return
+        if self.sampler is not None or self.start_time is not None or self.end_time is not None:
+            # Skipped packets may include the reply
+            return
+        self._reply_done = True
+
+    def _clear_reply_index(self):
+        """Clear the reply index"""
+        if self._reply_map is not None:
+            self._reply_map  = {}
+            self._reply_done = False
+        if self.pkt_cache is not None:
+            # Packet indexes are not valid anymore
+            self.pkt_cache.clear()
+
+    def reply_index(self, index):
+        """Return the packet index of the reply for the RPC call given by
+           its packet index. The reply index is built as the packets are
+           processed so no search is needed to pair a call with its reply.
+
+           Returns None if the reply has not been processed yet, or -1
+           if there is no reply for the call -- this is only known after
+           all packets in the trace file have been processed. When the
+           packets are selected by a sampler or by the time window given
+           by start_time and end_time, the replies not processed are never
+           known to be missing so None is returned for them instead of -1.
+
+           Examples:
+               pkt_call = x.match("NFS.argop == 38")
+               rindex = x.reply_index(pkt_call.record.index)
+               if rindex == -1:
+                   print "WRITE call has no reply"
+               elif rindex is not None:
+                   pkt_reply = x[rindex]
+        """
+        rindex = self._reply_map.get(index)
+        if rindex is None and self._reply_done:
+            return -1
+        return rindex
+
     def seek(self, offset, whence=os.SEEK_SET, hard=False):
         """Position the read offset correctly
            If new position is outside the current read buffer then clear the
            buffer so a new chunk of data will be read from the file instead
         """
-        soffset = self.fh.tell() - len(self.rdbuffer)
-        if hard or offset < soffset or whence != os.SEEK_SET:
-            # Seek is before the read buffer, do the actual seek
+        foffset = self.fh.tell()
+        soffset = foffset - len(self.rdbuffer)
+        if hard or offset < soffset or offset > foffset or whence != os.SEEK_SET:
+            # Seek is outside the read buffer, do the actual seek
             self.rdbuffer = ""
             self.rdoffset = 0
             self.fh.seek(offset, whence)
             self.offset = self.fh.tell()
         else:
-            # Seek is not before the read buffer
+            # Seek is within the read buffer
             self.rdoffset = offset - soffset
             self.offset = offset
 
+    def seek_time(self, secs):
+        """Position the trace file at the first packet having a timestamp
+           greater than or equal to the given time so the next packet
+           fetched will be that packet. Returns False if there is no such
+           packet, in which case the trace file is positioned at <EOF>.
+
+           The sparse time index is used to find a nearby record, then
+           the record headers are scanned from there so no packets are
+           decoded. Since the packets before the new position are never
+           decoded the packet index is set using the frame number and
+           all state (TCP streams, outstanding calls) is cleared.
+
+           secs:
+               Time given in seconds since the epoch
+
+           Examples:
+               # Display all packets starting 30 seconds into the trace
+               x.seek_time(x.time_value("+30"))
+               for pkt in x:
+                   print pkt
+        """
+        self.dprint('PKT1', ">>> seek_time(%f)" % secs)
+        found = False
+        if len(self.pktt_list) > 1:
+            # Dealing with multiple trace files
+            self.index  = 0
+            self.offset = 0
+            for obj in self.pktt_list:
+                if obj.seek_time(secs):
+                    found = True
+                self.index  += obj.index
+                self.offset += obj.offset
+            if self.dedup is not None:
+                self._share_state()
+        else:
+            self._build_time_index()
+            # The time index has the timestamps as given by the trace file
+            tsecs = secs + self.clock_offset
+            # Get the last index entry where all records before it
+            # have a timestamp less than the given time
+            idx = bisect.bisect_left(self._tindex_secs, tsecs) - 1
+            offset, frame = self._tindex_pos[idx]
+            found = self._seek_record(offset, frame, lambda f, t: t >= tsecs)
+        self._seek_done("seek_time", secs)
+        return found
+
+    def seek_frame(self, frame):
+        """Position the trace file at the given frame number so the next
+           packet fetched will be the first packet in that frame. Returns
+           False if there is no such frame, in which case the trace file
+           is positioned at <EOF>.
+
+           The sparse time index is used to find a nearby record so no
+           packets are decoded, see seek_time(). This is not supported
+           when dealing with multiple trace files since frame numbers
+           are relative to each trace file.
+
+           frame:
+               Frame number
+        """
+        self.dprint('PKT1', ">>> seek_frame(%d)" % frame)
+        if len(self.pktt_list) > 1:
+            raise Exception("Seek by frame number is not supported for multiple trace files")
+        self._build_time_index()
+        idx = bisect.bisect_right([x[1] for x in self._tindex_pos], frame) - 1
+        offset, iframe = self._tindex_pos[max(idx, 0)]
+        found = self._seek_record(offset, iframe, lambda f, t: f >= frame)
+        self._seek_done("seek_frame", frame)
+        return found
+
+    def _seek_record(self, offset, frame, func):
+        """Scan the record headers starting at the given offset, which
+           is the offset of the given frame number, and position the trace
+           file at the first record where func(frame, secs) is true.
+           Returns False if no record is found, in which case the trace
+           file is positioned at <EOF>.
+        """
+        found = False
+        self.seek(offset, hard=True)
+        while True:
+            boffset = self.offset
+            data = self._read(16)
+            if len(data) < 16:
+                break
+            ulist = struct.unpack(self.header_rec, data)
+            if func(frame, float(ulist[0]) + float(ulist[1])/1000000.0):
+                found = True
+                break
+            if len(self._read(ulist[2])) < ulist[2]:
+                break
+            frame += 1
+
+        # Position the file pointer at the start of the record found
+        self.seek(boffset)
+        self.boffset = boffset
+        self.index   = frame - 1
+        self.frame   = frame
+        self.eof     = False
+        self.tstart  = self._tindex_first - self.clock_offset
+        return found
+
+    def _seek_done(self, method, value):
+        """Clear all state after a seek and save the seek method and its
+           argument so rewind() can go back to the seek point
+        """
+        self.pkt      = None
+        self.pkt_call = None
+        self._cache_index    = None
+        self._tcp_stream_map = {}
+        self._rpc_xid_map    = {}
+        self._seek_base = (method, value, self.index)
+        # Packet indexes are not the same after a seek
+        self._clear_reply_index()
+
+    def _clear_seek_base(self):
+        """Forget the last time seek, all packet indexes given after the
+           seek are not valid once the trace file is processed from the
+           first packet
+        """
+        if self._seek_base is not None:
+            self._seek_base = None
+            self._clear_reply_index()
+
+    def time_value(self, value):
+        """Convert the given time value to seconds since the epoch.
+
+           value:
+               Seconds since the epoch as a number or string, seconds
+               relative to the first packet if the string starts with "+",
+               or a local date and time string "YYYY-MM-DD HH:MM:SS[.usecs]".
+               The date is optional, if not given the date of the first
+               packet is used
+
+           Examples:
+               # Ten and a half seconds after the first packet
+               secs = x.time_value("+10.5")
+
+               # Using the date of the first packet
+               secs = x.time_value("13:42:56.530957")
+
+               secs = x.time_value("2014-03-16 13:42:56")
+        """
+        if not isinstance(value, str):
+            return float(value)
+        value = value.strip()
+        if value[:1] == "+":
+            return self._first_time() + float(value[1:])
+        try:
+            return float(value)
+        except ValueError:
+            pass
+
+        regex = re.search(r"^((\d+-\d+-\d+)\s+)?(\d+:\d+:\d+)(\.\d*)?$", value)
+        if regex is None:
+            raise ValueError("Invalid time value '%s'" % value)
+        date = regex.group(2)
+        if date is None:
+            # Use the date of the first packet
+            date = time.strftime("%Y-%m-%d", time.localtime(self._first_time()))
+        secs = time.mktime(time.strptime(date + " " + regex.group(3), "%Y-%m-%d %H:%M:%S"))
+        if regex.group(4):
+            secs += float("0" + regex.group(4))
+        return secs
+
+    def _first_time(self):
+        """Return the timestamp of the first record in the trace file(s)"""
+        if len(self.pktt_list) > 1:
+            return min([obj._first_time() for obj in self.pktt_list])
+        if self._tindex_first is None:
+            self._getfh()
+            fh = self._open_copy()
+            try:
+                fh.seek(self.ioffset)
+                data = fh.read(16)
+            finally:
+                fh.close()
+            if len(data) < 16:
+                raise Exception("Packet trace file has no packets")
+            ulist = struct.unpack(self.header_rec, data)
+            self._tindex_first = float(ulist[0]) + float(ulist[1])/1000000.0
+        return self._tindex_first - self.clock_offset
+
+    def _open_copy(self):
+        """Open a new file handle for the trace file so it can be read
+           without disturbing the read buffer of the main file handle
+        """
+        if isinstance(self.fh, gzip.GzipFile):
+            return gzip.open(self.tfile, 'rb')
+        return open(self.tfile, 'rb')
+
+    def _build_time_index(self, scan=None):
+        """Build the sparse time index by walking the record headers of the
+           trace file, the packets are not decoded. An entry is added every
+           TIME_INDEX_STEP records and it has the maximum timestamp of all
+           records before it, so the index can be searched using bisect even
+           if the records are not strictly in timestamp order.
+
+           scan:
+               Use the record header arrays of this PcapScan object instead
+               of walking the trace file [default: None]
+        """
+        if self._tindex_secs is not None and scan is None:
+            return
+        self._getfh()
+        maxsecs = float("-inf")
+        tlist   = [maxsecs]
+        plist   = [(self.ioffset, 1)]
+        tfirst  = None
+        if scan is not None:
+            if scan.count > 0:
+                secs = scan.secs()
+                tfirst = float(secs[0])
+                # Running maximum of all timestamps
+                if pcapscan.numpy is not None:
+                    secs = pcapscan.numpy.maximum.accumulate(secs)
+                else:
+                    rmax = []
+                    for tsecs in secs:
+                        maxsecs = max(maxsecs, tsecs)
+                        rmax.append(maxsecs)
+                    secs = rmax
+                for idx in xrange(TIME_INDEX_STEP-1, scan.count, TIME_INDEX_STEP):
+                    tlist.append(float(secs[idx-1]))
+                    plist.append((int(scan.offset[idx]), idx+1))
+        else:
+            self.dprint('PKT1', ">>> building time index for %s" % self.tfile)
+            frame = 1
+            fh = self._open_copy()
+            try:
+                for item in pcapscan.walk_records(fh, self.ioffset, self.header_rec):
+                    secs = float(item[1]) + float(item[2])/1000000.0
+                    if tfirst is None:
+                        tfirst = secs
+                    if frame % TIME_INDEX_STEP == 0:
+                        tlist.append(maxsecs)
+                        plist.append((item[0], frame))
+                    if secs > maxsecs:
+                        maxsecs = secs
+                    frame += 1
+            finally:
+                fh.close()
+        self._tindex_secs  = tlist
+        self._tindex_pos   = plist
+        self._tindex_first = tfirst
+
+    def scan(self, use_mmap=True):
+        """Walk the record headers of the trace file without decoding any
+           packets and return a PcapScan object having the offset, timestamp
+           and lengths of every record as arrays. The arrays are also used
+           to seed the time index so no other walk is needed by seek_time().
+           A list of PcapScan objects, one for each trace file, is returned
+           when dealing with multiple trace files.
+
+           use_mmap:
+               Map the trace file into memory instead of reading it
+               [default: True]
+
+           Examples:
+               # Number of packets and bytes on the wire
+               scan = x.scan()
+               npkts = scan.count
+               nbytes = scan.total_bytes()[1]
+        """
+        if len(self.pktt_list) > 1:
+            return [obj.scan(use_mmap) for obj in self.pktt_list]
+        scan = pcapscan.PcapScan(self.tfile, use_mmap)
+        self._build_time_index(scan)
+        return scan
+
     def _getfh(self):
         """Get the filehandle of the trace file, open file if necessary."""
         if self.fh == None:
@@ -836,7 +1701,15 @@ class Pktt(BaseObj, Unpack):
 
         return ret
 
-    def match(self, expr, maxindex=None, rewind=True, reply=False):
+    def _compile_match(self, expr):
+        """Parse the match expression and convert it into the expression
+           to be evaluated for every packet.
+        """
+        st = parser.expr(expr)
+        smap = parser.st2list(st)
+        return self._convert_match(smap)
+
+    def match(self, expr, maxindex=None, rewind=True, reply=False, start_time=None, end_time=None):
         """Return the packet that matches the given expression, also the packet
            index points to the next packet after the matched packet.
            Returns None if packet is not found and the packet index points
@@ -850,6 +1723,13 @@ class Pktt(BaseObj, Unpack):
                Rewind to index where matching started if match fails
            reply:
                Match RPC replies of previously matched calls as well
+           start_time:
+               Start the search at the first packet with a timestamp greater
+               than or equal to this time if the current packet is before it
+               (seconds since the epoch)
+           end_time:
+               The match fails if the packet timestamp is after this time
+               (seconds since the epoch)
 
            Examples:
                # Find the packet with both the ACK and SYN TCP flags set to 1
@@ -886,6 +1766,9 @@ class Pktt(BaseObj, Unpack):
                if ("NFS.argop == 38" in x):
                    print x.pkt.nfs
 
+               # Find the next WRITE request within the given time window
+               pkt = x.match("NFS.argop == 38", start_time=tstart, end_time=tend)
+
            See also:
                match_ethernet(), match_ip(), match_tcp(), match_rpc(), match_nfs()
         """
@@ -893,17 +1776,24 @@ class Pktt(BaseObj, Unpack):
         save_index = self.index
 
         # Parse match expression
-        st = parser.expr(expr)
-        smap = parser.st2list(st)
-        pdata = self._convert_match(smap)
+        pdata = self._compile_match(expr)
         self.dprint('PKT1', ">>> %d: match(%s)" % (self.index, expr))
         self.reply_matched = False
 
+        if start_time is not None:
+            record = getattr(self.pkt, "record", None)
+            if record is None or record.secs < start_time:
+                # Skip all packets before the start of the time window
+                self.seek_time(start_time)
+
         # Search one packet at a time
         for pkt in self:
             if maxindex and self.index > maxindex:
                 # Hit maxindex limit
                 break
+            if end_time is not None and pkt.record.secs > end_time:
+                # Hit end of time window
+                break
             try:
                 if reply and pkt == "rpc" and pkt.rpc.type == 1 and pkt.rpc.xid in self._match_xid_list:
                     self.dprint('PKT1', ">>> %d: match() -> True: reply" % pkt.record.index)
@@ -928,6 +1818,111 @@ class Pktt(BaseObj, Unpack):
         self.dprint('PKT1', ">>> match() -> False")
         return None
 
+    def match_many(self, exprs, counts=None, maxindex=None, rewind=False, reply=False, start_time=None, end_time=None):
+        """Generator to search for multiple expressions in a single forward
+           pass of the trace file. All expressions are evaluated for every
+           packet so the packet is decoded just once, a tuple (name, pkt)
+           is yielded for every expression matched, so a packet matching
+           more than one expression is yielded once for each of them.
+
+           exprs:
+               Dictionary of match expressions where the key is the name
+               of the expression, or a list of (name, expr) tuples to have
+               the expressions evaluated in the given order
+           counts:
+               Dictionary of the number of packets to match for each named
+               expression, once the count is reached the expression is not
+               evaluated anymore. The search stops when all expressions have
+               reached their counts, expressions not in this dictionary are
+               never exhausted [default: None]
+           maxindex:
+               The search stops if packet index hits this limit
+           rewind:
+               Rewind to index where the search started when done
+               [default: False]
+           reply:
+               Match RPC replies of previously matched calls as well, the
+               reply is yielded using the names of the expressions matching
+               the call [default: False]
+           start_time:
+               Start the search at the first packet with a timestamp greater
+               than or equal to this time (seconds since the epoch)
+           end_time:
+               The search stops if the packet timestamp is after this time
+               (seconds since the epoch)
+
+           Examples:
+               # Find the first OPEN and all WRITE and CLOSE requests
+               exprs = {
+                   "open":  "NFS.argop == 18",
+                   "write": "NFS.argop == 38",
+                   "close": "NFS.argop == 4",
+               }
+               for name, pkt in x.match_many(exprs, counts={"open": 1}):
+                   print name, pkt
+        """
+        if isinstance(exprs, dict):
+            exprs = exprs.items()
+        counts = dict(counts) if counts else {}
+
+        # Save current position
+        save_index = self.index
+
+        # List of [name, pdata, inlhs] for all expressions to evaluate
+        plist = []
+        for name, expr in exprs:
+            self.inlhs = False
+            pdata = self._compile_match(expr)
+            plist.append([name, pdata, self.inlhs])
+        self.dprint('PKT1', ">>> %d: match_many(%s)" % (self.index, ", ".join([str(x[0]) for x in plist])))
+
+        if start_time is not None:
+            record = getattr(self.pkt, "record", None)
+            if record is None or record.secs < start_time:
+                # Skip all packets before the start of the time window
+                self.seek_time(start_time)
+
+        # Map of xids of matched calls to the names of the expressions
+        xid_map = {}
+        try:
+            for pkt in self:
+                if maxindex and self.index > maxindex:
+                    # Hit maxindex limit
+                    break
+                if end_time is not None and pkt.record.secs > end_time:
+                    # Hit end of time window
+                    break
+                if reply and pkt == "rpc" and pkt.rpc.type == 1 and pkt.rpc.xid in xid_map:
+                    self.dprint('PKT1', ">>> %d: match_many() -> True: reply" % pkt.record.index)
+                    self.reply_matched = True
+                    for name in xid_map.pop(pkt.rpc.xid):
+                        yield (name, pkt)
+                    continue
+                self.reply_matched = False
+                for item in list(plist):
+                    name, pdata, self.inlhs = item
+                    try:
+                        if not eval(pdata):
+                            continue
+                    except Exception:
+                        continue
+                    self.dprint('PKT1', ">>> %d: match_many() -> True: %s" % (pkt.record.index, name))
+                    if reply and pkt == "rpc" and pkt.rpc.type == 0:
+                        # Save xid of matched call
+                        xid_map.setdefault(pkt.rpc.xid, []).append(name)
+                    yield (name, pkt)
+                    if name in counts:
+                        counts[name] -= 1
+                        if counts[name] <= 0:
+                            # Expression has reached its count
+                            plist.remove(item)
+                if not plist and not xid_map:
+                    # All expressions have reached their counts
+                    break
+        finally:
+            if rewind:
+                self.rewind(save_index)
+
     def show_progress(self, done=False):
         """Display progress bar if enabled and if running on correct terminal"""
         if SHOWPROG and self.showprog and (done or self.index % 500 == 0) \
@@ -1047,6 +2042,128 @@ class Pktt(BaseObj, Unpack):
         """
         return "IP.dst == '%s' and TCP.dst_port == %d" % (ipaddr, port)
 
+class PcapWriter(BaseObj):
+    """Packet trace writer
+
+       Write a new packet trace file having only the packets added. The
+       original records are copied as raw bytes from the packet trace
+       files where they were decoded, they are not re-encoded. The records
+       are written when the object is closed, ordered by their timestamps,
+       so the same record is written only once even if it is added many
+       times, e.g., a TCP segment having multiple RPC packets. All the TCP
+       segments needed to decode an RPC packet are written as well, e.g.,
+       the segments of an RPC packet spanning multiple TCP segments.
+       The packet trace header is taken from the first packet trace file
+       written or from the packet trace file given if no records are
+       written.
+
+       Usage:
+           from packet.pktt import Pktt, PcapWriter
+
+           x = Pktt("/traces/tracefile.cap")
+           w = PcapWriter("/traces/subtrace.cap", "/traces/tracefile.cap")
+           while x.match("nfs.status != 0"):
+               # Add the packet and its call including the TCP handshake
+               w.add(x.pkt, handshake=True)
+               w.add(x.pkt_call)
+           w.close()
+
+       Object definition:
+
+       PcapWriter(
+           pcapfile = str, # Name of packet trace file to write
+           count    = int, # Number of records written
+       )
+    """
+    # Class attributes
+    _attrlist = ("pcapfile", "count")
+
+    def __init__(self, pcapfile, tfile=None):
+        """Constructor
+
+           pcapfile:
+               Name of packet trace file to write
+           tfile:
+               Packet trace file to take the header from if no records are
+               written, the packet trace file written is empty (no header)
+               if this is not given and no records are written [default: None]
+        """
+        self.pcapfile = pcapfile
+        self.count    = 0
+        self._tfile   = tfile
+        # Records added: (trace file, offset) => timestamp
+        self._records = {}
+
+    def add(self, pkt, handshake=False):
+        """Add packet to be written, the packet is ignored if it is None
+
+           pkt:
+               Packet object (packet.pkt.Pkt)
+           handshake:
+               Add the SYN and SYN/ACK segments of the packet's TCP stream
+               as well if they have been decoded [default: False]
+        """
+        if pkt is None or pkt.record is None:
+            return
+        records = [pkt.record]
+        if pkt.tcp is not None:
+            # Segments needed to decode the RPC packet
+            records += getattr(pkt.tcp, "rpc_records", [])
+            if handshake and pkt.tcp.handshake:
+                records += pkt.tcp.handshake
+        for record in records:
+            self._records[(record.tfile, record.offset)] = record.secs
+
+    def close(self):
+        """Write all records added to the packet trace file, returns the
+           number of records written
+        """
+        records = sorted(self._records.items(), key=lambda x: (x[1], x[0]))
+        readers = {}
+        fd = open(self.pcapfile, "wb")
+        try:
+            header = None
+            if not records and self._tfile is not None:
+                # No records to write, just write the header
+                self._open_reader(fd, readers, self._tfile, header)
+            for (tfile, offset), secs in records:
+                pktt = readers.get(tfile)
+                if pktt is None:
+                    pktt = self._open_reader(fd, readers, tfile, header)
+                    if header is None:
+                        header = pktt
+                pktt.seek(offset)
+                data = pktt._read(16)
+                ulist = struct.unpack(pktt.header_rec, data)
+                if pktt.header_rec != header.header_rec:
+                    # Byte order is different from the trace file header
+                    data = struct.pack(header.header_rec, *ulist)
+                fd.write(data + pktt._read(ulist[2]))
+                self.count += 1
+        finally:
+            fd.close()
+            for pktt in readers.values():
+                pktt.__del__()
+        self._records = {}
+        return self.count
+
+    def _open_reader(self, fd, readers, tfile, header):
+        """Open the packet trace file to copy its records and write the
+           packet trace header if this is the first file opened
+        """
+        pktt = Pktt(tfile)
+        pktt._getfh()
+        readers[tfile] = pktt
+        if header is None:
+            # Use the header of the first packet trace file
+            fd.write(pktt.ident + struct.pack(pktt.header_fmt,
+                     pktt.header.major, pktt.header.minor,
+                     pktt.header.zone_offset, pktt.header.accuracy,
+                     pktt.header.dump_length, pktt.header.link_type))
+        elif pktt.header.link_type != header.header.link_type:
+            raise Exception("Unable to write records with different link types: %s" % tfile)
+        return pktt
+
 if __name__ == '__main__':
     # Self test of module
     l_escape = [
@@ -48,8 +48,11 @@ class Record(BaseObj):
            usecs       = int,   # Microseconds
            length_inc  = int,   # Number of bytes included in trace
            length_orig = int,   # Number of bytes in packet
-           secs        = float, # Absolute seconds including microseconds
+           secs        = float, # Absolute seconds including microseconds,
+                                # minus the clock offset of the trace file
            rsecs       = float, # Seconds relative to first packet
+           offset      = int,   # File offset of the record
+           tfile       = str,   # Packet trace file name
        )
     """
     # Class attributes
@@ -75,9 +78,12 @@ class Record(BaseObj):
         self.usecs       = ulist[1]
         self.length_inc  = ulist[2]
         self.length_orig = ulist[3]
+        # The record header has just been read
+        self.offset      = pktt.offset - len(data)
+        self.tfile       = pktt.tfile
         pktt.pkt.record = self
-        # Seconds + microseconds
-        self.secs = float(self.seconds) + float(self.usecs)/1000000.0
+        # Seconds + microseconds on the aligned clock
+        self.secs = float(self.seconds) + float(self.usecs)/1000000.0 - pktt.clock_offset
 
         if pktt.tstart is None:
             # This is the first packet
@@ -0,0 +1,200 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Packet sampling module
+
+Select a fraction of the packets in a packet trace before they are decoded
+so very large packet traces could be analyzed quickly, the counts given by
+the analysis should be multiplied by the scale factor to get an estimate
+of the counts for the whole packet trace. Two sampling methods are
+supported:
+    stream sampling
+        All the packets of the selected TCP or UDP streams are decoded.
+        A stream is selected using a hash of its addresses and ports, the
+        same for both directions, so TCP reassembly is not affected and
+        calls and replies are kept together. Packets which are not TCP
+        or UDP are always decoded and they are not counted.
+    time sampling
+        Only the packets within the selected time windows are decoded,
+        the first (rate * period) seconds of every period. The windows
+        are aligned to the epoch so the same windows are selected on
+        packet traces captured on different hosts.
+"""
+import struct
+import hashlib
+import nfstest_config as c
+from baseobj import BaseObj
+from packet.dedup import packet_key
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+def stream_key(link_type, data):
+    """Return the key identifying the TCP or UDP stream of the packet given
+       by the raw record data, the key is the same for both directions of
+       the stream. None is returned if the packet is not a TCP or UDP packet
+
+       link_type:
+           Link type given by the trace file header
+       data:
+           Raw record data, only the packet headers are needed
+    """
+    key = packet_key(link_type, data)
+    if key is None:
+        return None
+    addrs, ports = key[0], key[1]
+    size = len(addrs) / 2
+    src = addrs[:size] + ports[0:2]
+    dst = addrs[size:] + ports[2:4]
+    return src + dst if src < dst else dst + src
+
+class Sampler(BaseObj):
+    """Packet sampler
+
+       Usage:
+           from packet.sample import Sampler
+
+           # Select 10% of the TCP and UDP streams
+           x = Sampler(0.1)
+
+           # Select the first second of every 10 seconds
+           x = Sampler(0.1, period=10)
+
+           # Check if the packet is selected
+           if x.select(secs, link_type, data):
+               # Decode the packet
+
+           # Estimate the total count from the count on the sampled packets
+           total = count * x.scale()
+
+       Object definition:
+
+       Sampler(
+           rate     = float, # Fraction of streams or time selected
+           period   = float, # Time sampling period in seconds
+           seed     = int,   # Hash seed for stream sampling
+           records  = int,   # Number of records sampled
+           selected = int,   # Number of records selected
+       )
+    """
+    # Class attributes
+    _attrlist = ("rate", "period", "seed", "records", "selected")
+
+    def __init__(self, rate, period=None, seed=0):
+        """Constructor
+
+           rate:
+               Fraction of the TCP and UDP streams selected or fraction of
+               every period selected when using time sampling, it must be
+               greater than zero and less than or equal to one
+           period:
+               Use time sampling with this period in seconds instead of
+               stream sampling [default: None]
+           seed:
+               Hash seed for stream sampling, a different seed selects
+               a different set of streams [default: 0]
+        """
+        if rate <= 0 or rate > 1:
+            raise ValueError("Invalid sampling rate: %s" % rate)
+        if period is not None and period <= 0:
+            raise ValueError("Invalid sampling period: %s" % period)
+        self.rate     = rate
+        self.period   = period
+        self.seed     = seed
+        self.records  = 0
+        self.selected = 0
+        self._seed = struct.pack("!I", seed & 0xffffffff)
+        # Hash values below this threshold are selected
+        self._threshold = int(rate * 0x100000000)
+        # Length of the time window selected on each period
+        self._window = rate * period if period is not None else None
+
+    def reset(self):
+        """Clear the number of records sampled and selected"""
+        self.records  = 0
+        self.selected = 0
+
+    def select_time(self, secs):
+        """Return True if the given time is within a selected time window,
+           it is always True for stream sampling
+        """
+        if self.period is None:
+            return True
+        return secs % self.period < self._window
+
+    def select_stream(self, link_type, data):
+        """Return True if the stream of the packet given by the raw record
+           data is selected, it is always True for time sampling or if the
+           packet is not a TCP or UDP packet
+        """
+        if self.period is not None:
+            return True
+        key = stream_key(link_type, data)
+        if key is None:
+            return True
+        return self._select_key(key)
+
+    def _select_key(self, key):
+        """Return True if the stream given by the key is selected"""
+        # CRC32 is not used since similar keys (consecutive addresses or
+        # ports) give hash values which are not uniformly distributed
+        digest = hashlib.md5(self._seed + key).digest()
+        return struct.unpack("!I", digest[:4])[0] < self._threshold
+
+    def select(self, secs, link_type=None, data=None, count=True):
+        """Return True if the packet is selected
+
+           secs:
+               Packet timestamp in seconds
+           link_type:
+               Link type given by the trace file header, only needed for
+               stream sampling [default: None]
+           data:
+               Raw record data, only needed for stream sampling
+               [default: None]
+           count:
+               Count the record as sampled, the record should not be
+               counted if it has been sampled before [default: True]
+        """
+        if self.period is not None:
+            ret = self.select_time(secs)
+        else:
+            key = stream_key(link_type, data)
+            if key is None:
+                # Packet is not a TCP or UDP packet so it is not sampled
+                return True
+            ret = self._select_key(key)
+        if count:
+            self.records += 1
+            if ret:
+                self.selected += 1
+        return ret
+
+    def fraction(self):
+        """Return the fraction of records selected, None if no records
+           have been sampled
+        """
+        if self.records == 0:
+            return None
+        return float(self.selected) / self.records
+
+    def scale(self):
+        """Return the factor to scale the counts given by the selected
+           packets to the whole packet trace, this is the inverse of the
+           sampling rate
+        """
+        return 1.0 / self.rate
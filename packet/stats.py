@@ -0,0 +1,1026 @@
+#===============================================================================
+# Copyright 2015 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Packet statistics module
+
+Provides objects to collect statistics in a single pass over a packet trace
+where the memory used does not depend on the number of packets.
+"""
+import math
+import heapq
+from collections import OrderedDict
+import nfstest_config as c
+from baseobj import BaseObj
+
+# Module constants
+__author__    = "Jorge Mora (%s)" % c.NFSTEST_AUTHOR_EMAIL
+__copyright__ = "Copyright (C) 2015 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+class Histogram(BaseObj):
+    """Fixed memory histogram
+
+       Values are counted in buckets with logarithmic boundaries so any
+       percentile is given with a relative error bounded by the precision
+       regardless of the number of values added. The number of buckets
+       depends only on the range of the values and the precision, e.g.,
+       values from one microsecond to one day with a precision of 1%
+       need less than 1300 buckets. The count, sum, minimum and maximum
+       are exact.
+
+       Usage:
+           from packet.stats import Histogram
+
+           x = Histogram()
+           for value in latencies:
+               x.add(value)
+
+           # Get the 99th percentile
+           p99 = x.percentile(99)
+
+       Object definition:
+
+       Histogram(
+           count     = int,   # Number of values added
+           total     = float, # Sum of all values added
+           minval    = float, # Minimum value added
+           maxval    = float, # Maximum value added
+       )
+    """
+    # Class attributes
+    _attrlist = ("count", "total", "minval", "maxval")
+
+    def __init__(self, precision=0.01, minvalue=1e-6):
+        """Constructor
+
+           precision:
+               Maximum relative error of the percentiles [default: 0.01]
+           minvalue:
+               All values less than or equal to this value are counted in
+               the same bucket [default: 1e-6]
+        """
+        self.precision = precision
+        self.minvalue  = minvalue
+        self.count     = 0
+        self.total     = 0.0
+        self.minval    = None
+        self.maxval    = None
+        self._buckets  = {}
+        self._logbase  = math.log((1.0 + precision) / (1.0 - precision))
+
+    def add(self, value, count=1):
+        """Add value to the histogram
+
+           value:
+               Value to add
+           count:
+               Number of times the value is added [default: 1]
+        """
+        if value <= self.minvalue:
+            idx = 0
+        else:
+            idx = int(math.log(value / self.minvalue) / self._logbase) + 1
+        self._buckets[idx] = self._buckets.get(idx, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.minval is None or value < self.minval:
+            self.minval = value
+        if self.maxval is None or value > self.maxval:
+            self.maxval = value
+
+    def merge(self, other):
+        """Add all values from the given histogram, both histograms must
+           have the same precision and minimum value
+        """
+        if other.precision != self.precision or other.minvalue != self.minvalue:
+            raise ValueError("Unable to merge histograms with different buckets")
+        for idx, count in other._buckets.items():
+            self._buckets[idx] = self._buckets.get(idx, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.minval is not None and (self.minval is None or other.minval < self.minval):
+            self.minval = other.minval
+        if other.maxval is not None and (self.maxval is None or other.maxval > self.maxval):
+            self.maxval = other.maxval
+
+    def _bucket_value(self, idx):
+        """Return the value representing all values in the given bucket,
+           this is the value with the smallest relative error to both
+           bucket boundaries
+        """
+        if idx == 0:
+            return self.minvalue
+        lower = self.minvalue * math.exp((idx - 1) * self._logbase)
+        return lower / (1.0 - self.precision)
+
+    def mean(self):
+        """Return the average of all values added"""
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def percentile(self, pct):
+        """Return the value at the given percentile
+
+           pct:
+               Percentile given as a number from 0 to 100
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(self.count * pct / 100.0)))
+        total = 0
+        for idx in sorted(self._buckets):
+            total += self._buckets[idx]
+            if total >= rank:
+                # Make sure the value is within the exact limits
+                return min(max(self._bucket_value(idx), self.minval), self.maxval)
+        return self.maxval
+
+    def percentiles(self, pctlist):
+        """Return the list of values for all the given percentiles"""
+        return [self.percentile(x) for x in pctlist]
+
+    def ks_test(self, other):
+        """Two sample Kolmogorov-Smirnov test, compare the distribution
+           of the values in this histogram to the distribution of the values
+           in the given histogram. Returns the tuple (D, pvalue) where D is
+           the maximum distance between both cumulative distributions and
+           pvalue is the probability of getting a distance at least as large
+           if both samples come from the same distribution. The distance is
+           measured at the bucket boundaries so both histograms must have
+           the same precision and minimum value.
+        """
+        if other.precision != self.precision or other.minvalue != self.minvalue:
+            raise ValueError("Unable to compare histograms with different buckets")
+        if self.count == 0 or other.count == 0:
+            return (None, None)
+        dist = 0.0
+        total1 = 0
+        total2 = 0
+        for idx in sorted(set(self._buckets) | set(other._buckets)):
+            total1 += self._buckets.get(idx, 0)
+            total2 += other._buckets.get(idx, 0)
+            dist = max(dist, abs(float(total1)/self.count - float(total2)/other.count))
+        # Asymptotic distribution of the statistic
+        nsize = float(self.count * other.count) / (self.count + other.count)
+        sqrtn = math.sqrt(nsize)
+        lam = (sqrtn + 0.12 + 0.11/sqrtn) * dist
+        if lam < 0.2:
+            return (dist, 1.0)
+        pvalue = 0.0
+        for k in xrange(1, 101):
+            term = 2 * (-1)**(k-1) * math.exp(-2 * k * k * lam * lam)
+            pvalue += term
+            if abs(term) < 1e-12:
+                break
+        return (dist, min(max(pvalue, 0.0), 1.0))
+
+def proportion_test(count1, total1, count2, total2):
+    """Two proportion z-test, compare the proportion count1/total1 to the
+       proportion count2/total2, e.g., the fraction of calls which are
+       re-transmitted on two packet traces. Returns the tuple (z, pvalue)
+       where z is the standard score of the difference and pvalue is the
+       two-sided probability of getting a difference at least as large
+       if both proportions are the same. The normal approximation is used
+       so the counts should not be too small.
+    """
+    if total1 == 0 or total2 == 0:
+        return (None, None)
+    prop1 = float(count1) / total1
+    prop2 = float(count2) / total2
+    prop = float(count1 + count2) / (total1 + total2)
+    stderr = math.sqrt(prop * (1.0 - prop) * (1.0/total1 + 1.0/total2))
+    if stderr == 0.0:
+        return (0.0, 1.0)
+    zscore = (prop2 - prop1) / stderr
+    return (zscore, math.erfc(abs(zscore) / math.sqrt(2.0)))
+
+class Timeline(BaseObj):
+    """Time bucketed counters
+
+       Counters are added for a given time and key, e.g., the client and
+       server pair, where the time is used to select the time interval
+       (bucket) where the counters are added. Buckets are aligned to
+       multiples of the interval so timelines created with the same
+       interval can be compared directly. Memory used depends on the
+       duration of the trace and the number of keys but not on the
+       number of packets.
+
+       Usage:
+           from packet.stats import Timeline
+
+           x = Timeline(0.1, ("ops", "bytes"))
+           x.add(pkt.record.secs, ("10.0.0.1", "10.0.0.2"), (1, 4096))
+
+           # Get the counters for every interval for the given key
+           for tstamp, ops, nbytes in x.series(("10.0.0.1", "10.0.0.2")):
+               print tstamp, ops, nbytes
+
+       Object definition:
+
+       Timeline(
+           interval = float, # Time interval in seconds
+           names    = list,  # Counter names
+       )
+    """
+    # Class attributes
+    _attrlist = ("interval", "names")
+
+    def __init__(self, interval, names):
+        """Constructor
+
+           interval:
+               Time interval in seconds of each bucket
+           names:
+               List of counter names
+        """
+        self.interval = interval
+        self.names    = tuple(names)
+        self._first   = None
+        self._last    = None
+        self._data    = {}
+
+    def add(self, secs, key, values):
+        """Add counters to the bucket for the given time and key
+
+           secs:
+               Time in seconds
+           key:
+               Key, this could be any hashable object
+           values:
+               List of values to add, one for each counter
+        """
+        bucket = int(secs // self.interval)
+        if self._first is None or bucket < self._first:
+            self._first = bucket
+        if self._last is None or bucket > self._last:
+            self._last = bucket
+        kdata = self._data.get(key)
+        if kdata is None:
+            kdata = {}
+            self._data[key] = kdata
+        counters = kdata.get(bucket)
+        if counters is None:
+            kdata[bucket] = list(values)
+        else:
+            for i in xrange(len(values)):
+                counters[i] += values[i]
+
+    def keys(self):
+        """Return the sorted list of keys"""
+        return sorted(self._data)
+
+    def times(self):
+        """Return the list of start times for all buckets from the first
+           to the last bucket having any counters
+        """
+        if self._first is None:
+            return []
+        return [x * self.interval for x in xrange(self._first, self._last + 1)]
+
+    def series(self, key):
+        """Return the list of (secs, counter1, counter2, ...) for all
+           buckets from the first to the last bucket of any key, buckets
+           without counters for the given key are given as zeros
+        """
+        ret = []
+        if self._first is None:
+            return ret
+        kdata = self._data.get(key, {})
+        zeros = [0] * len(self.names)
+        for bucket in xrange(self._first, self._last + 1):
+            ret.append(tuple([bucket * self.interval] + kdata.get(bucket, zeros)))
+        return ret
+
+class QueueDepth(BaseObj):
+    """Outstanding RPC tracker
+
+       Keep track of the number of RPC calls in flight, calls sent without
+       having received their reply, for each transport stream. The queue
+       depth is tracked over time so the time weighted average and the
+       maximum depth are given for the whole stream and for each time
+       interval. Memory used depends on the number of streams, the number
+       of calls in flight and the duration of the trace but not on the
+       number of packets.
+
+       Events are expected in time order for each stream, events older
+       than the last event on the stream are ignored so packets processed
+       again after a rewind are not counted twice.
+
+       Usage:
+           from packet.stats import QueueDepth
+
+           x = QueueDepth(interval=1.0)
+           x.call(secs, ("10.0.0.1", 800, "10.0.0.2", 2049), xid)
+           x.reply(secs, ("10.0.0.1", 800, "10.0.0.2", 2049), xid)
+
+           # Get summary for every stream
+           for key in x.keys():
+               print key, x.summary(key)
+
+       Object definition:
+
+       QueueDepth(
+           interval = float, # Time interval in seconds for the time series
+           timeout  = float, # Calls without a reply for this many seconds
+                             # are no longer considered in flight
+       )
+    """
+    # Class attributes
+    _attrlist = ("interval", "timeout")
+
+    def __init__(self, interval=1.0, timeout=None):
+        """Constructor
+
+           interval:
+               Time interval in seconds for the time series [default: 1.0]
+           timeout:
+               Calls without a reply for this many seconds are no longer
+               considered in flight, by default a call is in flight until
+               its reply is found [default: None]
+        """
+        self.interval = interval
+        self.timeout  = timeout
+        self._streams = {}
+
+    def _advance(self, state, secs):
+        """Account for the current queue depth up to the given time"""
+        tlast = state["tlast"]
+        depth = state["depth"]
+        if depth > 0 and secs > tlast:
+            state["area"] += depth * (secs - tlast)
+            buckets = state["buckets"]
+            while tlast < secs:
+                bucket = int(tlast // self.interval)
+                tend = min(secs, (bucket + 1) * self.interval)
+                item = buckets.get(bucket)
+                if item is None:
+                    buckets[bucket] = [depth * (tend - tlast), depth]
+                else:
+                    item[0] += depth * (tend - tlast)
+                    item[1] = max(item[1], depth)
+                tlast = tend
+        state["tlast"] = secs
+
+    def _expire(self, state, secs):
+        """Remove all calls in flight which have timed out"""
+        xids = state["xids"]
+        heap = state["heap"]
+        while heap and secs - heap[0][0] > self.timeout:
+            tcall, xid = heapq.heappop(heap)
+            if xids.get(xid) != tcall:
+                # The reply has already been found
+                continue
+            self._advance(state, tcall + self.timeout)
+            del xids[xid]
+            state["depth"] -= 1
+            state["expired"] += 1
+
+    def _get_state(self, secs, key):
+        """Return the state for the given stream, None is returned if the
+           event is older than the last event on the stream
+        """
+        state = self._streams.get(key)
+        if state is None:
+            state = {
+                "xids":    {},   # Calls in flight: xid => call time
+                "heap":    [],   # Calls by call time: [(call time, xid), ...]
+                "depth":   0,    # Current queue depth
+                "maxdepth": 0,   # Maximum queue depth
+                "calls":   0,    # Number of calls
+                "dsum":    0,    # Sum of queue depth seen by each call
+                "area":    0.0,  # Integral of queue depth over time
+                "expired": 0,    # Number of calls timed out
+                "tfirst":  secs, # Time of first event
+                "tlast":   secs, # Time of last event
+                "buckets": {},   # Time series: bucket => [area, max depth]
+            }
+            self._streams[key] = state
+        elif secs < state["tlast"]:
+            return None
+        if self.timeout is not None:
+            self._expire(state, secs)
+        self._advance(state, secs)
+        return state
+
+    def call(self, secs, key, xid):
+        """Add RPC call to the given stream
+
+           secs:
+               Time of call in seconds
+           key:
+               Transport stream, e.g., (src, sport, dst, dport) of the call
+           xid:
+               RPC transaction id
+        """
+        state = self._get_state(secs, key)
+        if state is None or xid in state["xids"]:
+            # Old event or re-transmission
+            return
+        state["xids"][xid] = secs
+        if self.timeout is not None:
+            # Replied calls are removed from the heap once they time out
+            heapq.heappush(state["heap"], (secs, xid))
+        state["depth"] += 1
+        state["calls"] += 1
+        state["dsum"]  += state["depth"]
+        state["maxdepth"] = max(state["maxdepth"], state["depth"])
+        # Make sure the bucket maximum includes this call
+        bucket = int(secs // self.interval)
+        item = state["buckets"].get(bucket)
+        if item is None:
+            state["buckets"][bucket] = [0.0, state["depth"]]
+        else:
+            item[1] = max(item[1], state["depth"])
+
+    def reply(self, secs, key, xid):
+        """Remove the RPC call from the given stream once its reply is found
+
+           secs:
+               Time of reply in seconds
+           key:
+               Transport stream, e.g., (src, sport, dst, dport) of the call
+           xid:
+               RPC transaction id
+        """
+        state = self._get_state(secs, key)
+        if state is None or xid not in state["xids"]:
+            # Old event, duplicate reply or call not in trace
+            return
+        del state["xids"][xid]
+        state["depth"] -= 1
+
+    def keys(self):
+        """Return the sorted list of streams"""
+        return sorted(self._streams)
+
+    def summary(self, key):
+        """Return a dictionary with the summary statistics of the stream:
+               calls:    number of calls
+               mean:     average queue depth seen by each call, including
+                         the call itself
+               max:      maximum queue depth
+               twavg:    time weighted average of the queue depth from
+                         the first to the last event on the stream
+               duration: time from the first to the last event
+               inflight: number of calls in flight at the last event
+               expired:  number of calls timed out
+        """
+        state = self._streams[key]
+        duration = state["tlast"] - state["tfirst"]
+        return {
+            "calls":    state["calls"],
+            "mean":     float(state["dsum"]) / state["calls"] if state["calls"] else 0.0,
+            "max":      state["maxdepth"],
+            "twavg":    state["area"] / duration if duration > 0 else float(state["depth"]),
+            "duration": duration,
+            "inflight": state["depth"],
+            "expired":  state["expired"],
+        }
+
+    def series(self, key):
+        """Return the list of (secs, twavg, max) for every time interval
+           from the first to the last event on the stream, where twavg is
+           the time weighted average and max is the maximum queue depth
+           on the interval
+        """
+        state = self._streams[key]
+        buckets = state["buckets"]
+        ret = []
+        first = int(state["tfirst"] // self.interval)
+        last  = int(state["tlast"] // self.interval)
+        for bucket in xrange(first, last + 1):
+            item = buckets.get(bucket, [0.0, 0])
+            ret.append((bucket * self.interval, item[0] / self.interval, item[1]))
+        return ret
+
+# TCP flags
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+# Maximum number of segments not yet acknowledged kept for each direction,
+# the oldest segments are dropped when the limit is reached so a trace
+# having only one direction of the connection does not grow without bound
+MAX_PENDING = 65536
+
+def _seqdiff(seq1, seq2):
+    """Return the difference of two 32-bit sequence numbers taking into
+       account the sequence number wrap around
+    """
+    diff = (seq1 - seq2) & 0xFFFFFFFF
+    if diff >= 0x80000000:
+        diff -= 0x100000000
+    return diff
+
+def _seqbisect(pending, seq):
+    """Return the index of the first pending segment which ends after the
+       given sequence number, pending segments are sorted by the sequence
+       number of their end
+    """
+    lo = 0
+    hi = len(pending)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _seqdiff(pending[mid][0], seq) > 0:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+class TCPStats(BaseObj):
+    """TCP stream analytics
+
+       Keep track of the data flow on each direction of every TCP stream,
+       data sent from the source to the destination. For each direction
+       it gives the round trip time estimated from the data segments and
+       the ACKs acknowledging them (re-transmitted segments are not used
+       for the estimate), the number of re-transmissions, the number of
+       duplicate ACKs received by the sender, the number of times the
+       receiver advertised a zero window, the number of times the data
+       in flight filled the window advertised by the receiver, the
+       advertised window and the number of bytes in flight. All times
+       are measured at the point where the trace was captured.
+
+       The window scale is taken from the SYN segments, if the connection
+       was established before the trace was started the advertised window
+       is given as is since the scale is unknown.
+
+       Segments are expected in time order for each direction, segments
+       older than the last segment on the direction are ignored so packets
+       processed again after a rewind are not counted twice. At most
+       MAX_PENDING segments not yet acknowledged are kept for each
+       direction, the oldest segments are dropped when the ACKs are not
+       in the trace and no round trip time is given for them.
+
+       Usage:
+           from packet.stats import TCPStats
+
+           x = TCPStats(interval=1.0)
+           x.segment(secs, ("10.0.0.1", 800, "10.0.0.2", 2049), seq, ack,
+                     window, length, flags)
+
+           # Get summary for every direction
+           for key in x.keys():
+               print key, x.summary(key)
+
+       Object definition:
+
+       TCPStats(
+           interval = float, # Time interval in seconds for the time series
+       )
+    """
+    # Class attributes
+    _attrlist = ("interval",)
+
+    def __init__(self, interval=1.0, precision=0.01):
+        """Constructor
+
+           interval:
+               Time interval in seconds for the time series [default: 1.0]
+           precision:
+               Relative error of the round trip time percentiles
+               [default: 0.01]
+        """
+        self.interval  = interval
+        self.precision = precision
+        self._streams  = {}
+
+    def _get_state(self, key):
+        """Return the state for the given direction"""
+        state = self._streams.get(key)
+        if state is None:
+            state = {
+                "segments":  0,    # Number of data segments
+                "bytes":     0,    # Number of bytes sent, not including re-transmissions
+                "retrans":   0,    # Number of re-transmitted segments
+                "rbytes":    0,    # Number of bytes re-transmitted
+                "dupacks":   0,    # Number of duplicate ACKs received
+                "zerowin":   0,    # Number of zero window events
+                "winfull":   0,    # Number of window full events
+                "snd_nxt":   None, # Next sequence number to send
+                "snd_una":   None, # Oldest unacknowledged sequence number
+                "pending":   [],   # Segments not acknowledged: [seq end, time, re-transmitted]
+                "rtt":       Histogram(self.precision),
+                "window":    None, # Window advertised by the receiver
+                "minwin":    None, # Minimum window advertised by the receiver
+                "maxwin":    None, # Maximum window advertised by the receiver
+                "inflight":  0,    # Maximum number of bytes in flight
+                "isum":      0,    # Sum of bytes in flight seen by each data segment
+                "zerostate": False,# Receiver is advertising a zero window
+                "fullstate": False,# Data in flight has filled the window
+                "lastack":   None, # Last (ack, window) received
+                "syn":       False,# SYN segment has been seen
+                "wscale":    None, # Window scale option from the SYN
+                "shift":     0,    # Window scale used for the advertised window
+                "tfirst":    None, # Time of first segment
+                "tlast":     None, # Time of last segment
+                "last":      None, # Last segment to ignore the same segment
+                "buckets":   {},   # Time series: bucket => [min window, max window, max in flight]
+            }
+            self._streams[key] = state
+        return state
+
+    def _bucket(self, state, secs):
+        """Return the time series entry for the given time"""
+        bucket = int(secs // self.interval)
+        item = state["buckets"].get(bucket)
+        if item is None:
+            item = [None, None, 0]
+            state["buckets"][bucket] = item
+        return item
+
+    def segment(self, secs, key, seq, ack, window, length, flags, wscale=None):
+        """Add TCP segment to the given direction
+
+           secs:
+               Time of segment in seconds
+           key:
+               Direction of segment given as (src, sport, dst, dport)
+           seq:
+               Sequence number
+           ack:
+               Acknowledgment number
+           window:
+               Window size as given in the TCP header
+           length:
+               Number of bytes of TCP payload
+           flags:
+               TCP raw flags
+           wscale:
+               Window scale option, only used on SYN segments [default: None]
+        """
+        sender = self._get_state(key)
+        if sender["tlast"] is not None and secs < sender["tlast"]:
+            # Old segment
+            return
+        segment = (secs, seq, ack, window, length, flags)
+        if segment == sender["last"]:
+            # Same segment processed again, e.g., TCP segment having
+            # multiple RPC packets
+            return
+        sender["last"] = segment
+        if sender["tfirst"] is None:
+            sender["tfirst"] = secs
+        sender["tlast"] = secs
+
+        # State of the data flowing in the opposite direction,
+        # this segment acknowledges its data and advertises its window
+        receiver = self._get_state((key[2], key[3], key[0], key[1]))
+
+        if flags & TCP_SYN:
+            # Window scaling is used only if both ends send the option
+            sender["syn"] = True
+            sender["wscale"] = wscale
+            if receiver["syn"]:
+                use_scale = sender["wscale"] is not None and receiver["wscale"] is not None
+                sender["shift"]   = sender["wscale"] if use_scale else 0
+                receiver["shift"] = receiver["wscale"] if use_scale else 0
+
+        # Sequence space used by this segment
+        seglen = length
+        if flags & TCP_SYN:
+            seglen += 1
+        if flags & TCP_FIN:
+            seglen += 1
+
+        if seglen > 0:
+            send_end = (seq + seglen) & 0xFFFFFFFF
+            snd_nxt = sender["snd_nxt"]
+            if snd_nxt is not None and _seqdiff(seq, snd_nxt) < 0 and \
+               not (length <= 1 and _seqdiff(send_end, snd_nxt) == 0 and not flags & (TCP_SYN|TCP_FIN)):
+                # Re-transmission, keep-alive segments are not counted
+                sender["retrans"] += 1
+                sender["rbytes"]  += length
+                pending = sender["pending"]
+                index = _seqbisect(pending, seq)
+                while index < len(pending) and _seqdiff(pending[index][0], send_end) <= 0:
+                    # Do not use re-transmitted segments for the RTT
+                    pending[index][2] = True
+                    index += 1
+            if snd_nxt is None or _seqdiff(send_end, snd_nxt) > 0:
+                if snd_nxt is not None and _seqdiff(seq, snd_nxt) < 0:
+                    sender["bytes"] += _seqdiff(send_end, snd_nxt)
+                else:
+                    sender["bytes"] += length
+                pending = sender["pending"]
+                pending.append([send_end, secs, False])
+                if len(pending) > MAX_PENDING:
+                    # Drop the oldest quarter of the segments at once,
+                    # these are never used for the RTT
+                    del pending[:MAX_PENDING//4]
+                sender["snd_nxt"] = send_end
+            if length > 0:
+                sender["segments"] += 1
+                if sender["snd_una"] is not None:
+                    inflight = max(0, _seqdiff(sender["snd_nxt"], sender["snd_una"]))
+                    sender["isum"] += inflight
+                    sender["inflight"] = max(sender["inflight"], inflight)
+                    item = self._bucket(sender, secs)
+                    item[2] = max(item[2], inflight)
+                    wnd = sender["window"]
+                    if wnd is not None and wnd > 0 and inflight >= wnd:
+                        if not sender["fullstate"]:
+                            sender["winfull"] += 1
+                            sender["fullstate"] = True
+                    else:
+                        sender["fullstate"] = False
+
+        if not flags & TCP_ACK or flags & TCP_RST:
+            return
+
+        # Window advertised for the data on the opposite direction,
+        # the window on a SYN segment is never scaled
+        if not flags & TCP_SYN:
+            window = window << sender["shift"]
+        receiver["window"] = window
+        if receiver["minwin"] is None or window < receiver["minwin"]:
+            receiver["minwin"] = window
+        if receiver["maxwin"] is None or window > receiver["maxwin"]:
+            receiver["maxwin"] = window
+        item = self._bucket(receiver, secs)
+        if item[0] is None or window < item[0]:
+            item[0] = window
+        if item[1] is None or window > item[1]:
+            item[1] = window
+        if window == 0:
+            if not receiver["zerostate"]:
+                receiver["zerowin"] += 1
+                receiver["zerostate"] = True
+        else:
+            receiver["zerostate"] = False
+
+        snd_una = receiver["snd_una"]
+        if snd_una is None or _seqdiff(ack, snd_una) > 0:
+            # New data acknowledged
+            receiver["snd_una"] = ack
+            pending = receiver["pending"]
+            count = _seqbisect(pending, ack)
+            if count > 0:
+                # Use the last segment fully acknowledged by this ACK
+                item = pending[count-1]
+                if not item[2]:
+                    receiver["rtt"].add(secs - item[1])
+                del pending[:count]
+        elif seglen == 0 and ack == snd_una and receiver["snd_nxt"] is not None and \
+             _seqdiff(receiver["snd_nxt"], ack) > 0 and receiver["lastack"] == (ack, window):
+            # Duplicate ACK: no data, same ACK and same window while
+            # there is data not yet acknowledged
+            receiver["dupacks"] += 1
+        receiver["lastack"] = (ack, window)
+
+    def keys(self):
+        """Return the sorted list of directions"""
+        return sorted(self._streams)
+
+    def summary(self, key):
+        """Return a dictionary with the summary statistics of the direction:
+               segments: number of data segments
+               bytes:    number of bytes sent, not including re-transmissions
+               retrans:  number of re-transmitted segments
+               rbytes:   number of bytes re-transmitted
+               dupacks:  number of duplicate ACKs received by the sender
+               zerowin:  number of times the receiver advertised a zero
+                         window
+               winfull:  number of times the data in flight filled the
+                         window advertised by the receiver
+               rtt:      Histogram of the round trip time
+               minwin:   minimum window advertised by the receiver
+               maxwin:   maximum window advertised by the receiver
+               inflight: maximum number of bytes in flight
+               imean:    average number of bytes in flight seen by each
+                         data segment
+               duration: time from the first to the last segment
+        """
+        state = self._streams[key]
+        duration = 0.0
+        if state["tfirst"] is not None:
+            duration = state["tlast"] - state["tfirst"]
+        return {
+            "segments": state["segments"],
+            "bytes":    state["bytes"],
+            "retrans":  state["retrans"],
+            "rbytes":   state["rbytes"],
+            "dupacks":  state["dupacks"],
+            "zerowin":  state["zerowin"],
+            "winfull":  state["winfull"],
+            "rtt":      state["rtt"],
+            "minwin":   state["minwin"],
+            "maxwin":   state["maxwin"],
+            "inflight": state["inflight"],
+            "imean":    float(state["isum"]) / state["segments"] if state["segments"] else 0.0,
+            "duration": duration,
+        }
+
+    def series(self, key):
+        """Return the list of (secs, minwin, maxwin, inflight) for every
+           time interval having any segments on the direction, where minwin
+           and maxwin are the minimum and maximum window advertised by the
+           receiver (None if not advertised on the interval) and inflight
+           is the maximum number of bytes in flight on the interval
+        """
+        buckets = self._streams[key]["buckets"]
+        return [tuple([x * self.interval] + buckets[x]) for x in sorted(buckets)]
+
+def clock_offset(samples1, samples2):
+    """Estimate the clock offset between two packet traces captured on
+       different hosts, e.g., on the client and on the server, using the
+       RPC calls and replies seen on both packet traces. Returns the tuple
+       (offset, count) where offset is the time in seconds to subtract
+       from the timestamps of the second packet trace to have them on the
+       same clock as the first packet trace and count is the number of RPC
+       calls seen on both. The offset is None if there are no RPC calls
+       in common.
+
+       The offset is the median of the differences between the midpoints
+       of each call and its reply on both packet traces, this assumes the
+       network delay is the same in both directions. The offset is then
+       limited so no call is seen after its reply: the packet trace having
+       the largest round trip time for a call is the one closer to the
+       client so the call must be seen there first and the reply last.
+
+       samples1:
+           Dictionary of RPC calls for the first packet trace where the
+           key identifies the call, e.g., (client, xid), and the value is
+           the tuple (call time, reply time)
+       samples2:
+           Dictionary of RPC calls for the second packet trace
+    """
+    diffs = []
+    lower = float("-inf")
+    upper = float("inf")
+    for key, item in samples1.items():
+        item2 = samples2.get(key)
+        if item2 is None:
+            continue
+        call1, reply1 = item
+        call2, reply2 = item2
+        diffs.append(((call2 + reply2) - (call1 + reply1)) / 2.0)
+        if reply1 - call1 >= reply2 - call2:
+            # First packet trace is closer to the client
+            lower = max(lower, reply2 - reply1)
+            upper = min(upper, call2 - call1)
+        else:
+            lower = max(lower, call2 - call1)
+            upper = min(upper, reply2 - reply1)
+    if not diffs:
+        return (None, 0)
+    diffs.sort()
+    mid = len(diffs) // 2
+    if len(diffs) % 2:
+        offset = diffs[mid]
+    else:
+        offset = (diffs[mid-1] + diffs[mid]) / 2.0
+    if lower <= upper:
+        # Bounds are consistent
+        offset = min(max(offset, lower), upper)
+    return (offset, len(diffs))
+
+class RPCBreakdown(BaseObj):
+    """RPC latency breakdown
+
+       Split the latency of every RPC call seen on multiple packet traces,
+       e.g., captured on the client and on the server, into the time spent
+       on the network and the time spent by the server. The packet traces
+       must have their clocks aligned. For every call, the total latency is
+       the largest round trip time among all packet traces having the call
+       (closest to the client), the think time is the smallest round trip
+       time (closest to the server) and the wire time is the difference.
+
+       Calls seen on a single packet trace are discarded once no other
+       packet trace could have them, i.e., when a call is older than the
+       timeout given.
+
+       Usage:
+           from packet.stats import RPCBreakdown
+
+           x = RPCBreakdown()
+           x.call(secs, "client.cap", ("10.0.0.1", xid), ("NFSv3", "READ"))
+           x.call(secs, "server.cap", ("10.0.0.1", xid), ("NFSv3", "READ"))
+           x.reply(secs, "server.cap", ("10.0.0.1", xid))
+           x.reply(secs, "client.cap", ("10.0.0.1", xid))
+
+           # Get summary for every operation
+           for name in x.keys():
+               print name, x.summary(name)
+
+       Object definition:
+
+       RPCBreakdown(
+           timeout   = float, # Time in seconds to wait for a call to be
+                              # seen on another packet trace
+           unmatched = int,   # Number of calls seen on a single packet trace
+       )
+    """
+    # Class attributes
+    _attrlist = ("timeout", "unmatched")
+
+    def __init__(self, precision=0.01, timeout=60.0):
+        """Constructor
+
+           precision:
+               Maximum relative error of the percentiles [default: 0.01]
+           timeout:
+               Time in seconds to wait for a call to be seen on another
+               packet trace [default: 60.0]
+        """
+        self.timeout   = timeout
+        self.unmatched = 0
+        self._precision = precision
+        # Calls in order of their first time seen:
+        # key => [name, time of call, {source: [call time, reply time]}]
+        self._pending = OrderedDict()
+        # Histograms for each name: name => [total, wire, think]
+        self._stats = {}
+
+    def _expire(self, secs):
+        """Discard all calls older than the timeout"""
+        while self._pending:
+            key, entry = next(self._pending.iteritems())
+            if secs - entry[1] <= self.timeout:
+                break
+            del self._pending[key]
+            self.unmatched += 1
+
+    def call(self, secs, source, key, name):
+        """Add RPC call seen on the given packet trace
+
+           secs:
+               Time of call in seconds
+           source:
+               Packet trace where the call is seen, e.g., the file name
+           key:
+               RPC call, e.g., (client, xid)
+           name:
+               Name used to group the statistics, e.g., (version, operation)
+        """
+        self._expire(secs)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = [name, secs, {}]
+            self._pending[key] = entry
+        if source not in entry[2]:
+            # Ignore re-transmissions
+            entry[2][source] = [secs, None]
+
+    def reply(self, secs, source, key):
+        """Add RPC reply seen on the given packet trace, the breakdown
+           is computed once the reply has been seen on all packet traces
+           having the call
+
+           secs:
+               Time of reply in seconds
+           source:
+               Packet trace where the reply is seen, e.g., the file name
+           key:
+               RPC call, e.g., (client, xid)
+        """
+        entry = self._pending.get(key)
+        if entry is None:
+            return
+        times = entry[2].get(source)
+        if times is None or times[1] is not None:
+            # Call not seen on this packet trace or duplicate reply
+            return
+        times[1] = secs
+        rtts = [x[1] - x[0] for x in entry[2].values() if x[1] is not None]
+        if len(rtts) < 2 or len(rtts) < len(entry[2]):
+            # Wait for the reply to be seen on all packet traces
+            return
+        del self._pending[key]
+        total = max(rtts)
+        think = max(min(rtts), 0.0)
+        stats = self._stats.get(entry[0])
+        if stats is None:
+            stats = [Histogram(self._precision) for i in range(3)]
+            self._stats[entry[0]] = stats
+        stats[0].add(total)
+        stats[1].add(max(total - think, 0.0))
+        stats[2].add(think)
+
+    def keys(self):
+        """Return the sorted list of names"""
+        return sorted(self._stats)
+
+    def summary(self, name):
+        """Return a dictionary with the latency histograms for the given
+           name (see Histogram):
+               total: total latency
+               wire:  time spent on the network
+               think: time spent by the server
+        """
+        stats = self._stats[name]
+        return {"total": stats[0], "wire": stats[1], "think": stats[2]}
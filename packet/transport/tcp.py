@@ -34,6 +34,9 @@ __copyright__ = "Copyright (C) 2012 NetApp, Inc."
 __license__   = "GPL v2"
 __version__   = "1.4"
 
+# Maximum number of segment records kept for the RPC record being decoded
+MAX_RPC_RECORDS = 1000
+
 TCPflags = {
     0: "FIN",
     1: "SYN",
@@ -127,6 +130,14 @@ class TCP(BaseObj):
            checksum    = int, # Checksum
            urgent_ptr  = int, # Urgent pointer
            seq         = int, # Relative sequence number
+           rpc_frame   = int, # Frame number where the RPC record on this
+                              #   segment starts, decoding must start at
+                              #   this frame to decode the RPC packet
+           handshake   = list,# Records of the SYN and SYN/ACK segments
+                              #   of this stream, None if not in the trace
+           rpc_records = list,# Records of the segments of this stream
+                              #   holding the RPC record on this segment,
+                              #   from the segment given by rpc_frame
            options = list,    # List of TCP options
            data = string,     # Raw data of payload if unable to decode
        )
@@ -175,6 +186,14 @@ class TCP(BaseObj):
                 'last_seq': 0,
                 'seq_wrap': 0,
                 'seq_base': self.seq_number,
+                'rpc_frame': pktt.frame,
+                'rpc_records': [],
+                'handshake': None,
+                # Stream picked up in the middle, e.g., after a seek,
+                # the first RPC record must be searched for
+                'resync': not self.flags.SYN,
+                # Relative sequence number of the next data segment
+                'next_seq': None,
             }
 
         # De-reference stream map
@@ -184,6 +203,19 @@ class TCP(BaseObj):
             # Reset seq_base on SYN
             stream['seq_base'] = self.seq_number
             stream['last_seq'] = stream['seq_wrap']
+            # Keep the handshake records, the list is shared by both
+            # directions of the stream
+            handshake = None
+            if self.flags.ACK:
+                revid = "%s:%d-%s:%d" % (ip.dst, self.dst_port, ip.src, self.src_port)
+                revstream = pktt._tcp_stream_map.get(revid)
+                if revstream is not None:
+                    handshake = revstream['handshake']
+            if handshake is None or self.flags.ACK == 0:
+                handshake = []
+            handshake.append(pktt.pkt.record)
+            stream['handshake'] = handshake
+        self.handshake = stream['handshake']
 
         # Convert sequence numbers to relative numbers
         seq = self.seq_number - stream['seq_base'] + stream['seq_wrap']
@@ -213,10 +245,47 @@ class TCP(BaseObj):
             # This is a re-transmission, do not process
             return
 
+        if self.length > 0 and stream['next_seq'] is not None and seq > stream['next_seq']:
+            # Some segments are missing, e.g., only some of the segments
+            # are in the trace, search for the next RPC record
+            stream['msfrag'] = ''
+            stream['frag_off'] = 0
+            stream['resync'] = True
+
+        record = pktt.pkt.record
+        msfrag = len(stream['msfrag']) > 0
+        if self.length > 0 and msfrag:
+            # This segment continues the RPC record started on a previous
+            # segment, a new list is created since the list is given to
+            # every packet
+            self.rpc_frame = stream['rpc_frame']
+            records = stream['rpc_records']
+            if (not records or records[-1].offset != record.offset) and \
+               len(records) < MAX_RPC_RECORDS:
+                records = records + [record]
+            self.rpc_records = records
+        else:
+            # The RPC record starts on this segment
+            self.rpc_frame = pktt.frame
+            self.rpc_records = [record] if self.length > 0 else []
+
         self._decode_payload(pktt, stream)
 
         if self.length > 0:
             stream['last_seq'] = seq
+            stream['next_seq'] = seq + self.length
+            if len(stream['msfrag']) == 0:
+                # No RPC record is left incomplete
+                stream['rpc_frame'] = pktt.frame
+                stream['rpc_records'] = []
+            elif not msfrag or pktt.pkt.rpc is not None:
+                # The incomplete RPC record starts on this segment,
+                # drop all segments before it
+                stream['rpc_frame'] = pktt.frame
+                stream['rpc_records'] = [record]
+            else:
+                # The incomplete RPC record spans this segment as well
+                stream['rpc_records'] = self.rpc_records
 
     def __str__(self):
         """String representation of object
@@ -241,6 +310,31 @@ class TCP(BaseObj):
             out = BaseObj.__str__(self)
         return out
 
+    def _rpc_resync(self, pktt):
+        """Return the offset of the first RPC record starting on this
+           segment or None if there is no RPC record on this segment
+        """
+        unpack = pktt.unpack
+        start = unpack.tell()
+        data = unpack.getbytes()
+        ret = None
+        offset = 0
+        while True:
+            # Look for the RPC message type (CALL or REPLY) after the
+            # fragment header and the xid
+            pos = data.find("\x00\x00\x00", offset + 8)
+            if pos < 0 or pos + 4 > len(data):
+                break
+            offset = pos - 8
+            if data[pos+3] in "\x00\x01" and ord(data[offset]) & 0x80:
+                unpack.seek(start + offset)
+                if RPC(pktt, proto=6, state=False):
+                    ret = offset
+                    break
+            offset += 1
+        unpack.seek(start)
+        return ret
+
     def _decode_payload(self, pktt, stream):
         """Decode TCP payload."""
         rpc = None
@@ -260,6 +354,15 @@ class TCP(BaseObj):
                 pkt.krb = krb
             return
 
+        if stream['resync'] and stream['frag_off'] == 0 and len(stream['msfrag']) == 0:
+            # The segment could start with the end of an RPC record
+            # which started before the stream was picked up
+            offset = self._rpc_resync(pktt)
+            if offset is None:
+                return
+            stream['resync'] = False
+            stream['frag_off'] = offset
+
         if stream['frag_off'] > 0 and len(stream['msfrag']) == 0:
             # This RPC packet lies within previous TCP packet,
             # Re-position the offset of the data
@@ -276,3 +276,13 @@ class RPCload(BaseObj):
             return out
         else:
             return BaseObj.__str__(self)
+
+def display_table(header, rows, nkeys):
+    """Display rows aligned to the header where the first nkeys columns
+       are left justified and the rest are right justified
+    """
+    widths = [max([len(header[i])] + [len(x[i]) for x in rows]) for i in range(len(header))]
+    fmt = "  ".join(["%%-%ds" % w for w in widths[:nkeys]] + ["%%%ds" % w for w in widths[nkeys:]])
+    print fmt % tuple(header)
+    for row in rows:
+        print fmt % tuple(row)